@@ -0,0 +1,85 @@
+#ifndef BOUNDED_QUEUE_HPP
+#define BOUNDED_QUEUE_HPP
+
+#include <deque>
+#include <mutex>
+#include <utility>
+#include <condition_variable>
+
+// Thread safe FIFO of limited capacity, connects stages of a pipeline.
+// Items are moved in and out, and removed items are destroyed outside the lock.
+template <typename T>
+class BoundedQueue
+{
+public:
+    BoundedQueue(const unsigned queue_capacity) : capacity(queue_capacity), closed(false) {};
+
+    // Blocks while the queue is full, returns false if the queue was closed
+    bool push(T &&item)
+    {
+        std::unique_lock<std::mutex> lock(mutex);
+        not_full.wait(lock, [this] { return closed || items.size() < capacity; });
+        if (closed)
+            return false;
+        items.push_back(std::move(item));
+        not_empty.notify_one();
+        return true;
+    }
+
+    // Never blocks: if the queue is full, its oldest item is dropped. Returns true if an item was dropped
+    bool push_dropping(T &&item)
+    {
+        T dropped_item;
+        bool dropped = false;
+        {
+            std::lock_guard<std::mutex> lock(mutex);
+            if (closed)
+                return false;
+            if (items.size() >= capacity)
+            {
+                dropped_item = std::move(items.front());
+                items.pop_front();
+                dropped = true;
+            }
+            items.push_back(std::move(item));
+        }
+        not_empty.notify_one();
+        return dropped;
+    }
+
+    // Blocks until an item is available, returns false if the queue is closed and empty
+    bool pop(T &item)
+    {
+        T popped_item;
+        {
+            std::unique_lock<std::mutex> lock(mutex);
+            not_empty.wait(lock, [this] { return closed || !items.empty(); });
+            if (items.empty())
+                return false;
+            popped_item = std::move(items.front());
+            items.pop_front();
+        }
+        not_full.notify_one();
+        item = std::move(popped_item);
+        return true;
+    }
+
+    // Wakes up all waiting threads, items left in the queue can still be popped
+    void close()
+    {
+        std::lock_guard<std::mutex> lock(mutex);
+        closed = true;
+        not_empty.notify_all();
+        not_full.notify_all();
+    }
+
+private:
+    unsigned capacity;
+    bool closed;
+    std::deque<T> items;
+    std::mutex mutex;
+    std::condition_variable not_empty;
+    std::condition_variable not_full;
+};
+
+#endif
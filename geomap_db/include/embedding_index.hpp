@@ -0,0 +1,49 @@
+#ifndef EMBEDDING_INDEX_HPP
+#define EMBEDDING_INDEX_HPP
+
+#include <string>
+#include <vector>
+#include <cstdint>
+#include <utility>
+#include <stdexcept>
+
+enum class EmbeddingMetric
+{
+    L1,
+    L2
+};
+
+// Inverted file index: embeddings are clustered around k-means centroids and
+// a query only scans the lists of its nprobe closest centroids.
+// Small tables are scanned exhaustively. The index keeps positions of rows,
+// the embeddings themselves are owned by the caller.
+class EmbeddingIndex
+{
+public:
+    static const unsigned MIN_ROWS = 4096;
+    static const unsigned DEFAULT_NPROBE = 4;
+
+    EmbeddingIndex(const unsigned);
+
+    void build(const float *, const unsigned);
+    void add(const float *, const unsigned);
+    std::vector<std::pair<float, unsigned>> search(const float *, const float *, const unsigned, const EmbeddingMetric, const unsigned = DEFAULT_NPROBE) const;
+    // Index saved for a table of another identity is not loaded
+    bool load(const std::string &, const unsigned, const std::uint64_t);
+    void save(const std::string &, const std::uint64_t) const;
+    unsigned size() const;
+    bool is_flat() const;
+
+    static float distance(const float *, const float *, const unsigned, const EmbeddingMetric);
+
+private:
+    unsigned embedding_dim;
+    unsigned rows;
+    std::vector<float> centroids;
+    std::vector<std::vector<unsigned>> lists;
+
+    unsigned lists_amount() const;
+    unsigned nearest_centroid(const float *) const;
+};
+
+#endif
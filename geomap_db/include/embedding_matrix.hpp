@@ -0,0 +1,49 @@
+#ifndef EMBEDDING_MATRIX_HPP
+#define EMBEDDING_MATRIX_HPP
+
+#include <string>
+#include <vector>
+#include <cstdint>
+#include <cstddef>
+#include <stdexcept>
+#include <mapped_file.hpp>
+
+// Row ids, locations (2 per row) and float32 embeddings of all rows, stored as contiguous arrays.
+// Loaded matrix is memory mapped from its file and used without copying,
+// it is copied into memory only when rows are appended to it.
+// Table identity tells which database and which state of its table the rows were read from, a matrix of another identity is stale.
+class EmbeddingMatrix
+{
+public:
+    EmbeddingMatrix(const unsigned);
+
+    bool load(const std::string &);
+    void save(const std::string &) const;
+    void clear();
+    void append(const std::int64_t, const double, const double, const std::vector<double> &);
+    void append(const std::int64_t, const double, const double, const float *);
+    unsigned size() const;
+    std::int64_t last_row_id() const;
+    std::uint64_t table_identity() const;
+    void set_table_identity(const std::uint64_t);
+    const std::int64_t *row_ids() const;
+    const double *locations() const;
+    const float *embeddings() const;
+
+private:
+    unsigned embedding_dim;
+    unsigned rows;
+    std::uint64_t identity;
+    MappedFile file;
+    const std::int64_t *row_ids_data;
+    const double *locations_data;
+    const float *embeddings_data;
+    std::vector<std::int64_t> own_row_ids;
+    std::vector<double> own_locations;
+    std::vector<float> own_embeddings;
+
+    void detach();
+    void point_to_own();
+};
+
+#endif
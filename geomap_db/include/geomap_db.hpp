@@ -3,35 +3,77 @@
 
 #include <string>
 #include <vector>
+#include <algorithm>
+#include <unordered_map>
 #include <iostream>
 #include <stdexcept>
 #include <sqlite3.h>
+#include <embedding_index.hpp>
+#include <location_grid.hpp>
+#include <embedding_matrix.hpp>
+#include <metrics.hpp>
 
 class GeomapDB
 {
 public:
-    GeomapDB(const unsigned, const std::string &, const std::string &);
+    static const int BUSY_TIMEOUT_MS = 5000;
+    static const int PRINT_PRECISION = 10;
+    // Random token and count of updated and deleted rows of every table, cached matrix, grid and index are saved with them
+    static constexpr const char *IDENTITY_TABLE_NAME = "geomap_identity";
+
+    GeomapDB(const unsigned, const std::string &, const std::string &, const bool = false);
     ~GeomapDB();
 
     std::ostream &print_db(std::ostream &);
+    void begin_transaction();
+    void commit_transaction();
     void insert(const double, const double, const std::vector<double> &);
+    void insert_many(const std::vector<std::vector<double>> &);
     std::vector<std::vector<double>> get_closest_objects(const double, const double, const double);
     std::vector<double> get_most_similar_object(const std::vector<double> &);
+    std::vector<std::vector<double>> get_most_similar_objects(const std::vector<double> &, const unsigned, const EmbeddingMetric = EmbeddingMetric::L1, const unsigned = EmbeddingIndex::DEFAULT_NPROBE);
     std::vector<double> get_closest_most_similar_object(const double, const double, const double, const std::vector<double> &);
+    std::vector<std::vector<double>> get_closest_most_similar_objects(const double, const double, const double, const std::vector<std::vector<double>> &);
 
 private:
     std::string db_name;
     std::string table_name;
     sqlite3 *db;
-    char *err;
-    sqlite3_stmt *stmt;
+    bool read_only;
+    unsigned transaction_depth;
+    std::unordered_map<std::string, sqlite3_stmt *> statements;
     unsigned embedding_dim;
 
+    // Rows are kept in memory in order of their rowid for in-process search
+    EmbeddingIndex index;
+    EmbeddingMatrix matrix;
+    LocationGrid grid;
+    std::string index_path;
+    std::string matrix_path;
+    std::string grid_path;
+    bool index_changed;
+    bool matrix_changed;
+    bool grid_changed;
+    bool rows_reloaded;
+    std::uint64_t table_identity;
+
     void connection();
+    bool execute(const std::string &, const std::string &);
+    sqlite3_stmt *prepare(const std::string &);
     void create_table();
+    bool has_column(const std::string &);
+    void migrate_table();
+    void create_identity();
+    sqlite3_int64 get_last_row_id();
+    std::uint32_t get_data_version();
+    std::uint64_t get_table_identity();
+    void load_rows();
+    void load_index();
+    void update_index();
+    void append_row(const sqlite3_int64, const double, const double, const std::vector<double> &);
+    std::vector<double> get_row(const unsigned);
+    std::vector<float> to_query(const std::vector<double> &);
     std::vector<std::vector<double>> select(const std::string &);
-    std::string get_closest_condition(const double, const double, const double);
-    std::string get_embedding_distances_table(const std::vector<double> &);
 };
 
 #endif
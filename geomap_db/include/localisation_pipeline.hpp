@@ -0,0 +1,92 @@
+#ifndef LOCALISATION_PIPELINE_HPP
+#define LOCALISATION_PIPELINE_HPP
+
+#include <string>
+#include <vector>
+#include <mutex>
+#include <chrono>
+#include <utility>
+#include <iostream>
+#include <location_seeker.hpp>
+#include <bounded_queue.hpp>
+
+struct PipelineOptions
+{
+    unsigned queue_size = 2;
+    bool drop_frames = true;     // Drop the oldest decoded frame if segmentation can not keep up
+    double location_eps = 0.001;
+    unsigned report_every = 50;  // Frames between stage latency reports
+};
+
+// Python object which can be moved and destroyed by a thread without the GIL
+class PythonValue
+{
+public:
+    PythonValue() {};
+    PythonValue(py::object &&object) : value(std::move(object)) {};
+    PythonValue(PythonValue &&other) : value(std::move(other.value)) {};
+    PythonValue &operator=(PythonValue &&);
+    ~PythonValue();
+
+    py::object value;
+
+    void reset();
+};
+
+// Localisation of a video stream: decoding, segmentation, embedding and matching
+// run in their own threads and hand frames over through bounded queues
+class LocalisationPipeline
+{
+public:
+    LocalisationPipeline(LocationSeeker &, const PipelineOptions &);
+    void run(const std::string &);
+
+private:
+    enum Stage
+    {
+        DECODING,
+        SEGMENTATION,
+        EMBEDDING,
+        MATCHING,
+        LATENCY,
+        STAGES_AMOUNT
+    };
+
+    struct Frame
+    {
+        unsigned index;
+        std::chrono::steady_clock::time_point captured;
+        PythonValue image;
+        PythonValue crops;
+        TrackedObjects objects;
+    };
+
+    struct StageStats
+    {
+        unsigned count = 0;
+        double total_ms = 0;
+        double max_ms = 0;
+    };
+
+    LocationSeeker &seeker;
+    PipelineOptions options;
+    py::module_ image_processing;
+    py::module_ python_metrics;
+    // Links detections of consecutive frames, segmentation and embedding use it in frame order
+    PythonValue tracker;
+    BoundedQueue<Frame> decoded, segmented, embedded;
+
+    std::mutex stats_mutex;
+    StageStats stats[STAGES_AMOUNT];
+    unsigned dropped_amount, located_amount;
+    std::chrono::steady_clock::time_point started;
+
+    void decode(const std::string &);
+    void segment();
+    void embed();
+    void match();
+    void add_stat(const Stage, const std::chrono::steady_clock::time_point &, const long);
+    void report();
+};
+
+#endif
@@ -0,0 +1,16 @@
+#ifndef LOCALISATION_SOCKET_HPP
+#define LOCALISATION_SOCKET_HPP
+
+#include <string>
+#include <stdexcept>
+
+// Localisation requests are text lines over a UNIX socket:
+// "<uav_input> [lon lat]\n" is answered with "<lon> <lat>\n" or "error: <message>\n"
+const std::string DEFAULT_LOCALISATION_SOCKET = "localisation.sock";
+
+int listen_socket(const std::string &);
+int connect_socket(const std::string &);
+bool read_line(const int, std::string &);
+bool write_line(const int, const std::string &);
+
+#endif
@@ -0,0 +1,46 @@
+#ifndef LOCATION_GRID_HPP
+#define LOCATION_GRID_HPP
+
+#include <string>
+#include <vector>
+#include <cstdint>
+#include <stdexcept>
+#include <unordered_map>
+#include <mapped_file.hpp>
+
+// Uniform grid over (lon, lat): every cell keeps positions of rows inside it,
+// so a box query only visits cells it overlaps and its cost does not depend on the map size.
+// The grid keeps positions of rows, the locations themselves are owned by the caller.
+// Saved grid is memory mapped on load, rows added later are kept in memory.
+class LocationGrid
+{
+public:
+    static constexpr double DEFAULT_CELL_SIZE = 0.002;
+
+    LocationGrid(const double = DEFAULT_CELL_SIZE);
+
+    void add(const double, const double, const unsigned);
+    std::vector<unsigned> find(const double *, const double, const double, const double) const;
+    // Grid saved for a table of another identity is not loaded
+    bool load(const std::string &, const unsigned, const std::uint64_t);
+    void save(const std::string &, const std::uint64_t) const;
+    unsigned size() const;
+    void clear();
+
+private:
+    double cell_size;
+    unsigned rows;
+    std::unordered_map<std::uint64_t, std::vector<unsigned>> cells;
+
+    // Loaded cells: sorted keys, offsets of their positions (one extra at the end) and positions
+    MappedFile file;
+    unsigned loaded_cells_amount;
+    const std::uint64_t *loaded_keys;
+    const std::uint32_t *loaded_offsets;
+    const std::uint32_t *loaded_positions;
+
+    std::int64_t cell_index(const double) const;
+    static std::uint64_t cell_key(const std::int64_t, const std::int64_t);
+};
+
+#endif
@@ -3,27 +3,62 @@
 
 #include <string>
 #include <vector>
+#include <unordered_map>
 #include <iostream>
-#include <geomap_db.hpp>
+#include <sharded_geomap_db.hpp>
+#include <metrics.hpp>
 #include <pybind11/pybind11.h>
 #include <pybind11/embed.h>
 #include <pybind11/stl.h>
+#include <pybind11/numpy.h>
 
 namespace py = pybind11;
 
+std::vector<std::vector<double>> to_embeddings(const py::array_t<float, py::array::c_style | py::array::forcecast> &);
+
+// Detections of a frame linked to tracks by image_processing.BuildingTracker
+struct TrackedObjects
+{
+    std::vector<long> track_ids;
+    std::vector<bool> embedded;  // Embedding made in this frame, the match of the track is looked up again
+    std::vector<std::vector<double>> embeddings;
+};
+
+// Result of BuildingTracker.embed: track ids, embeddings and embedded flags
+TrackedObjects to_tracked_objects(const py::tuple &);
+
 class LocationSeeker
 {
 public:
-    LocationSeeker(const unsigned emb_dim, const std::string &geomap_db_name, const double prev_lon, const double prev_lat) : geomap_db(emb_dim, geomap_db_name, "geomap_embeddings"), previous_lon(prev_lon), previous_lat(prev_lat) {};
+    LocationSeeker(const unsigned emb_dim, const std::string &geomap_db_name, const double prev_lon, const double prev_lat) : geomap_db(emb_dim, geomap_db_name), previous_lon(prev_lon), previous_lat(prev_lat), frames_amount(0), image_processing(py::module_::import("py_src.image_processing")), python_metrics(py::module_::import("py_src.metrics")), tracker(image_processing.attr("BuildingTracker")())
+    {
+        geomap_db.move_to(previous_lon, previous_lat);
+    };
     std::vector<double> update_current_location(const std::string &, const double);
+    // Without a frame index frames are numbered in order of the calls
+    std::vector<double> update_current_location(const std::vector<std::vector<double>> &, const double, const long = -1);
+    // Tracked objects keep the match found for their embedding, only embedded ones are looked up
+    std::vector<double> update_current_location(const TrackedObjects &, const double, const long = -1);
+    void set_current_location(const double, const double);
+    void warm_up();
 
 private:
     py::scoped_interpreter guard{};
-    GeomapDB geomap_db;
+    // Shards of geomap_db_name around the current location, or the whole database if it is not split
+    ShardedGeomapDB geomap_db;
     unsigned embedding_dim;
     double previous_lon, previous_lat;
+    unsigned long frames_amount;
+    // Imported once, models are loaded on first use or by warm_up and stay in memory
+    py::module_ image_processing;
+    py::module_ python_metrics;
+    // Buildings of the images given by path, so consecutive images reuse their embeddings
+    py::object tracker;
+    std::unordered_map<long, std::vector<double>> track_matches;
 
-    std::vector<std::vector<double>> get_image_embeddings(const std::string &);
+    TrackedObjects get_image_objects(const std::string &);
+    long next_frame(const long);
+    std::vector<double> locate(const std::vector<std::vector<double>> &, const long);
 };
 
 #endif
@@ -0,0 +1,31 @@
+#ifndef MAPPED_FILE_HPP
+#define MAPPED_FILE_HPP
+
+#include <string>
+#include <cstddef>
+
+// Read only memory mapping of the whole file, unmapped on destruction
+class MappedFile
+{
+public:
+    MappedFile();
+    MappedFile(const MappedFile &) = delete;
+    MappedFile &operator=(const MappedFile &) = delete;
+    ~MappedFile();
+
+    bool open(const std::string &);
+    void close();
+    bool is_open() const;
+    const char *data() const;
+    size_t size() const;
+
+private:
+    void *mapping;
+    size_t mapping_size;
+};
+
+// Name next to path which only the calling process and thread write to.
+// Files are written there and renamed over path, so processes saving the same file at once do not mix their writes
+std::string temporary_path(const std::string &);
+
+#endif
@@ -0,0 +1,55 @@
+#ifndef METRICS_HPP
+#define METRICS_HPP
+
+#include <string>
+#include <cstdio>
+#include <mutex>
+#include <chrono>
+
+// Timings and counters of pipeline stages written as JSON lines, the same lines py_src/metrics.py writes.
+// GEOMAP_METRICS names the log file, - is stderr. Without it the log is never opened
+// and a timer costs one check of a flag.
+class Metrics
+{
+public:
+    Metrics(const Metrics &) = delete;
+    Metrics &operator=(const Metrics &) = delete;
+
+    static Metrics &instance();
+    bool enabled() const { return sink != NULL; };
+    // A negative frame means the event does not belong to a frame
+    void record(const std::string &, const double, const long = -1);
+    void count(const std::string &, const double, const long = -1);
+
+private:
+    std::FILE *sink;
+    std::mutex sink_mutex;
+
+    Metrics();
+    ~Metrics();
+    void write(const std::string &, const long);
+};
+
+// Records time from its construction to its destruction as an event of the stage
+class ScopedTimer
+{
+public:
+    ScopedTimer(const char *timer_stage, const long timer_frame = -1) : stage(timer_stage), frame(timer_frame), active(Metrics::instance().enabled())
+    {
+        if (active)
+            start = std::chrono::steady_clock::now();
+    };
+    ~ScopedTimer()
+    {
+        if (active)
+            Metrics::instance().record(stage, std::chrono::duration<double, std::milli>(std::chrono::steady_clock::now() - start).count(), frame);
+    };
+
+private:
+    const char *stage;
+    long frame;
+    bool active;
+    std::chrono::steady_clock::time_point start;
+};
+
+#endif
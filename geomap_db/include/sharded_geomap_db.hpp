@@ -0,0 +1,69 @@
+#ifndef SHARDED_GEOMAP_DB_HPP
+#define SHARDED_GEOMAP_DB_HPP
+
+#include <map>
+#include <set>
+#include <deque>
+#include <mutex>
+#include <memory>
+#include <string>
+#include <thread>
+#include <vector>
+#include <cstdint>
+#include <utility>
+#include <condition_variable>
+#include <geomap_db.hpp>
+
+// Geomap split by py_src/geomap_shards.py into square cells of the location columns, every cell is a database of its own.
+// Only shards within radius cells of the current location are kept open, the loader thread opens the shards
+// around a new location in the background and closes the ones left behind, so memory and query time
+// depend on the neighbourhood and not on the mission area.
+// Without a manifest next to the database the whole database is opened as one shard.
+class ShardedGeomapDB
+{
+public:
+    static const int DEFAULT_RADIUS = 1;
+    static constexpr const char *SHARDS_SUFFIX = ".shards";
+    static constexpr const char *MANIFEST_NAME = "manifest.txt";
+
+    ShardedGeomapDB(const unsigned, const std::string &, const int = DEFAULT_RADIUS);
+    ShardedGeomapDB(const ShardedGeomapDB &) = delete;
+    ShardedGeomapDB &operator=(const ShardedGeomapDB &) = delete;
+    ~ShardedGeomapDB();
+
+    bool is_sharded() const;
+    // Prefetches shards around the location and releases the far ones, never blocks on loading
+    void move_to(const double, const double);
+    // Shards the box overlaps are loaded first if the prefetch has not done it yet
+    std::vector<std::vector<double>> get_closest_most_similar_objects(const double, const double, const double, const std::vector<std::vector<double>> &);
+    unsigned loaded_shards_amount();
+
+private:
+    typedef std::pair<std::int64_t, std::int64_t> Cell;
+
+    unsigned embedding_dim;
+    std::string shards_path;
+    double shard_size;
+    int radius;
+    std::unique_ptr<GeomapDB> whole;
+
+    std::set<Cell> available;
+    // Loaded shards are shared with running queries, a shard released during a query is closed after it
+    std::map<Cell, std::shared_ptr<GeomapDB>> loaded;
+    std::deque<Cell> queued;
+    std::set<Cell> pending;
+    std::vector<std::shared_ptr<GeomapDB>> released;
+    std::mutex mutex;
+    std::condition_variable changed;
+    bool stopping;
+    std::thread loader;
+
+    bool read_manifest();
+    Cell cell_of(const double, const double) const;
+    std::string shard_name(const Cell &) const;
+    bool is_near(const Cell &, const Cell &, const int) const;
+    std::shared_ptr<GeomapDB> require(const Cell &);
+    void load_shards();
+};
+
+#endif
@@ -1,13 +1,22 @@
 import os
-import subprocess
-import glob
-import cv2
-import tqdm
+import argparse
 
-from py_src.geomap import build_geomap
-from py_src.image_processing import get_embeddings
+from py_src.geomap import build_geomap, GeomapFromFile
+from py_src.geomap_sync import sync_geomap, sync_archived_geomap, sync_rendered_geomap
+from py_src.mask_archive import MASK_ARCHIVE_PATH
+from py_src.geomap_shards import shard_geomap, shards_path
 
 
+parser = argparse.ArgumentParser(description='Fill geomap.db with embeddings of building masks')
+parser.add_argument('--rebuild', action='store_true', help='embed every mask again, not only new and changed ones')
+parser.add_argument('--region', type=float, nargs=4, metavar=('MIN_LON', 'MIN_LAT', 'MAX_LON', 'MAX_LAT'),
+                    help='render building masks of the region in a process pool and embed them without PNG files')
+parser.add_argument('--map-file', default="data/northwestern-fed-district-latest.osm.pbf", help='OSM file the region is read from')
+parser.add_argument('--processes', type=int, default=None, help='render processes, all cores by default')
+parser.add_argument('--shard-size', type=float, default=None,
+                    help='split geomap.db into shards of this size in degrees, existing shards are updated with their own size')
+args = parser.parse_args()
+
 # print("Input coordinates in form of (min_lon, min_lat, max_lon, max_lat, geomap_file_name)")
 # user_input = input().split(", ")
 # geomap_file_name = user_input.pop()
@@ -17,17 +26,23 @@ from py_src.image_processing import get_embeddings
 
 print("The region was successfully scanned!")
 
-masks_path = os.path.join('images', 'building')
-masks = glob.glob(masks_path + '/*.png')
-
-for mask in tqdm.tqdm(masks):
-    lon, lat = mask.split(';')
-    lon = lon[len(masks_path)+1:]
-    lat = lat[:-4]
-    embedding = get_embeddings([cv2.imread(mask)])[0]
-    command = f"./add_embeddings {len(embedding)} {lon} {lat} "
-    for emb_cord in embedding:
-        command += f"{float(emb_cord)} "
-    subprocess.run(command, shell = True, executable="/bin/bash")
+# Only new and changed masks are embedded, rows of removed masks are deleted
+if args.region:
+    geomap = GeomapFromFile(*args.region)
+    geomap.load_file(args.map_file, args.processes)
+    changes = sync_rendered_geomap(geomap, 'geomap.db', args.processes, rebuild=args.rebuild)
+elif os.path.exists(MASK_ARCHIVE_PATH):
+    changes = sync_archived_geomap(MASK_ARCHIVE_PATH, 'geomap.db', rebuild=args.rebuild)
+else:
+    # Masks of builds made before the mask archive
+    changes = sync_geomap(os.path.join('images', 'building'), 'geomap.db', rebuild=args.rebuild)
+print(f"{changes['added']} masks were added, {changes['updated']} updated, {changes['deleted']} deleted, {changes['kept']} kept")
+if changes['stale_rows_deleted']:
+    print(f"{changes['stale_rows_deleted']} rows without a known mask were deleted")
+
+# LocationSeeker opens shards instead of geomap.db as soon as they exist, so they are kept in line with it
+if args.shard_size or os.path.exists(shards_path('geomap.db')):
+    shards = shard_geomap('geomap.db', args.shard_size)
+    print(f"geomap.db is split into {shards['shards']} shards: {shards['written']} written, {shards['kept']} kept, {shards['removed']} removed")
 
 print("Database filled successfully! Ready to be put on the UAV")
@@ -0,0 +1,319 @@
+"""
+This module is the benchmark suite of the localisation hot path. Everything it needs is synthetic and made offline:
+an OSM extract of buildings and roads, geomap.db tables of the given sizes and frames cut from the rendered map,
+recorded frames can be given instead. It times GeomapFromFile.visualize_map, get_embeddings, segment_buildings,
+and through ./geomap_benchmark GeomapDB searches and LocationSeeker.update_current_location,
+then writes a JSON report and compares it with a baseline report.
+Run it from geomap_db after building: python -m py_src.benchmark
+"""
+
+import argparse
+import datetime
+import glob
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import cv2
+import numpy as np
+import osmium
+
+from py_src.geomap import GeomapFromFile
+from py_src.geomap_sync import open_database, mask_location, TABLE_NAME
+from py_src.mask_archive import MaskArchive, MASK_ARCHIVE_PATH
+
+REGION = (30.27, 59.91, 30.31, 59.93)           # min_lon, min_lat, max_lon, max_lat of the synthetic extract
+BUILDING_TAGS = ['yes', 'apartments', 'school', 'retail']
+ROADS_AMOUNT = 40
+METERS_PER_DEGREE = 111320.0
+EMBEDDING_DIMENSION = 16
+EMBEDDING_CLUSTERS = 256                        # PCA embeddings of buildings form clusters, as in index_benchmark
+QUERY_NOISE = 5.0                               # Buildings seen from the UAV differ from their map masks
+LOCATION_EPS = 0.001                            # The same box get_aprox_location searches in
+FRAME_SIZE = 640
+INSERT_CHUNK = 100000
+STAGES = ['map', 'embeddings', 'segmentation', 'db']
+SEGMENTATION_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'segmentation')
+
+def synthetic_region_osm(path : str, buildings : int, region : tuple = REGION, seed : int = 42) -> None:
+    """
+    Writes an OSM extract of rotated rectangular buildings and straight roads over the region
+    """
+    generator = np.random.default_rng(seed)
+    min_lon, min_lat, max_lon, max_lat = region
+    meters_per_lon = METERS_PER_DEGREE * np.cos(np.radians((min_lat + max_lat) / 2))
+    writer = osmium.SimpleWriter(path)
+    node_id = way_id = 0
+    try:
+        for _ in range(buildings):
+            center_lon, center_lat = generator.uniform(min_lon, max_lon), generator.uniform(min_lat, max_lat)
+            width, length, angle = generator.uniform(8, 40), generator.uniform(8, 60), generator.uniform(0, np.pi)
+            corners = np.array([[-width, -length], [width, -length], [width, length], [-width, length]]) / 2
+            rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+            nodes = []
+            for x, y in corners @ rotation.T:
+                node_id += 1
+                writer.add_node(osmium.osm.mutable.Node(id=node_id, version=1, location=(center_lon + x / meters_per_lon,
+                                                                                           center_lat + y / METERS_PER_DEGREE)))
+                nodes.append(node_id)
+            way_id += 1
+            writer.add_way(osmium.osm.mutable.Way(id=way_id, version=1, nodes=nodes + nodes[:1],
+                                                  tags={'building': str(generator.choice(BUILDING_TAGS))}))
+        for i in range(ROADS_AMOUNT):
+            # Half of the roads go from west to east, the other half from south to north
+            share = (i // 2 + 0.5) / (ROADS_AMOUNT // 2)
+            ends = [(min_lon, min_lat + share * (max_lat - min_lat)), (max_lon, min_lat + share * (max_lat - min_lat))] if i % 2 else \
+                   [(min_lon + share * (max_lon - min_lon), min_lat), (min_lon + share * (max_lon - min_lon), max_lat)]
+            nodes = []
+            for location in ends:
+                node_id += 1
+                writer.add_node(osmium.osm.mutable.Node(id=node_id, version=1, location=location))
+                nodes.append(node_id)
+            way_id += 1
+            writer.add_way(osmium.osm.mutable.Way(id=way_id, version=1, nodes=nodes, tags={'highway': 'residential'}))
+    finally:
+        writer.close()
+
+def synthetic_geomap_db(path : str, rows : int, density : float, region : tuple = REGION, seed : int = 42) -> None:
+    """
+    Fills geomap.db table with rows of clustered embeddings spread with the given density (rows per square km)
+    around the region center. Locations are stored the way pre_flight.py stores them, latitude first
+    """
+    generator = np.random.default_rng(seed)
+    min_lon, min_lat, max_lon, max_lat = region
+    center_lon, center_lat = (min_lon + max_lon) / 2, (min_lat + max_lat) / 2
+    half_side = np.sqrt(rows / density) * 1000 / 2
+    half_lat = half_side / METERS_PER_DEGREE
+    half_lon = half_side / (METERS_PER_DEGREE * np.cos(np.radians(center_lat)))
+    centers = generator.normal(0, 100, (EMBEDDING_CLUSTERS, EMBEDDING_DIMENSION)).astype(np.float32)
+
+    connection = open_database(path)
+    try:
+        connection.execute("BEGIN")
+        for start in range(0, rows, INSERT_CHUNK):
+            amount = min(INSERT_CHUNK, rows - start)
+            lats = generator.uniform(center_lat - half_lat, center_lat + half_lat, amount)
+            lons = generator.uniform(center_lon - half_lon, center_lon + half_lon, amount)
+            embeddings = centers[generator.integers(0, EMBEDDING_CLUSTERS, amount)] + \
+                         generator.normal(0, 20, (amount, EMBEDDING_DIMENSION)).astype(np.float32)
+            # Latitude goes to the lon column, see geomap_sync.TABLE_NAME
+            connection.executemany(f"INSERT INTO {TABLE_NAME}(lon, lat, embedding) VALUES(?, ?, ?)",
+                                   ((lat, lon, embedding.tobytes()) for lat, lon, embedding in zip(lats, lons, embeddings)))
+        connection.execute("COMMIT")
+    finally:
+        connection.close()
+
+def write_queries(db_path : str, path : str, queries : int, seed : int = 42) -> None:
+    """
+    Writes noisy copies of random rows as queries of ./geomap_benchmark, located a bit off their rows
+    """
+    generator = np.random.default_rng(seed)
+    connection = open_database(db_path)
+    try:
+        rows = connection.execute(f"SELECT max(rowid) FROM {TABLE_NAME}").fetchone()[0]
+        row_ids = [int(row_id) for row_id in generator.integers(1, rows + 1, queries)]
+        sample = {row_id: (lat, lon, blob) for row_id, lat, lon, blob in connection.execute(
+            f"SELECT rowid, lon, lat, embedding FROM {TABLE_NAME} WHERE rowid IN ({','.join(map(str, set(row_ids)))})")}
+    finally:
+        connection.close()
+    with open(path, 'w') as file:
+        for row_id in row_ids:
+            lat, lon, blob = sample[row_id]
+            embedding = np.frombuffer(blob, np.float32) + generator.normal(0, QUERY_NOISE, EMBEDDING_DIMENSION)
+            lat, lon = np.array([lat, lon]) + generator.uniform(-LOCATION_EPS / 2, LOCATION_EPS / 2, 2)
+            file.write(' '.join(f"{value:.10g}" for value in [lat, lon, *embedding]) + '\n')
+
+def cut_frames(image : np.ndarray, frames_path : str, amount : int, region : tuple = REGION, seed : int = 42) -> list[str]:
+    """
+    Cuts frames out of the rendered map, they are named like masks after the location of their center
+    """
+    generator = np.random.default_rng(seed)
+    min_lon, min_lat, max_lon, max_lat = region
+    height, width = image.shape[:2]
+    os.makedirs(frames_path, exist_ok=True)
+    paths = []
+    for _ in range(amount):
+        x, y = generator.integers(0, max(1, width - FRAME_SIZE)), generator.integers(0, max(1, height - FRAME_SIZE))
+        lat = max_lat - (y + FRAME_SIZE / 2) / height * (max_lat - min_lat)
+        lon = min_lon + (x + FRAME_SIZE / 2) / width * (max_lon - min_lon)
+        paths.append(os.path.join(frames_path, f"{lat};{lon}.png"))
+        cv2.imwrite(paths[-1], image[y:y + FRAME_SIZE, x:x + FRAME_SIZE])
+    return paths
+
+def frame_location(path : str, region : tuple = REGION) -> tuple[float, float]:
+    """
+    Location (lat, lon) of a frame named like masks, recorded frames without it start at the region center
+    """
+    try:
+        return mask_location(os.path.basename(path))
+    except ValueError:
+        min_lon, min_lat, max_lon, max_lat = region
+        return (min_lat + max_lat) / 2, (min_lon + max_lon) / 2
+
+def timed(action, repeats : int = 1) -> list[float]:
+    """
+    Runs action repeats times and returns durations in ms
+    """
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        action()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+def summary(samples : list[float]) -> dict:
+    """
+    Statistics of a stage, every value is in ms
+    """
+    ordered = sorted(samples)
+    return {'median_ms': statistics.median(ordered), 'p95_ms': ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))],
+            'min_ms': ordered[0], 'max_ms': ordered[-1], 'count': len(ordered)}
+
+def benchmark_map(osm_path : str, work_dir : str, repeats : int):
+    """
+    Times loading of the extract and visualize_map, which also packs building masks into an archive in work_dir/images.
+    Returns samples, the map image and the mask archive
+    """
+    geomap = GeomapFromFile(*REGION)
+    samples = {'load_file': timed(lambda: geomap.load_file(osm_path))}
+    masks_path = os.path.join(work_dir, MASK_ARCHIVE_PATH)
+    samples['visualize_map'] = timed(lambda: geomap.visualize_map(masks_path), repeats)
+    return samples, geomap.image, MaskArchive(masks_path)
+
+def benchmark_embeddings(masks : MaskArchive, batches : int) -> dict:
+    """
+    Times get_embeddings on batches of rendered masks, the first batch loads the models and is not counted
+    """
+    from py_src.image_processing import get_embeddings, EMBEDDING_BATCH_SIZE
+    crops = [masks.mask(i) for i in sorted(masks.latest('building').values())[:(batches + 1) * EMBEDDING_BATCH_SIZE]]
+    batches = [crops[start:start + EMBEDDING_BATCH_SIZE] for start in range(0, len(crops), EMBEDDING_BATCH_SIZE)]
+    get_embeddings(batches[0])
+    return {'get_embeddings': [timed(lambda: get_embeddings(batch))[0] for batch in batches[1:]]}
+
+def benchmark_segmentation(frames : list[str]) -> dict:
+    """
+    Times segment_buildings of segmentation/segmenter.py with the weights image_processing uses
+    """
+    from py_src.image_processing import SEGMENTATION_NET_PATH
+    sys.path.insert(0, SEGMENTATION_PATH)
+    import segmenter
+    segmenter.MODEL_PATH = SEGMENTATION_NET_PATH
+    segmenter.warm_up(FRAME_SIZE)
+    return {'segment_buildings': [timed(lambda: segmenter.segment_buildings(frame))[0] for frame in frames]}
+
+def benchmark_db(binary : str, work_dir : str, rows : int, density : float, queries : int, frames : list[str]) -> dict:
+    """
+    Makes a synthetic database of rows, unless it is already in work_dir, and runs ./geomap_benchmark on it.
+    Cached matrix, grid and index are removed first, so the first open builds them
+    """
+    db_path = os.path.join(work_dir, f"geomap_{rows}.db")
+    if not os.path.exists(db_path):
+        synthetic_geomap_db(db_path + '.tmp', rows, density)
+        os.replace(db_path + '.tmp', db_path)
+    for cache in glob.glob(f"{db_path}.{TABLE_NAME}.*"):
+        os.remove(cache)
+    queries_path = os.path.join(work_dir, f"queries_{rows}.txt")
+    write_queries(db_path, queries_path, queries)
+    command = [binary, db_path, queries_path, str(LOCATION_EPS)]
+    if frames:
+        frames_path = os.path.join(work_dir, 'frames.txt')
+        with open(frames_path, 'w') as file:
+            for frame in frames:
+                lat, lon = frame_location(frame)
+                # ./geomap_benchmark takes locations in the order of the table columns, latitude first
+                file.write(f"{lat} {lon} {os.path.abspath(frame)}\n")
+        command.append(frames_path)
+
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"{binary} failed:\n{result.stderr}")
+    samples = json.loads(result.stdout.strip().splitlines()[-1])
+    return {f"{stage}@{rows}": stage_samples for stage, stage_samples in samples.items() if stage_samples}
+
+def environment() -> dict:
+    """
+    Where the report was made, reports of different machines are not comparable
+    """
+    from py_src.image_processing import MODEL_BACKEND
+    commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True)
+    return {'created': datetime.datetime.now().isoformat(timespec='seconds'), 'platform': platform.platform(),
+            'machine': platform.machine(), 'cpu_count': os.cpu_count(), 'python': platform.python_version(),
+            'model_backend': MODEL_BACKEND, 'git_commit': commit.stdout.strip() if commit.returncode == 0 else None}
+
+def compare(results : dict, baseline : dict, tolerance : float, min_difference : float) -> list[str]:
+    """
+    Prints medians against the baseline and returns stages which became slower than tolerance allows.
+    Stages of microseconds jitter by more than tolerance, so a slowdown also has to exceed min_difference ms
+    """
+    regressions = []
+    print(f"\n{'stage':<48}{'baseline, ms':>14}{'now, ms':>12}{'ratio':>8}")
+    for stage, timing in results.items():
+        if stage not in baseline:
+            continue
+        ratio = timing['median_ms'] / baseline[stage]['median_ms'] if baseline[stage]['median_ms'] else 1.0
+        print(f"{stage:<48}{baseline[stage]['median_ms']:>14.3f}{timing['median_ms']:>12.3f}{ratio:>8.2f}")
+        if ratio > 1 + tolerance and timing['median_ms'] - baseline[stage]['median_ms'] > min_difference:
+            regressions.append(stage)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the localisation hot path on synthetic data')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000], help='sizes of synthetic databases')
+    parser.add_argument('--density', type=float, default=1500, help='database rows per square km')
+    parser.add_argument('--buildings', type=int, default=3000, help='buildings of the synthetic OSM extract')
+    parser.add_argument('--queries', type=int, default=1000, help='database queries of every size')
+    parser.add_argument('--frames', default=None, help='directory with recorded frames, frames are cut from the synthetic map otherwise')
+    parser.add_argument('--frame-count', type=int, default=20, help='synthetic frames')
+    parser.add_argument('--embedding-batches', type=int, default=10)
+    parser.add_argument('--repeats', type=int, default=3, help='runs of visualize_map')
+    parser.add_argument('--skip', nargs='+', default=[], choices=STAGES)
+    parser.add_argument('--binary', default='./geomap_benchmark', help='built geomap_benchmark executable')
+    parser.add_argument('--work-dir', default='bench_data', help='synthetic data, databases are kept between runs')
+    parser.add_argument('--output', default='bench_report.json')
+    parser.add_argument('--baseline', default=None, help='report to compare with, the run fails if a stage became slower')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed growth of a median against the baseline')
+    parser.add_argument('--min-difference', type=float, default=0.05, help='growth of a median in ms which is never a regression')
+    args = parser.parse_args()
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    osm_path = os.path.join(args.work_dir, f"region_{args.buildings}.osm.pbf")
+    if not os.path.exists(osm_path):
+        synthetic_region_osm(osm_path, args.buildings)
+
+    samples, image, masks = {}, None, None
+    if 'map' not in args.skip or 'embeddings' not in args.skip or not args.frames:
+        map_samples, image, masks = benchmark_map(osm_path, args.work_dir, args.repeats if 'map' not in args.skip else 1)
+        if 'map' not in args.skip:
+            samples.update(map_samples)
+    if args.frames:
+        frames = sorted(glob.glob(os.path.join(args.frames, '*.png')) + glob.glob(os.path.join(args.frames, '*.jpg')))
+    else:
+        frames = cut_frames(image, os.path.join(args.work_dir, 'frames'), args.frame_count)
+    if 'embeddings' not in args.skip:
+        samples.update(benchmark_embeddings(masks, args.embedding_batches))
+    if 'segmentation' not in args.skip:
+        samples.update(benchmark_segmentation(frames))
+    if 'db' not in args.skip:
+        for rows in args.rows:
+            samples.update(benchmark_db(args.binary, args.work_dir, rows, args.density, args.queries,
+                                        frames if 'segmentation' not in args.skip else []))
+
+    results = {stage: summary(stage_samples) for stage, stage_samples in samples.items()}
+    report = {'environment': environment(), 'params': vars(args), 'results': results}
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+
+    print(f"{'stage':<48}{'median, ms':>12}{'p95, ms':>12}{'count':>8}")
+    for stage, timing in results.items():
+        print(f"{stage:<48}{timing['median_ms']:>12.3f}{timing['p95_ms']:>12.3f}{timing['count']:>8}")
+    print(f"Report was written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file)['results'], args.tolerance, args.min_difference)
+        if regressions:
+            sys.exit(f"Slower than the baseline by more than {args.tolerance:.0%}: {', '.join(regressions)}")
@@ -2,16 +2,23 @@
 This module provides you with all needed functionality to visualize OSM maps
 """
 
-import time
 import os
 import cv2
 import numpy as np
-import osmapi
 import osmium
 
+from multiprocessing import Pool
+
 from geopy.distance import geodesic
 from tqdm import tqdm
 
+from py_src import metrics
+from py_src.osm_download import OsmDownloader
+from py_src.osm_ingest import load_pbf
+from py_src.projection import LocalProjection, nodes_to_array
+from py_src.image_processing import preprocess_crop, CROP_SIZE
+from py_src.mask_archive import MaskArchiveWriter, MASK_ARCHIVE_PATH, mask_digest
+
 COLORSCHEME = {
         'yes' : (0, 0, 255),
         'retail' : (0, 0, 255),
@@ -50,9 +57,13 @@ VISUALIZE_OBJECTS = [
     'barrier'
 ]
 
-LIMIT_WIDTH = LIMIT_HEIGHT = 1000   # Does not allow api.Map() to overfit the request
+LIMIT_WIDTH = LIMIT_HEIGHT = 1000   # Does not allow api.map() to overfit the request
+
+LIMIT_NODE_AMOUNT = 700             # Does not allow api.ways_get() and api.nodes_get() to overfit the request
+
+WAY_THICKNESS = 6                   # Ways are drawn as polylines of this width in pixels
 
-LIMIT_NODE_AMOUNT = 700             # Does not allow api.WaysGet() and api.NodesGet() to overfit the request
+SHARDS_PER_PROCESS = 4              # Areas are split into more shards than processes, so processes finish together
 
 def get_description(tags : dict) -> str:
     """
@@ -63,41 +74,134 @@ def get_description(tags : dict) -> str:
             return key, value
     return None
 
-api = osmapi.OsmApi()
+def rasterize_area(contours : list[np.ndarray], outer_rings_amount : int, color : tuple[int, int, int],
+                   image_shape : tuple[int, ...]):
+    """
+    Rasterizes area only inside its own bounding box, clipped to an image of image_shape.
+    The first outer_rings_amount contours are outer rings, the rest are inner ones.
+    Returns the patch, its top left corner (left, above) on the image and the area's pixel bounding box
+    (min_x, min_y, max_x, max_y) relative to the patch, or (None, None, None) if the area lies outside the image
+    """
+    all_contours = np.concatenate(contours)
+    (min_x, min_y), (max_x, max_y) = all_contours.min(axis=(0, 1)), all_contours.max(axis=(0, 1))
+    left, above = max(int(min_x), 0), max(int(min_y), 0)
+    right, under = min(int(max_x) + 1, image_shape[1]), min(int(max_y) + 1, image_shape[0])
+    if left >= right or above >= under:
+        return None, None, None
+
+    area_mask = np.zeros((under - above, right - left, 3), np.uint8)
+    offset = (-left, -above)
+    for outer_contour in contours[:outer_rings_amount]:
+        cv2.drawContours(area_mask, [outer_contour], -1, color, -1, offset=offset)
+    inner_color = (0, 0, 0) if outer_rings_amount else color
+    for inner_contour in contours[outer_rings_amount:]:
+        cv2.drawContours(area_mask, [inner_contour], -1, inner_color, -1, offset=offset)
+    return area_mask, (left, above), (min_x - left, min_y - above, max_x - left, max_y - above)
+
+def draw_area(image, contours : list[np.ndarray], outer_rings_amount : int, color : tuple[int, int, int]):
+    """
+    Rasterizes area only inside its own bounding box and adds the patch to the image in place.
+    Returns the patch, its top left corner on the image and the area's pixel bounding box relative to it,
+    or (None, None, None) if the area lies outside the image
+    """
+    area_mask, corner, mask_bounds = rasterize_area(contours, outer_rings_amount, color, image.shape)
+    if area_mask is None:
+        return None, None, None
+    left, above = corner
+    image_patch = image[above:above + area_mask.shape[0], left:left + area_mask.shape[1]]
+    cv2.add(image_patch, area_mask, dst=image_patch)
+    return area_mask, corner, mask_bounds
+
+def area_geometry(area : dict, projection : LocalProjection):
+    """
+    Returns main tag, pixel contours, amount of outer rings and [lat, lon] cords of all rings of the area,
+    or None if the area is not visualized
+    """
+    main_tag = get_description(area['tags'])
+    if not main_tag:
+        return None
+    rings_cords = [ring for ring in area['outer_rings'] if ring.size]
+    outer_rings_amount = len(rings_cords)
+    rings_cords += [ring for ring in area['inner_rings'] if ring.size]
+    if not rings_cords:
+        return None
+    contours = [projection.to_contour(ring_cords) for ring_cords in rings_cords]
+    return main_tag, contours, outer_rings_amount, np.concatenate(rings_cords)
+
+def object_mask(area_mask, mask_bounds : tuple, rings_cords : np.ndarray):
+    """
+    Cuts object's mask out of its area patch, returns the mask and the object location
+    in the form masks are named with
+    """
+    min_lat, min_lon = rings_cords.min(axis=0)
+    max_lat, max_lon = rings_cords.max(axis=0)
+    min_x, min_y, max_x, max_y = mask_bounds
+    object_location = ((max_lat + min_lat)/2, (max_lon + min_lon)/2)
+    return area_mask[max(min_y, 0):max_y, max(min_x, 0):max_x], object_location
+
+def init_render_worker() -> None:
+    """
+    Every render process preprocesses masks in a single thread, cores are shared between processes
+    """
+    import torch
+    torch.set_num_threads(1)
 
-def handle_osm_api_error(func):
+def render_area_masks(areas : list[dict], projection : LocalProjection, image_shape : tuple[int, ...], object_tag : str):
     """
-    A decorator to overcome OSM's bandwidth limit exceeded error
+    Renders masks of areas tagged with object_tag and preprocesses them for the embedding net.
+    Returns mask names, content hashes of the masks and (N, 3, CROP_SIZE, CROP_SIZE) batch of them,
+    the same batch the masks would give after a round trip through PNG files
     """
-    def wrapper(*args, **kwargs):
-        try:
-            return_value = func(*args, **kwargs)
-        except osmapi.ApiError as error:
-            print(error.reason)
-            time_to_sleep = int(error.payload.split()[-2]) + 1
-            time.sleep(time_to_sleep)
-            return_value = func(*args, **kwargs)
-            print(f"APIError got handled, slept for {time_to_sleep} seconds")
-        except AssertionError:
-            return_value = []
-        return return_value
-    return wrapper
-
-@handle_osm_api_error
+    names, digests, pixels = [], [], []
+    for area in areas:
+        geometry = area_geometry(area, projection)
+        if not geometry or geometry[0][0] != object_tag:
+            continue
+        main_tag, contours, outer_rings_amount, rings_cords = geometry
+        area_mask, _, mask_bounds = rasterize_area(contours, outer_rings_amount, COLORSCHEME[main_tag[1]], image_shape)
+        if area_mask is None:
+            continue
+        mask, object_location = object_mask(area_mask, mask_bounds, rings_cords)
+        if not mask.size:
+            continue
+        names.append(f"{object_location[0]};{object_location[1]}.png")
+        digests.append(mask_digest(mask))
+        pixels.append(preprocess_crop(mask).numpy())
+    return names, digests, np.array(pixels, np.float32).reshape((-1, 3, CROP_SIZE, CROP_SIZE))
+
+def render_shard(shard : tuple):
+    """
+    render_area_masks() for Pool.imap_unordered, which passes one argument
+    """
+    with metrics.timer('render_shard'):
+        result = render_area_masks(*shard)
+    metrics.count('masks_rendered', len(result[0]))
+    return result
+
+def draw_way(image, contour : np.ndarray, color : tuple[int, int, int]) -> None:
+    """
+    Draws way in place
+    """
+    if contour.size:
+        cv2.polylines(image, [contour], False, color, WAY_THICKNESS)
+
+downloader = OsmDownloader()
+
 def download_sector(sector : list[float]) -> list[dict]:
     """
     Downloads map sectors from OSM
     """
-    assert len(sector) == 4
-    sectors_nodes = api.Map(*sector)
-    return sectors_nodes
+    if len(sector) != 4:
+        return []
+    return downloader.map_sector(sector)
 
-@handle_osm_api_error
 def download_ways(relation_id : int) -> dict:
     """
     Downloads ways from OSM
     """
-    relation = api.RelationGet(relation_id)
+    relation = downloader.relation(relation_id)
+    if relation is None:
+        return {}
     ways_ids = []
     relation_members = relation['member']
     for member in relation_members:
@@ -105,18 +209,15 @@ def download_ways(relation_id : int) -> dict:
             ways_ids.append(member['ref'])
     if len(ways_ids) > LIMIT_NODE_AMOUNT:
         return {}
-    ways = api.WaysGet(ways_ids)
-    return ways
+    return downloader.ways(ways_ids)
 
-@handle_osm_api_error
 def download_nodes(nodes_ids : list[int]) -> dict:
     """
     Downloads nodes from OSM
     """
     if len(nodes_ids) > LIMIT_NODE_AMOUNT:
         return {}
-    nodes = api.NodesGet(nodes_ids)
-    return nodes
+    return downloader.nodes(nodes_ids)
 
 class GeomapFromAPI:
     """
@@ -163,10 +264,8 @@ class GeomapFromAPI:
         """
         sectors = self.__area_sectorization()
         all_nodes = []
-        for i, sector in enumerate(sectors, start=1):
-            all_nodes += download_sector(sector)
-            if i % 10 == 0:
-                print(f'{i}/{len(sectors)} sectors were downloaded')
+        for sector_nodes in downloader.map(download_sector, sectors, report_every=10):
+            all_nodes += sector_nodes
 
         self.__nodes = {
             node['data']['id'] : node['data'] for node in all_nodes
@@ -190,15 +289,21 @@ class GeomapFromAPI:
         """
         Drawing OSM relations
         """
-        for i, relation_id, relation in enumerate(self.__relations.items(), start=1):
+        relations = [(relation_id, relation) for relation_id, relation in self.__relations.items()
+                     if get_description(relation['tag'])]
+        relations_ways = downloader.map(download_ways, [relation_id for relation_id, _ in relations], report_every=100)
+        ways = [way_data for ways_in_relation in relations_ways for way_data in ways_in_relation.values()]
+        ways_nodes = downloader.map(download_nodes, [way_data['nd'] for way_data in ways], report_every=100)
+        ways_nodes = iter(ways_nodes)
+
+        for (_, relation), ways_in_relation in zip(relations, relations_ways):
             main_tag = get_description(relation['tag'])
-            if not main_tag:
-                continue
-            ways_in_relation = download_ways(relation_id)
             for _, way_data in ways_in_relation.items():
                 node_cords = []
-                way_nodes = download_nodes(way_data['nd'])
+                way_nodes = next(ways_nodes)
                 for node_id in way_data['nd']:
+                    if node_id not in way_nodes:
+                        continue
                     node = way_nodes[node_id]
                     if not (self.min_lat < node['lat'] < self.max_lat and
                             self.min_lon < node['lon'] < self.max_lon):
@@ -212,9 +317,7 @@ class GeomapFromAPI:
                     node_cords.append([node_cord_x, node_cord_y])
                 node_cords = np.array(node_cords, np.int32)
                 node_cords = node_cords.reshape((-1, 1, 2))
-                cv2.polylines(image, [node_cords], True, COLORSCHEME[main_tag])
-            if i % 100 == 0:
-                print(f"{i}/{len(self.__relations)} relations were preprocessed")
+                cv2.polylines(image, [node_cords], True, COLORSCHEME[main_tag[1]])
         return image
 
     def __ways_visualization(self, image):
@@ -279,6 +382,7 @@ class GeomapFromFile(osmium.SimpleHandler):
         self.max_lon = max_lon
         self.max_lat = max_lat
         self.image = None
+        self.__projection = LocalProjection.for_bbox(min_lon, min_lat, max_lon, max_lat)
         self.__areas = []
         self.__ways = []
 
@@ -304,10 +408,10 @@ class GeomapFromFile(osmium.SimpleHandler):
             }
             for outer_ring in area.outer_rings():
                 nodes = [node for node in outer_ring if self.__node_is_acceptable(node)]
-                area_dict['outer_rings'].append(nodes)
+                area_dict['outer_rings'].append(nodes_to_array(nodes))
                 for inner_ring in area.inner_rings(outer_ring):
                     nodes = [node for node in inner_ring if self.__node_is_acceptable(node)]
-                    area_dict['inner_rings'].append(nodes)
+                    area_dict['inner_rings'].append(nodes_to_array(nodes))
             self.__areas.append(area_dict)
 
     def way(self, way):
@@ -318,88 +422,51 @@ class GeomapFromFile(osmium.SimpleHandler):
             way_dict = {
                 'way_id' : way.id,
                 'tags' : {tag.k : tag.v for tag in way.tags},
-                'nodes' : [node for node in way.nodes if self.__node_is_acceptable(node)]
+                'nodes' : nodes_to_array(node for node in way.nodes if self.__node_is_acceptable(node))
             }
             self.__ways.append(way_dict)
 
-    def __extract_object_mask(self, area_mask, area_coordinates : list[float], object_tag : list[str, str]):
+    def load_file(self, geomap_file : str, processes : int = None) -> None:
         """
-        Saves object's mask as a file in format "images/<object_tag>/<object_location>.png
+        Reads areas and ways from given file.
+        .osm.pbf files are parsed in a process pool with bounding box pre-filtering,
+        other formats go through osmium
         """
-        crop_above = int(geodesic(
-                        (self.max_lat, self.min_lon), (area_coordinates[2], self.min_lon)
-                        ).kilometers * 1000)
-        crop_under = int(geodesic(
-                        (self.max_lat, self.min_lon), (area_coordinates[0], self.min_lon)
-                        ).kilometers * 1000)
-        crop_left = int(geodesic(
-                        (self.max_lat, self.min_lon), (self.max_lat, area_coordinates[1])
-                        ).kilometers * 1000)
-        crop_right = int(geodesic(
-                        (self.max_lat, self.min_lon), (self.max_lat, area_coordinates[3])
-                        ).kilometers * 1000)
-
-        object_location = ((area_coordinates[2] + area_coordinates[0])/2, (area_coordinates[3] + area_coordinates[1])/2)
-
-        object_mask = area_mask[crop_above:crop_under, crop_left:crop_right]
-        if not os.path.exists(f"images/{object_tag[0]}"):
-            os.makedirs(f"images/{object_tag[0]}")
-        if object_mask.size:
-            cv2.imwrite(f"images/{object_tag[0]}/{object_location[0]};{object_location[1]}.png", object_mask)
+        with metrics.timer('osm_parse'):
+            if geomap_file.endswith('.pbf'):
+                areas, ways = load_pbf(geomap_file, self.min_lon, self.min_lat, self.max_lon, self.max_lat, processes)
+                self.__areas += areas
+                self.__ways += ways
+            else:
+                self.apply_file(geomap_file)
+        metrics.count('osm_areas', len(self.__areas))
+        metrics.count('osm_ways', len(self.__ways))
+
+    def __extract_object_mask(self, masks : MaskArchiveWriter, area_mask, corner : tuple[int, int], mask_bounds : tuple,
+                              rings_cords : np.ndarray, object_tag : list[str, str]):
+        """
+        Appends object's mask to the mask archive with its location and its place on the map
+        """
+        mask, object_location = object_mask(area_mask, mask_bounds, rings_cords)
+        if mask.size:
+            masks.add(object_tag[0], object_location, (corner[0] + max(mask_bounds[0], 0), corner[1] + max(mask_bounds[1], 0)), mask)
 
-    def __visualize_area(self, image, extract_mask : bool = True ):
+    def __visualize_area(self, image, masks : MaskArchiveWriter = None):
         """
-        Draws areas
+        Draws areas and appends their masks to masks, if it is given.
+        Each area is rasterized into a patch of its own bounding box,
+        which is added to the map in place, so memory does not depend on the map size
         """
         for area in tqdm(self.__areas):
-            main_tag = get_description(area['tags'])
-            if not main_tag:
+            geometry = area_geometry(area, self.__projection)
+            if not geometry:
                 continue
-            area_mask = np.zeros(image.shape, np.uint8)
-            max_lat, min_lat = -90, 90
-            max_lon, min_lon = -180, 180
-            has_outer_rings = has_inner_rings = False
-            for outer_ring in area['outer_rings']:
-                outer_node_cords = []
-                for node in outer_ring:
-                    max_lat, min_lat = max(node.location.lat, max_lat), min(node.location.lat, min_lat)
-                    max_lon, min_lon = max(node.location.lon, max_lon), min(node.location.lon, min_lon)
-                    node_cord_y = int(geodesic(
-                        (self.max_lat, self.min_lon), (node.location.lat, self.min_lon)
-                        ).kilometers * 1000)
-                    node_cord_x = int(geodesic(
-                        (self.max_lat, self.min_lon), (self.max_lat, node.location.lon)
-                        ).kilometers * 1000)
-                    outer_node_cords.append([node_cord_x, node_cord_y])
-                if outer_node_cords:
-                    has_outer_rings = True
-                    outer_node_cords = np.array(outer_node_cords, np.int32)
-                    outer_node_cords = outer_node_cords.reshape((-1, 1, 2))
-                    cv2.drawContours(area_mask, [outer_node_cords], -1, COLORSCHEME[main_tag[1]], -1)
-
-            for inner_ring in area['inner_rings']:
-                inner_node_cords = []
-                for node in inner_ring:
-                    max_lat, min_lat = max(node.location.lat, max_lat), min(node.location.lat, min_lat)
-                    max_lon, min_lon = max(node.location.lon, max_lon), min(node.location.lon, min_lon)
-                    node_cord_y = int(geodesic(
-                        (self.max_lat, self.min_lon), (node.location.lat, self.min_lon)
-                        ).kilometers * 1000)
-                    node_cord_x = int(geodesic(
-                        (self.max_lat, self.min_lon), (self.max_lat, node.location.lon)
-                        ).kilometers * 1000)
-                    inner_node_cords.append([node_cord_x, node_cord_y])
-                if inner_node_cords:
-                    has_inner_rings = True
-                    inner_node_cords = np.array(inner_node_cords, np.int32)
-                    inner_node_cords = inner_node_cords.reshape((-1, 1, 2))
-                    if has_outer_rings:
-                        cv2.drawContours(area_mask, [inner_node_cords], -1, (0, 0, 0), -1)
-                    else:
-                        cv2.drawContours(area_mask, [inner_node_cords], -1, COLORSCHEME[main_tag[1]], -1)
-            if extract_mask and (has_outer_rings or has_inner_rings):
-                self.__extract_object_mask(area_mask, [min_lat, min_lon, max_lat, max_lon], main_tag)
-            image = cv2.addWeighted(image, 1, area_mask, 1, 0)
+            main_tag, contours, outer_rings_amount, rings_cords = geometry
+
+            area_mask, corner, mask_bounds = draw_area(image, contours, outer_rings_amount, COLORSCHEME[main_tag[1]])
+            if masks is not None and area_mask is not None:
+                with metrics.timer('mask_extraction'):
+                    self.__extract_object_mask(masks, area_mask, corner, mask_bounds, rings_cords, main_tag)
 
         return image
 
@@ -411,25 +478,14 @@ class GeomapFromFile(osmium.SimpleHandler):
             main_tag = get_description(way['tags'])
             if not main_tag:
                 continue
-            node_cords = []
-            for node in way['nodes']:
-                node_cord_y = int(geodesic(
-                    (self.max_lat, self.min_lon), (node.location.lat, self.min_lon)
-                    ).kilometers * 1000)
-                node_cord_x = int(geodesic(
-                    (self.max_lat, self.min_lon), (self.max_lat, node.location.lon)
-                    ).kilometers * 1000)
-                node_cords.append([node_cord_x, node_cord_y])
-            if node_cords:
-                node_cords = np.array(node_cords, np.int32)
-                node_cords = node_cords.reshape((-1, 1, 2))
-                cv2.polylines(image, [node_cords], False, COLORSCHEME[main_tag[1]], 6)
+            node_cords = self.__projection.to_contour(way['nodes'])
+            draw_way(image, node_cords, COLORSCHEME[main_tag[1]])
 
         return image
 
-    def visualize_map(self):
+    def image_shape(self) -> tuple[int, int, int]:
         """
-        Visualizing the map
+        Shape of the map image, one pixel is one meter
         """
         height = int(geodesic(
             (self.min_lat, self.min_lon), (self.min_lat, self.max_lon)
@@ -437,15 +493,34 @@ class GeomapFromFile(osmium.SimpleHandler):
         width = int(geodesic(
             (self.min_lat, self.min_lon), (self.max_lat, self.min_lon)
             ).kilometers * 1000)
+        return (width, height, 3)
 
-        image = np.zeros((width, height, 3), np.uint8)
+    def visualize_map(self, masks_path : str = MASK_ARCHIVE_PATH):
+        """
+        Visualizing the map, masks of the objects are written to a new archive in masks_path
+        """
+        with metrics.timer('render'), MaskArchiveWriter(masks_path) as masks:
+            image = np.zeros(self.image_shape(), np.uint8)
 
-        image = self.__visualize_area(image)
-        image = self.__visualize_ways(image)
+            image = self.__visualize_area(image, masks)
+            image = self.__visualize_ways(image)
 
         self.image = image
         return image
 
+    def render_object_masks(self, object_tag : str = 'building', processes : int = None):
+        """
+        Renders masks of objects with object_tag in a process pool without drawing the map or writing files.
+        Areas are sharded between processes, shards are yielded as soon as they are ready
+        in form of render_area_masks() results
+        """
+        processes = processes or os.cpu_count()
+        shards_amount = max(1, min(len(self.__areas), processes * SHARDS_PER_PROCESS))
+        shards = [self.__areas[i::shards_amount] for i in range(shards_amount)]
+        image_shape = self.image_shape()
+        with Pool(processes, initializer=init_render_worker) as pool:
+            yield from pool.imap_unordered(render_shard, [(shard, self.__projection, image_shape, object_tag) for shard in shards])
+
     def save_image_as(self, file_name : str = 'images/map.png'):
         """
         Saves map as an image
@@ -456,7 +531,7 @@ class GeomapFromFile(osmium.SimpleHandler):
 
 def build_geomap(min_lon : float, min_lat : float, max_lon : float, max_lat : float, geomap_file = "data/northwestern-fed-district-latest.osm.pbf") -> None:
     geomap = GeomapFromFile(min_lon, min_lat, max_lon, max_lat)
-    geomap.apply_file(geomap_file)
+    geomap.load_file(geomap_file)
     geomap.visualize_map()
     geomap.save_image_as()
 
@@ -0,0 +1,112 @@
+"""
+This module splits geomap.db into geographic shards for LocationSeeker, which keeps open only the shards around the UAV
+(include/sharded_geomap_db.hpp). Shards are square cells of shard_size degrees of the location columns,
+every shard is a database of the geomap.db layout in <db>.shards with a manifest of all of them.
+A shard whose rows did not change keeps its file, so caches GeomapDB has built for it stay valid.
+"""
+
+import os
+import glob
+import math
+import shutil
+import struct
+import hashlib
+import sqlite3
+
+from py_src.geomap_sync import TABLE_NAME, create_table
+
+SHARDS_SUFFIX = '.shards'
+MANIFEST_NAME = 'manifest.txt'
+DEFAULT_SHARD_SIZE = 0.02          # About 2 km along the meridian, ten times the cell of LocationGrid
+
+def shards_path(db_path : str) -> str:
+    return db_path + SHARDS_SUFFIX
+
+def shard_cell(lon : float, lat : float, shard_size : float) -> tuple[int, int]:
+    """
+    Cell of a row, computed the way ShardedGeomapDB::cell_of does it
+    """
+    return math.floor(lon / shard_size), math.floor(lat / shard_size)
+
+def shard_name(cell : tuple[int, int]) -> str:
+    return f"shard_{cell[0]}_{cell[1]}.db"
+
+def read_manifest(path : str) -> tuple[float, dict]:
+    """
+    Shard size and shards of the manifest in path: cell -> (rows, digest), (None, {}) if there is no manifest
+    """
+    manifest_path = os.path.join(path, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return None, {}
+    with open(manifest_path) as file:
+        key, shard_size = file.readline().split()
+        shards = {}
+        for line in file:
+            lon_cell, lat_cell, rows, digest = line.split()
+            shards[(int(lon_cell), int(lat_cell))] = (int(rows), digest)
+    return float(shard_size), shards
+
+def write_shard(path : str, rows : list[tuple]) -> None:
+    """
+    Writes rows (lon, lat, embedding) as a new database, replacing the old one and its caches at once
+    """
+    # Not named like the caches of the shard, they are removed with it
+    temporary_path = os.path.splitext(path)[0] + '.tmp'
+    if os.path.exists(temporary_path):
+        os.remove(temporary_path)
+    connection = sqlite3.connect(temporary_path)
+    try:
+        create_table(connection)
+        connection.executemany(f"INSERT INTO {TABLE_NAME}(lon, lat, embedding) VALUES(?, ?, ?)", rows)
+        connection.commit()
+    finally:
+        connection.close()
+    remove_shard(path)
+    os.replace(temporary_path, path)
+
+def remove_shard(path : str) -> None:
+    """
+    Removes a shard with matrix, grid and index cached next to it
+    """
+    for shard_file in [path] + glob.glob(glob.escape(path) + '.*'):
+        if os.path.exists(shard_file):
+            os.remove(shard_file)
+
+def shard_geomap(db_path : str = 'geomap.db', shard_size : float = None) -> dict:
+    """
+    Splits the table of db_path into shards and returns amounts of written, kept and removed shards.
+    Without shard_size the size of the existing shards is used, or DEFAULT_SHARD_SIZE
+    """
+    path = shards_path(db_path)
+    old_size, old_shards = read_manifest(path)
+    shard_size = shard_size or old_size or DEFAULT_SHARD_SIZE
+    if old_size is not None and old_size != shard_size:
+        shutil.rmtree(path)
+        old_shards = {}
+    os.makedirs(path, exist_ok=True)
+
+    cells = {}
+    with sqlite3.connect(f"file:{db_path}?mode=ro", uri=True) as connection:
+        for lon, lat, embedding in connection.execute(f"SELECT lon, lat, embedding FROM {TABLE_NAME} ORDER BY rowid"):
+            cells.setdefault(shard_cell(lon, lat, shard_size), []).append((lon, lat, embedding))
+
+    shards, written = {}, 0
+    for cell, rows in cells.items():
+        digest = hashlib.blake2b(digest_size=16)
+        for lon, lat, embedding in rows:
+            digest.update(struct.pack('<dd', lon, lat) + embedding)
+        shards[cell] = (len(rows), digest.hexdigest())
+        if old_shards.get(cell) != shards[cell] or not os.path.exists(os.path.join(path, shard_name(cell))):
+            write_shard(os.path.join(path, shard_name(cell)), rows)
+            written += 1
+    removed = [cell for cell in old_shards if cell not in shards]
+    for cell in removed:
+        remove_shard(os.path.join(path, shard_name(cell)))
+
+    # The manifest is replaced at once, a reader sees either the old shards or the new ones
+    with open(os.path.join(path, MANIFEST_NAME + '.tmp'), 'w') as file:
+        file.write(f"shard_size {shard_size!r}\n")
+        for (lon_cell, lat_cell), (rows, digest) in sorted(shards.items()):
+            file.write(f"{lon_cell} {lat_cell} {rows} {digest}\n")
+    os.replace(os.path.join(path, MANIFEST_NAME + '.tmp'), os.path.join(path, MANIFEST_NAME))
+    return {'shards': len(shards), 'written': written, 'kept': len(shards) - written, 'removed': len(removed)}
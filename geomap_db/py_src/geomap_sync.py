@@ -0,0 +1,271 @@
+"""
+This module keeps geomap.db in sync with the building masks made by build_geomap, packed into a mask archive
+or, as older builds made them, PNG files.
+Every mask is recorded with its content hash and the version of the models that embedded it,
+so a run only embeds new and changed masks and deletes rows of removed ones.
+"""
+
+import os
+import glob
+import hashlib
+import sqlite3
+import cv2
+import numpy as np
+import tqdm
+
+from py_src import metrics
+from py_src.geomap import GeomapFromFile
+from py_src.mask_archive import MaskArchive, MASK_ARCHIVE_PATH
+from py_src.image_processing import get_embeddings, get_pixel_embeddings, get_models_version, EMBEDDING_BATCH_SIZE
+
+# Columns are (lon, lat, embedding), but as geomap.db was always built, the lon column holds the latitude
+# and the lat column the longitude. Rows, queries and frames of ./geomap_benchmark are latitude first
+TABLE_NAME = 'geomap_embeddings'
+SOURCES_TABLE_NAME = 'geomap_sources'
+IDENTITY_TABLE_NAME = 'geomap_identity'
+HASH_CHUNK_SIZE = 1 << 20
+
+def mask_location(mask_name : str) -> tuple[float, float]:
+    """
+    Masks are named lat;lon.png, returns (lat, lon)
+    """
+    lat, lon = os.path.splitext(mask_name)[0].split(';')
+    return float(lat), float(lon)
+
+def content_hash(path : str) -> str:
+    """
+    Hash of the file content, masks rendered again with the same content keep their rows
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def create_table(connection : sqlite3.Connection) -> None:
+    """
+    Creates the table with its identity the way GeomapDB::create_table does it: a random token of the table
+    and a count of updated and deleted rows, which tell GeomapDB whether its cached matrix, grid and index are still valid
+    """
+    changed = f" BEGIN UPDATE {IDENTITY_TABLE_NAME} SET changes = changes + 1 WHERE table_name = '{TABLE_NAME}'; END"
+    connection.execute(f"CREATE TABLE IF NOT EXISTS {TABLE_NAME}(lon DOUBLE, lat DOUBLE, embedding BLOB)")
+    connection.execute(f"CREATE TABLE IF NOT EXISTS {IDENTITY_TABLE_NAME}(table_name TEXT PRIMARY KEY, token INTEGER, changes INTEGER)")
+    connection.execute(f"INSERT OR IGNORE INTO {IDENTITY_TABLE_NAME} VALUES('{TABLE_NAME}', random(), 0)")
+    connection.execute(f"CREATE TRIGGER IF NOT EXISTS {TABLE_NAME}_updated AFTER UPDATE ON {TABLE_NAME}{changed}")
+    connection.execute(f"CREATE TRIGGER IF NOT EXISTS {TABLE_NAME}_deleted AFTER DELETE ON {TABLE_NAME}{changed}")
+
+def migrate_table(connection : sqlite3.Connection, columns : list[str]) -> None:
+    """
+    Moves rows of a table of older versions, which kept every embedding cord in its own DOUBLE column,
+    into float32 embedding blobs the way GeomapDB::migrate_table does it. Rowids are kept
+    """
+    dimension = sum(column.startswith('embedding') for column in columns)
+    cords = [f"embedding{i}" for i in range(dimension)]
+    if set(cords) - set(columns):
+        raise RuntimeError(f"Table {TABLE_NAME} has embedding columns {', '.join(sorted(set(columns) - {'lon', 'lat'}))}, "
+                           "they can not be migrated")
+    print(f"Migrating {TABLE_NAME} to float32 embeddings")
+    legacy_name = f"{TABLE_NAME}_legacy"
+    connection.execute("BEGIN")
+    try:
+        connection.execute(f"ALTER TABLE {TABLE_NAME} RENAME TO {legacy_name}")
+        connection.execute(f"CREATE TABLE {TABLE_NAME}(lon DOUBLE, lat DOUBLE, embedding BLOB)")
+        rows = connection.execute(f"SELECT rowid, lon, lat, {', '.join(cords)} FROM {legacy_name}")
+        connection.executemany(f"INSERT INTO {TABLE_NAME}(rowid, lon, lat, embedding) VALUES(?, ?, ?, ?)",
+                               ((row[0], row[1], row[2], np.array(row[3:], np.float32).tobytes()) for row in rows))
+        connection.execute(f"DROP TABLE {legacy_name}")
+        connection.execute("COMMIT")
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("VACUUM")
+
+def open_database(db_path : str) -> sqlite3.Connection:
+    """
+    Opens geomap.db with the same table layout GeomapDB uses and the table of mask sources,
+    a table of older versions is migrated first
+    """
+    connection = sqlite3.connect(db_path, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    columns = [column[1] for column in connection.execute(f"PRAGMA table_info({TABLE_NAME})")]
+    if 'embedding0' in columns:
+        migrate_table(connection, columns)
+    create_table(connection)
+    connection.execute(f"CREATE TABLE IF NOT EXISTS {SOURCES_TABLE_NAME}(mask TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+                       "content_hash TEXT, models_version TEXT, row_id INTEGER)")
+    return connection
+
+def read_sources(connection : sqlite3.Connection) -> dict:
+    """
+    Recorded masks: name -> (size, mtime_ns, content_hash, models_version, row_id)
+    """
+    return {mask: (size, mtime_ns, digest, version, row_id) for mask, size, mtime_ns, digest, version, row_id in
+            connection.execute(f"SELECT mask, size, mtime_ns, content_hash, models_version, row_id FROM {SOURCES_TABLE_NAME}")}
+
+def write_changes(connection : sqlite3.Connection, known : dict, embedded : list[tuple], embeddings : np.ndarray,
+                  removed : list[str], touched : list[tuple], models_version : str) -> dict:
+    """
+    Applies a sync in one transaction: embedded masks (mask, size, mtime_ns, content_hash) are upserted with their embeddings,
+    removed masks and rows no mask refers to are deleted, touched masks (size, mtime_ns, mask) get their new stat.
+    Returns amounts of added, updated, deleted masks and deleted stale rows
+    """
+    replaced = [known[mask][4] for mask, _, _, _ in embedded if mask in known]
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        # Rows without a recorded mask are left by builds without sources or by an interrupted run
+        stale_rows = [row_id for row_id, in connection.execute(
+            f"SELECT rowid FROM {TABLE_NAME} WHERE rowid NOT IN (SELECT row_id FROM {SOURCES_TABLE_NAME})")]
+        deleted_rows = [(known[mask][4],) for mask in removed] + [(row_id,) for row_id in replaced + stale_rows]
+        connection.executemany(f"DELETE FROM {TABLE_NAME} WHERE rowid = ?", deleted_rows)
+        connection.executemany(f"DELETE FROM {SOURCES_TABLE_NAME} WHERE mask = ?", [(mask,) for mask in removed])
+        connection.executemany(f"UPDATE {SOURCES_TABLE_NAME} SET size = ?, mtime_ns = ? WHERE mask = ?", touched)
+        for (mask, size, mtime_ns, digest), embedding in zip(embedded, embeddings):
+            lat, lon = mask_location(mask)
+            # Latitude goes to the lon column, see TABLE_NAME
+            row_id = connection.execute(f"INSERT INTO {TABLE_NAME}(lon, lat, embedding) VALUES(?, ?, ?)",
+                                        (lat, lon, embedding.astype(np.float32).tobytes())).lastrowid
+            connection.execute(f"INSERT OR REPLACE INTO {SOURCES_TABLE_NAME} VALUES(?, ?, ?, ?, ?, ?)",
+                               (mask, size, mtime_ns, digest, models_version, row_id))
+        # GeomapDB reloads its in-memory rows when the data version changes, appended rows alone do not need it
+        if deleted_rows:
+            data_version = connection.execute("PRAGMA user_version").fetchone()[0]
+            connection.execute(f"PRAGMA user_version = {data_version + 1}")
+        connection.execute("COMMIT")
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    changes = {'added': len(embedded) - len(replaced), 'updated': len(replaced), 'deleted': len(removed),
+               'stale_rows_deleted': len(stale_rows)}
+    for change, amount in changes.items():
+        metrics.count(f"masks_{change}", amount)
+    return changes
+
+def sync_geomap(masks_path : str = os.path.join('images', 'building'), db_path : str = 'geomap.db', rebuild : bool = False) -> dict:
+    """
+    Brings the table in line with masks in masks_path and returns amounts of added, updated, deleted and kept masks.
+    Masks whose size and modification time are unchanged are not read at all, the others are hashed.
+    With rebuild every mask is embedded again
+    """
+    connection = open_database(db_path)
+    try:
+        models_version = get_models_version()
+        known = read_sources(connection)
+
+        # Masks to embed, and masks whose file was touched but whose content is the same
+        to_embed, touched = [], []
+        kept = 0
+        masks = sorted(glob.glob(os.path.join(masks_path, '*.png')))
+        for path in masks:
+            mask = os.path.basename(path)
+            stat = os.stat(path)
+            record = known.get(mask)
+            if record is not None and not rebuild and record[3] == models_version:
+                if record[:2] == (stat.st_size, stat.st_mtime_ns):
+                    kept += 1
+                    continue
+                digest = content_hash(path)
+                if digest == record[2]:
+                    touched.append((stat.st_size, stat.st_mtime_ns, mask))
+                    kept += 1
+                    continue
+            else:
+                digest = content_hash(path)
+            to_embed.append((mask, stat.st_size, stat.st_mtime_ns, digest))
+
+        embeddings = []
+        for start in tqdm.tqdm(range(0, len(to_embed), EMBEDDING_BATCH_SIZE)):
+            batch = [cv2.imread(os.path.join(masks_path, mask)) for mask, _, _, _ in to_embed[start:start + EMBEDDING_BATCH_SIZE]]
+            embeddings.append(get_embeddings(batch))
+
+        present = {os.path.basename(path) for path in masks}
+        removed = [mask for mask in known if mask not in present]
+        with metrics.timer('db_write'):
+            changes = write_changes(connection, known, to_embed, np.concatenate(embeddings) if embeddings else [], removed, touched, models_version)
+    finally:
+        connection.close()
+    changes['kept'] = kept
+    return changes
+
+def sync_archived_geomap(archive_path : str = MASK_ARCHIVE_PATH, db_path : str = 'geomap.db', tag : str = 'building',
+                         rebuild : bool = False) -> dict:
+    """
+    Brings the table in line with masks of tag in a mask archive and returns amounts of added, updated, deleted and kept masks.
+    Content hashes are read from the archive index, only masks to embed are read from the mapped data.
+    Masks are hashed as raw pixels, like sync_rendered_geomap does it
+    """
+    archive = MaskArchive(archive_path)
+    connection = open_database(db_path)
+    try:
+        models_version = get_models_version()
+        known = read_sources(connection)
+        present = archive.latest(tag)
+
+        to_embed, indices = [], []
+        kept = 0
+        for mask, i in present.items():
+            digest = archive.digest(i)
+            record = known.get(mask)
+            if record is not None and not rebuild and record[2:4] == (digest, models_version):
+                kept += 1
+                continue
+            to_embed.append((mask, None, None, digest))
+            indices.append(i)
+
+        # Records are in the order of their data, so the data is read sequentially
+        embeddings = []
+        for start in tqdm.tqdm(range(0, len(indices), EMBEDDING_BATCH_SIZE)):
+            embeddings.append(get_embeddings([archive.mask(i) for i in indices[start:start + EMBEDDING_BATCH_SIZE]]))
+
+        removed = [mask for mask in known if mask not in present]
+        with metrics.timer('db_write'):
+            changes = write_changes(connection, known, to_embed, np.concatenate(embeddings) if embeddings else [], removed, [], models_version)
+    finally:
+        connection.close()
+    changes['kept'] = kept
+    return changes
+
+def sync_rendered_geomap(geomap : GeomapFromFile, db_path : str = 'geomap.db', processes : int = None, rebuild : bool = False) -> dict:
+    """
+    Brings the table in line with buildings of a loaded map without PNG files.
+    Masks are rendered by a pool of processes and come back already preprocessed,
+    they are embedded here in batches while the pool renders the rest.
+    The table is made the map's one: rows of masks the map does not have are deleted.
+    Masks are hashed as raw pixels, so a following sync of PNG files embeds them again
+    """
+    connection = open_database(db_path)
+    try:
+        models_version = get_models_version()
+        known = read_sources(connection)
+        present, to_embed, embeddings, pending = set(), [], [], []
+        kept = 0
+
+        def embed_pending():
+            import torch
+            embeddings.append(get_pixel_embeddings(torch.from_numpy(np.concatenate(pending))))
+            pending.clear()
+
+        with tqdm.tqdm() as progress:
+            for names, digests, pixels in geomap.render_object_masks('building', processes):
+                selected = []
+                for i, (mask, digest) in enumerate(zip(names, digests)):
+                    present.add(mask)
+                    record = known.get(mask)
+                    if record is not None and not rebuild and record[2:4] == (digest, models_version):
+                        kept += 1
+                        continue
+                    to_embed.append((mask, None, None, digest))
+                    selected.append(i)
+                pending.append(pixels[selected])
+                if sum(len(batch) for batch in pending) >= EMBEDDING_BATCH_SIZE:
+                    embed_pending()
+                progress.update(len(names))
+            if pending:
+                embed_pending()
+
+        removed = [mask for mask in known if mask not in present]
+        with metrics.timer('db_write'):
+            changes = write_changes(connection, known, to_embed, np.concatenate(embeddings) if embeddings else [], removed, [], models_version)
+    finally:
+        connection.close()
+    changes['kept'] = kept
+    return changes
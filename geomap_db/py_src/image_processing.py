@@ -7,26 +7,110 @@ Original file is located at
     https://colab.research.google.com/drive/1__Y2Sies4olfDGzcJWDLfz22K54-ABVc
 """
 
-from ultralytics import YOLO
 from PIL import Image
+import os
+import threading
 import cv2
-from transformers import AutoImageProcessor, ResNetModel
-from torchvision.transforms.functional import pil_to_tensor
-from torchvision.transforms import Resize
-import torch
 import numpy as np
 from typing import List
-import joblib
 
-seg_model = YOLO('nn_models/segmentation_net/dronuniver_yolov8nseg.pt')
-emb_processor = AutoImageProcessor.from_pretrained("microsoft/resnet-50")
-emb_model = ResNetModel.from_pretrained("nn_models/embedding_net")
-with open('nn_models/pca.joblib', 'rb') as file:
-    pca_model = joblib.load(file)
+from py_src import metrics
+
+# Models are built on first use and heavy libraries are imported where they are needed,
+# so importing this module for its helpers stays cheap
+
+SEGMENTATION_NET_PATH = 'nn_models/segmentation_net/dronuniver_yolov8nseg.pt'
+EMBEDDING_NET_PATH = 'nn_models/embedding_net'
+EXPORTED_MODELS_PATH = 'nn_models/exported'
+PCA_MODEL_PATH = 'nn_models/pca.joblib'
+# preprocessor_config.json of microsoft/resnet-50 is kept next to the embedding net, no hub access is needed
+EMBEDDING_PROCESSOR_PATH = EMBEDDING_NET_PATH
+
+# torch runs the original checkpoints, the others run models made by py_src/model_export.py
+MODEL_BACKEND = os.environ.get('GEOMAP_MODEL_BACKEND', 'torch')
+EXPORTED_EMBEDDING_NETS = {'onnx': 'embedding_net.onnx', 'onnx-int8': 'embedding_net.int8.onnx'}
+EXPORTED_SEGMENTATION_NET = 'segmentation_net.onnx'
+if MODEL_BACKEND != 'torch' and MODEL_BACKEND not in EXPORTED_EMBEDDING_NETS:
+    raise ValueError(f"Unknown GEOMAP_MODEL_BACKEND {MODEL_BACKEND}, expected torch or one of {list(EXPORTED_EMBEDDING_NETS)}")
+
+_models = {}
+_models_lock = threading.Lock()
+
+# Process-wide singletons, a model is loaded once even if several threads ask for it at the same time
+def _get_model(name: str, load):
+    model = _models.get(name)
+    if model is None:
+        with _models_lock:
+            if name not in _models:
+                _models[name] = load()
+            model = _models[name]
+    return model
+
+def _load_segmentation_model():
+    from ultralytics import YOLO
+    if MODEL_BACKEND == 'torch':
+        return YOLO(SEGMENTATION_NET_PATH)
+    return YOLO(os.path.join(EXPORTED_MODELS_PATH, EXPORTED_SEGMENTATION_NET), task='segment')
+
+def _load_embedding_model():
+    if MODEL_BACKEND == 'torch':
+        from transformers import ResNetModel
+        return ResNetModel.from_pretrained(EMBEDDING_NET_PATH)
+    import onnxruntime
+    return onnxruntime.InferenceSession(os.path.join(EXPORTED_MODELS_PATH, EXPORTED_EMBEDDING_NETS[MODEL_BACKEND]),
+                                        providers=['CPUExecutionProvider'])
+
+def _load_embedding_processor():
+    from transformers import AutoImageProcessor
+    return AutoImageProcessor.from_pretrained(EMBEDDING_PROCESSOR_PATH, local_files_only=True)
+
+def _load_pca_model():
+    import joblib
+    with open(PCA_MODEL_PATH, 'rb') as file:
+        return joblib.load(file)
+
+def get_segmentation_model():
+    return _get_model('segmentation', _load_segmentation_model)
+
+# torch ResNetModel or onnxruntime session, depending on MODEL_BACKEND
+def get_embedding_model():
+    return _get_model('embedding', _load_embedding_model)
+
+def get_embedding_processor():
+    return _get_model('embedding_processor', _load_embedding_processor)
+
+def get_pca_model():
+    return _get_model('pca', _load_pca_model)
+
+# Embeddings of other weights, PCA or backend are not comparable, so database rows record the version they were made with
+def get_models_version() -> str:
+    import hashlib
+    digest = hashlib.blake2b(f"{MODEL_BACKEND};{CROP_SIZE}".encode(), digest_size=16)
+    paths = [os.path.join(EMBEDDING_NET_PATH, name) for name in sorted(os.listdir(EMBEDDING_NET_PATH))] + [PCA_MODEL_PATH]
+    if MODEL_BACKEND != 'torch':
+        paths.append(os.path.join(EXPORTED_MODELS_PATH, EXPORTED_EMBEDDING_NETS[MODEL_BACKEND]))
+    for path in paths:
+        if os.path.isfile(path):
+            with open(path, 'rb') as file:
+                for chunk in iter(lambda: file.read(1 << 20), b''):
+                    digest.update(chunk)
+    return digest.hexdigest()
+
+# Loads the models and runs each of them once, so the first real frame does not pay for lazy initialisation
+def warm_up(segmentation: bool = True, embedding: bool = True):
+    if segmentation:
+        get_segmentation_model()(np.zeros((WARM_UP_FRAME_SIZE, WARM_UP_FRAME_SIZE, 3), np.uint8), verbose=False)
+    if embedding:
+        get_embeddings([np.zeros((WARM_UP_FRAME_SIZE // 8, WARM_UP_FRAME_SIZE // 8, 3), np.uint8)])
+
+EMBEDDING_BATCH_SIZE = 32
+CROP_SIZE = 32
+WARM_UP_FRAME_SIZE = 640
 
 def get_pred(img_path):
     img = Image.open(img_path)
-    return seg_model(img)[0]
+    with metrics.timer('segmentation'):
+        return get_segmentation_model()(img)[0]
 
 def get_boxes(preds):
     return preds.boxes.xywh.int()
@@ -34,36 +118,225 @@ def get_boxes(preds):
 def get_masks(preds):
     return [mask.astype(int) for mask in preds.masks.xy]
 
+# Filled polygon of every detection inside its own bounds (x0, y0, x1, y1), clipped to the frame.
+# Only buffers of the box size are allocated, nothing of the frame size is drawn or copied.
+# Crops used to be placed by boxes.xywh, which holds box centres, and masks were taken from masked crops,
+# so black pixels inside a polygon were cut out of its mask. Now a mask is the polygon alone
+def get_box_masks(preds):
+    if preds.masks is None:
+        return []
+    height, width = preds.orig_shape[:2]
+    box_masks = []
+    for polygon in preds.masks.xy:
+        if not len(polygon):
+            continue
+        polygon = polygon.astype(np.int32)
+        x0, y0 = np.maximum(polygon.min(axis=0), 0)
+        x1, y1 = np.minimum(polygon.max(axis=0) + 1, (width, height))
+        if x1 <= x0 or y1 <= y0:
+            continue
+        mask = np.zeros((y1 - y0, x1 - x0), np.uint8)
+        cv2.fillPoly(mask, [polygon], 255, offset=(-int(x0), -int(y0)))
+        box_masks.append(((x0, y0, x1, y1), mask))
+    return box_masks
+
 def get_crops(img_path, preds):
-    img = cv2.imread(img_path)
-    boxes = get_boxes(preds)
-    masks = get_masks(preds)
+    return get_frame_crops(cv2.imread(img_path), preds)
+
+# Crops are views into the frame until they are masked
+def get_frame_crops(img, preds):
     crops = []
-    for i, box in enumerate(boxes):
-        x,y,w,h = box
-        crop = img[y:y+h, x:x+w].copy()
-        masks[i] = masks[i] - masks[i].min(axis=0)
-        mask = np.zeros(crop.shape[:2], np.uint8)
-        cv2.drawContours(mask, [masks[i]], -1, 255, -1)
+    for (x0, y0, x1, y1), mask in get_box_masks(preds):
+        crop = img[y0:y1, x0:x1]
         crops.append(cv2.bitwise_and(crop, crop, mask=mask))
     return crops
 
-def get_embeddings(crops):
-    embeddings = []
-    transform = Resize((32, 32))
+def preprocess_crop(crop):
+    import torch
+    from torchvision.transforms import Resize
+    img = cv2.cvtColor(crop, cv2.COLOR_BGR2RGB)
+    img = torch.from_numpy(img).permute(2, 0, 1)
+    return torch.clamp(Resize((CROP_SIZE, CROP_SIZE))(img), 0, 255) / 255
+
+# Same result as preprocess_crop of mask crops, whose only non zero channel is red: a (N, 3, CROP_SIZE, CROP_SIZE) batch
+def preprocess_masks(masks):
+    import torch
+    from torchvision.transforms import Resize
+    resize = Resize((CROP_SIZE, CROP_SIZE))
+    pixels = torch.zeros((len(masks), 3, CROP_SIZE, CROP_SIZE))
+    for i, mask in enumerate(masks):
+        pixels[i, 0] = resize(torch.from_numpy(mask)[None])[0] / 255
+    return pixels
+
+def run_embedding_net(pixel_values) -> np.ndarray:
+    import torch
+    emb_model = get_embedding_model()
+    if MODEL_BACKEND != 'torch':
+        return emb_model.run(['pooler_output'], {'pixel_values': pixel_values.numpy()})[0]
+    with torch.no_grad():
+        return emb_model(pixel_values=pixel_values).pooler_output.numpy()
+
+# Embeddings of crops already preprocessed into a (N, 3, CROP_SIZE, CROP_SIZE) batch
+def get_pixel_embeddings(pixels, batch_size: int = EMBEDDING_BATCH_SIZE, embedding_net=run_embedding_net) -> np.ndarray:
+    pca_model = get_pca_model()
+    emb_processor = get_embedding_processor()
+    if not len(pixels):
+        return np.empty((0, pca_model.n_components_), np.float32)
+    features = []
+    for start in range(0, len(pixels), batch_size):
+        batch = list(pixels[start:start + batch_size])
+        with metrics.timer('embedding_preprocess'):
+            inputs = emb_processor(batch, return_tensors="pt")
+        with metrics.timer('embedding'):
+            features.append(embedding_net(inputs['pixel_values']).reshape(len(batch), -1))
+    with metrics.timer('pca'):
+        embeddings = pca_model.transform(np.concatenate(features).astype(np.float64))
+    return np.ascontiguousarray(embeddings, dtype=np.float32)
+
+def get_embeddings(crops, batch_size: int = EMBEDDING_BATCH_SIZE, embedding_net=run_embedding_net) -> np.ndarray:
+    import torch
+    pixels = torch.stack([preprocess_crop(crop) for crop in crops]) if len(crops) else []
+    return get_pixel_embeddings(pixels, batch_size, embedding_net)
+
+def get_mask_crops(crops):
+    mask_crops = []
     for crop in crops:
-        img = cv2.cvtColor(crop, cv2.COLOR_BGR2RGB)
-        im_pil = Image.fromarray(img)
-        im_pil = torch.clamp(transform(pil_to_tensor(im_pil)), 0, 255)  / 255
-        inputs = emb_processor(im_pil, return_tensors="pt")
-        with torch.no_grad():
-            outputs = emb_model(**inputs).pooler_output
-        embeddings.append(list(pca_model.transform(np.array([float(coord[0][0].detach().numpy()) for coord in outputs[0]]).reshape(1,-1))[0]))
-    return embeddings
+        mask_crop = np.zeros_like(crop)
+        mask_crop[:, :, 2] = crop.any(axis=2) * np.uint8(255)
+        mask_crops.append(mask_crop)
+    return mask_crops
+
+# Preprocessed box masks of all detections of the frame
+def crop_detections(preds):
+    with metrics.timer('mask_extraction'):
+        masks = [mask for _, mask in get_box_masks(preds)]
+        pixels = preprocess_masks(masks)
+    metrics.count('objects_detected', len(masks))
+    return pixels
 
+# The crop engine: YOLO outputs go straight to an embedding model batch, image pixels are not needed
 def get_geomap_embeddings(img_file: str):
     pred = get_pred(img_file)
-    crops = get_crops(img_file, pred)
-    crops = [torch.clamp(torch.max(torch.Tensor(crop), dim=2).values, 0, 1) for crop in crops]
-    crops = [torch.stack((torch.zeros_like(crop), torch.zeros_like(crop), crop), dim=2).numpy().astype(np.uint8) * 255 for crop in crops]
-    return get_embeddings(crops)
+    return get_pixel_embeddings(crop_detections(pred))
+
+TRACK_BOX_IOU = 0.3       # Boxes of a building in consecutive frames overlap at least this much once the camera motion is compensated
+TRACK_MASK_IOU = 0.8      # A mask which overlaps the mask its track was embedded from less than this has drifted and is embedded again
+TRACK_MAX_MISSED = 2      # Frames a building may be lost for before its track is dropped
+TRACK_MAX_REUSE = 30      # Frames an embedding is reused for at most, so a slow drift is corrected too
+
+def box_ious(boxes: np.ndarray, other_boxes: np.ndarray) -> np.ndarray:
+    x0 = np.maximum(boxes[:, None, 0], other_boxes[None, :, 0])
+    y0 = np.maximum(boxes[:, None, 1], other_boxes[None, :, 1])
+    x1 = np.minimum(boxes[:, None, 2], other_boxes[None, :, 2])
+    y1 = np.minimum(boxes[:, None, 3], other_boxes[None, :, 3])
+    intersection = np.clip(x1 - x0, 0, None) * np.clip(y1 - y0, 0, None)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    other_areas = (other_boxes[:, 2] - other_boxes[:, 0]) * (other_boxes[:, 3] - other_boxes[:, 1])
+    return intersection / np.maximum(areas[:, None] + other_areas[None, :] - intersection, 1e-9)
+
+def box_centre(box: np.ndarray) -> np.ndarray:
+    return (box[:2] + box[2:]) / 2
+
+def mask_iou(pixels, other_pixels) -> float:
+    mask, other_mask = pixels[0] > 0.5, other_pixels[0] > 0.5
+    union = (mask | other_mask).sum()
+    return float((mask & other_mask).sum() / union) if union else 1.0
+
+# Detections of a frame linked to tracks, made by BuildingTracker.track and embedded by BuildingTracker.embed
+class TrackedFrame:
+    def __init__(self, tracks: list, embedded: np.ndarray, pixels):
+        self.tracks = tracks
+        self.embedded = embedded
+        self.pixels = pixels
+
+# Links YOLO detections of consecutive frames by box and mask overlap, so a building seen again keeps its embedding.
+# Only new and drifted detections go through the embedding net and PCA, LocationSeeker keeps the database match
+# of a track until its embedding changes. track and embed may run in different threads, frames must reach both in order
+class BuildingTracker:
+    def __init__(self):
+        self.tracks = []
+        self.next_id = 0
+        self.frame = 0
+        self.shift = np.zeros(2)    # Mean motion of the boxes between the last two frames, the camera mostly
+
+    # Greedy matching of the most overlapping pairs, boxes of the tracks are moved by the last camera motion first
+    def match(self, boxes: np.ndarray) -> dict:
+        if not len(boxes) or not self.tracks:
+            return {}
+        predicted = np.array([track['box'] for track in self.tracks], np.float64) + np.tile(self.shift, 2)
+        ious = box_ious(boxes, predicted)
+        matches = {}
+        for detection, track in zip(*np.unravel_index(np.argsort(-ious, axis=None), ious.shape)):
+            if ious[detection, track] < TRACK_BOX_IOU:
+                break
+            if detection not in matches and track not in matches.values():
+                matches[detection] = track
+        return matches
+
+    def track(self, preds) -> TrackedFrame:
+        with metrics.timer('mask_extraction'):
+            box_masks = get_box_masks(preds)
+            pixels = preprocess_masks([mask for _, mask in box_masks])
+        metrics.count('objects_detected', len(box_masks))
+        with metrics.timer('tracking'):
+            boxes = np.array([box for box, _ in box_masks], np.float64).reshape(-1, 4)
+            matches = self.match(boxes)
+            if matches:
+                shifts = [box_centre(boxes[detection]) - box_centre(self.tracks[track]['box']) for detection, track in matches.items()]
+                self.shift = np.median(shifts, axis=0)
+            tracks, embedded = [], np.zeros(len(boxes), bool)
+            for detection, box in enumerate(boxes):
+                track = self.tracks[matches[detection]] if detection in matches else None
+                if track is None or self.frame - track['embedded_frame'] >= TRACK_MAX_REUSE \
+                        or mask_iou(pixels[detection], track['pixels']) < TRACK_MASK_IOU:
+                    # A new track, or a new embedding of the same one, whose match is looked up again
+                    if track is None:
+                        track = {'id': self.next_id, 'embedding': None}
+                        self.next_id += 1
+                    track.update(pixels=pixels[detection], embedded_frame=self.frame)
+                    embedded[detection] = True
+                track.update(box=box, seen_frame=self.frame)
+                tracks.append(track)
+            seen = {id(track) for track in tracks}
+            self.tracks = tracks + [track for track in self.tracks
+                                    if id(track) not in seen and self.frame - track['seen_frame'] < TRACK_MAX_MISSED]
+            self.frame += 1
+        return TrackedFrame(tracks, embedded, pixels)
+
+    # Track ids, embeddings and whether each detection was embedded in this frame
+    def embed(self, tracked: TrackedFrame):
+        # A track whose first embedding failed is embedded with the pixels of this frame
+        embedded = tracked.embedded | np.array([track['embedding'] is None for track in tracked.tracks], bool)
+        new_embeddings = get_pixel_embeddings(tracked.pixels[np.flatnonzero(embedded)])
+        for track, embedding in zip([track for track, is_new in zip(tracked.tracks, embedded) if is_new], new_embeddings):
+            track['embedding'] = embedding
+        metrics.count('objects_reused', int(len(embedded) - embedded.sum()))
+        ids = np.array([track['id'] for track in tracked.tracks], np.int64)
+        embeddings = np.stack([track['embedding'] for track in tracked.tracks]) if tracked.tracks else new_embeddings
+        return ids, embeddings, embedded
+
+def get_tracked_embeddings(tracker: BuildingTracker, img_file: str):
+    return tracker.embed(tracker.track(get_pred(img_file)))
+
+# Source is a camera index or a video file, cameras pace themselves, so their fps is 0
+def open_video_source(source: str):
+    if source.isdigit():
+        return cv2.VideoCapture(int(source)), 0.0
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise IOError(f"Can not open video source {source}")
+    return capture, capture.get(cv2.CAP_PROP_FPS)
+
+def read_frame(capture):
+    ok, frame = capture.read()
+    return frame if ok else None
+
+def segment_frame(frame: np.ndarray):
+    with metrics.timer('segmentation'):
+        pred = get_segmentation_model()(frame)[0]
+    return crop_detections(pred)
+
+def track_frame(tracker: BuildingTracker, frame: np.ndarray) -> TrackedFrame:
+    with metrics.timer('segmentation'):
+        pred = get_segmentation_model()(frame)[0]
+    return tracker.track(pred)
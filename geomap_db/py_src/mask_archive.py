@@ -0,0 +1,168 @@
+"""
+This module packs object masks into one archive instead of a PNG file per object.
+The archive is a data file of bit-packed masks and an index next to it with a fixed size record per mask:
+tag, location, box on the map, color, offset and size of the mask data and its content hash.
+Masks are appended in chunks while the map is rendered, the archive is memory-mapped for reading,
+so neither side makes a syscall or a codec pass per mask.
+"""
+
+import os
+import hashlib
+import numpy as np
+
+MASK_ARCHIVE_PATH = os.path.join('images', 'masks.pack')
+INDEX_SUFFIX = '.idx'
+INDEX_MAGIC = b'GEOMASK1'
+CHUNK_SIZE = 1 << 20                # Bytes of mask data collected before a chunk is written
+
+RECORD_DTYPE = np.dtype([
+    ('tag', 'S16'),
+    ('lat', '<f8'),
+    ('lon', '<f8'),
+    ('x', '<i4'),                   # Top left corner of the mask on the map
+    ('y', '<i4'),
+    ('width', '<u4'),
+    ('height', '<u4'),
+    ('color', 'u1', (3,)),          # BGR color of the mask pixels
+    ('reserved', 'u1'),
+    ('size', '<u4'),
+    ('offset', '<u8'),
+    ('digest', 'u1', (16,)),
+])
+
+def index_path(path : str) -> str:
+    return path + INDEX_SUFFIX
+
+def mask_digest(mask : np.ndarray) -> str:
+    """
+    Hash of the mask pixels, the same for a mask rendered, read from a PNG file or from an archive
+    """
+    return hashlib.blake2b(np.ascontiguousarray(mask).tobytes() + str(mask.shape).encode(), digest_size=16).hexdigest()
+
+def mask_name(lat : float, lon : float) -> str:
+    """
+    Name a mask had as a PNG file, it identifies the mask in geomap.db sources
+    """
+    return f"{lat};{lon}.png"
+
+def indexed_records(path : str) -> int:
+    """
+    Amount of complete records in the index, a record cut by an interrupted write is not counted
+    """
+    if not os.path.exists(index_path(path)):
+        return 0
+    return max(0, os.path.getsize(index_path(path)) - len(INDEX_MAGIC)) // RECORD_DTYPE.itemsize
+
+class MaskArchiveWriter:
+    """
+    Appends masks to an archive. Mask data of a chunk is written before its records,
+    so the index never refers to data which is not written yet
+    """
+    def __init__(self, path : str = MASK_ARCHIVE_PATH, append : bool = False) -> None:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.records, self.chunks, self.chunk_size = [], [], 0
+        if append and os.path.exists(path) and os.path.exists(index_path(path)):
+            # Whatever an interrupted write left after the last complete record is cut off
+            records_amount = indexed_records(path)
+            end = 0
+            if records_amount:
+                index = np.fromfile(index_path(path), RECORD_DTYPE, records_amount, offset=len(INDEX_MAGIC))
+                end = int((index['offset'] + index['size']).max())
+            self.data = open(path, 'r+b')
+            self.data.truncate(end)
+            self.data.seek(end)
+            self.index = open(index_path(path), 'r+b')
+            self.index.truncate(len(INDEX_MAGIC) + records_amount * RECORD_DTYPE.itemsize)
+            self.index.seek(0, os.SEEK_END)
+        else:
+            self.data = open(path, 'wb')
+            self.index = open(index_path(path), 'wb')
+            self.index.write(INDEX_MAGIC)
+        self.offset = self.data.tell()
+
+    def add(self, tag : str, location : tuple[float, float], corner : tuple[int, int], mask : np.ndarray) -> None:
+        """
+        Queues a mask of one color (height, width, 3) with its (lat, lon) location and top left corner on the map
+        """
+        plane = mask.any(axis=2)
+        color = mask[plane][0] if plane.any() else np.zeros(3, np.uint8)
+        if not (mask[plane] == color).all():
+            raise ValueError(f"Mask at {location} has more than one color, only single color masks can be packed")
+        data = np.packbits(plane).tobytes()
+        record = np.zeros((), RECORD_DTYPE)
+        record['tag'] = tag.encode()
+        record['lat'], record['lon'] = location
+        record['x'], record['y'] = corner
+        record['height'], record['width'] = plane.shape
+        record['color'] = color
+        record['size'] = len(data)
+        record['offset'] = self.offset + self.chunk_size
+        record['digest'] = np.frombuffer(bytes.fromhex(mask_digest(mask)), np.uint8)
+        self.records.append(record)
+        self.chunks.append(data)
+        self.chunk_size += len(data)
+        if self.chunk_size >= CHUNK_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.records:
+            return
+        self.data.write(b''.join(self.chunks))
+        self.data.flush()
+        self.index.write(np.array(self.records, RECORD_DTYPE).tobytes())
+        self.index.flush()
+        self.offset += self.chunk_size
+        self.records, self.chunks, self.chunk_size = [], [], 0
+
+    def close(self) -> None:
+        self.flush()
+        self.data.close()
+        self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+class MaskArchive:
+    """
+    Memory-mapped archive, masks are unpacked only when they are asked for.
+    Records of a tag are ordered like their data, reading them in order reads the data file sequentially
+    """
+    def __init__(self, path : str = MASK_ARCHIVE_PATH) -> None:
+        with open(index_path(path), 'rb') as file:
+            if file.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                raise ValueError(f"{index_path(path)} is not an index of a mask archive")
+        records_amount = indexed_records(path)
+        self.path = path
+        # Empty files can not be mapped
+        self.records = np.memmap(index_path(path), RECORD_DTYPE, 'r', len(INDEX_MAGIC), (records_amount,)) \
+            if records_amount else np.empty(0, RECORD_DTYPE)
+        self.data = np.memmap(path, np.uint8, 'r') if os.path.getsize(path) else np.empty(0, np.uint8)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def name(self, i : int) -> str:
+        return mask_name(self.records['lat'][i], self.records['lon'][i])
+
+    def digest(self, i : int) -> str:
+        return self.records['digest'][i].tobytes().hex()
+
+    def mask(self, i : int) -> np.ndarray:
+        """
+        Mask i as (height, width, 3) BGR image, the same image its PNG file would give
+        """
+        record = self.records[i]
+        height, width, offset = int(record['height']), int(record['width']), int(record['offset'])
+        plane = np.unpackbits(self.data[offset:offset + int(record['size'])], count=height * width).reshape(height, width)
+        return plane[:, :, None] * record['color']
+
+    def latest(self, tag : str = None) -> dict:
+        """
+        Records of masks with tag by name, a mask appended again replaces the earlier record of the same name
+        """
+        indices = np.arange(len(self.records)) if tag is None else np.flatnonzero(self.records['tag'] == tag.encode())
+        return {self.name(i): int(i) for i in indices}
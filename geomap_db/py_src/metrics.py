@@ -0,0 +1,162 @@
+"""
+This module records timings and counters of pipeline stages as JSON lines.
+Set GEOMAP_METRICS to a file name, or to - for stderr, to turn it on. Without it timer() returns
+one shared context manager which does nothing and count() returns at once.
+C++ stages (include/metrics.hpp) write lines with the same fields, so a process embedding Python keeps one log.
+Summary of a log: python -m py_src.metrics metrics.log
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+
+METRICS_PATH = os.environ.get('GEOMAP_METRICS', '')
+ENABLED = bool(METRICS_PATH)
+
+_sink = None
+_sink_pid = None
+_sink_lock = threading.Lock()
+# Frame index of the calling thread, the video pipeline works on different frames in different threads
+_context = threading.local()
+
+class _NoTimer:
+    """
+    Returned by timer() when metrics are off
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class _Timer:
+    """
+    Writes duration of the block as an event of its stage
+    """
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage : str) -> None:
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        _write({'stage': self.stage, 'ms': (time.perf_counter() - self.start) * 1000})
+        return False
+
+
+_NO_TIMER = _NoTimer()
+
+def timer(stage : str):
+    """
+    Context manager timing a stage: with metrics.timer('segmentation'): ...
+    """
+    return _Timer(stage) if ENABLED else _NO_TIMER
+
+def count(name : str, value : float = 1) -> None:
+    """
+    Records a counter, like amount of detected objects
+    """
+    if ENABLED:
+        _write({'counter': name, 'value': value})
+
+def set_frame(index : int = None) -> None:
+    """
+    Following events of this thread belong to the frame, None ends it
+    """
+    _context.frame = index
+
+def _write(event : dict) -> None:
+    global _sink, _sink_pid
+    event['time'] = round(time.time(), 6)
+    event['pid'] = os.getpid()
+    frame = getattr(_context, 'frame', None)
+    if frame is not None:
+        event['frame'] = frame
+    line = json.dumps(event) + '\n'
+    with _sink_lock:
+        # Pool workers are forked with the parent's file object, each process appends through its own one
+        if _sink_pid != os.getpid():
+            _sink = sys.stderr if METRICS_PATH == '-' else open(METRICS_PATH, 'a', buffering=1)
+            _sink_pid = os.getpid()
+        _sink.write(line)
+
+def read_events(path : str) -> list[dict]:
+    """
+    Events of a log, lines of other output are skipped
+    """
+    events = []
+    with open(path) as file:
+        for line in file:
+            if line.startswith('{'):
+                try:
+                    events.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    return events
+
+def summarize(events : list[dict]) -> dict:
+    """
+    Count, median, p95, max and total in ms of every stage and sum of every counter
+    """
+    durations, counters = {}, {}
+    for event in events:
+        if 'stage' in event:
+            durations.setdefault(event['stage'], []).append(event['ms'])
+        elif 'counter' in event:
+            counters[event['counter']] = counters.get(event['counter'], 0) + event['value']
+    stages = {}
+    for stage, samples in durations.items():
+        samples.sort()
+        stages[stage] = {'count': len(samples), 'median_ms': statistics.median(samples),
+                         'p95_ms': samples[min(len(samples) - 1, int(0.95 * len(samples)))],
+                         'max_ms': samples[-1], 'total_ms': sum(samples)}
+    return {'stages': stages, 'counters': counters}
+
+def slowest_frames(events : list[dict], amount : int, total_stage : str = None) -> list[tuple[int, float, dict]]:
+    """
+    Frames with the longest total_stage, or with the longest sum of their stages without it,
+    and time every stage of the frame took
+    """
+    frames = {}
+    for event in events:
+        if 'stage' in event and 'frame' in event:
+            stages = frames.setdefault((event['pid'], event['frame']), {})
+            stages[event['stage']] = stages.get(event['stage'], 0) + event['ms']
+    totals = [(frame, stages.get(total_stage, 0) if total_stage else sum(stages.values()), stages)
+              for (_, frame), stages in frames.items()]
+    return sorted(totals, key=lambda total: total[1], reverse=True)[:amount]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize a metrics log written with GEOMAP_METRICS')
+    parser.add_argument('log')
+    parser.add_argument('--slowest', type=int, default=5, help='frames to break down by stage')
+    parser.add_argument('--frame-stage', default=None, help='stage which is the whole frame, like frame or pipeline_latency')
+    parser.add_argument('--json', action='store_true', help='print the summary as JSON')
+    args = parser.parse_args()
+
+    events = read_events(args.log)
+    summary = summarize(events)
+    frames = slowest_frames(events, args.slowest, args.frame_stage)
+    if args.json:
+        summary['slowest_frames'] = [{'frame': frame, 'ms': total, 'stages': stages} for frame, total, stages in frames]
+        print(json.dumps(summary, indent=2))
+        sys.exit()
+
+    print(f"{'stage':<28}{'count':>8}{'median, ms':>12}{'p95, ms':>12}{'max, ms':>12}{'total, ms':>12}")
+    for stage, timing in sorted(summary['stages'].items(), key=lambda item: item[1]['total_ms'], reverse=True):
+        print(f"{stage:<28}{timing['count']:>8}{timing['median_ms']:>12.3f}{timing['p95_ms']:>12.3f}"
+              f"{timing['max_ms']:>12.3f}{timing['total_ms']:>12.1f}")
+    for counter, value in summary['counters'].items():
+        print(f"{counter}: {value:g}")
+    for frame, total, stages in frames:
+        print(f"frame {frame}: {total:.1f} ms, " + ', '.join(f"{stage} {ms:.1f}" for stage, ms in
+                                                             sorted(stages.items(), key=lambda item: item[1], reverse=True)))
@@ -0,0 +1,187 @@
+"""
+This module exports embedding and segmentation networks for CPU-only inference with ONNX Runtime
+and checks that exported embeddings still match the same database rows.
+Run it from geomap_db: python -m py_src.model_export
+"""
+
+import argparse
+import glob
+import os
+import shutil
+import sqlite3
+import sys
+import time
+import cv2
+import numpy as np
+import torch
+import onnxruntime
+
+from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quant_pre_process, quantize_static
+from transformers import ResNetModel
+from ultralytics import YOLO
+
+from py_src.image_processing import (EMBEDDING_NET_PATH, SEGMENTATION_NET_PATH, EXPORTED_MODELS_PATH,
+                                     EXPORTED_EMBEDDING_NETS, EXPORTED_SEGMENTATION_NET,
+                                     get_embedding_processor, preprocess_crop, get_embeddings)
+from py_src.mask_archive import MaskArchive, MASK_ARCHIVE_PATH
+
+ONNX_OPSET = 17
+EMBEDDING_INPUT_SIZE = 224          # Side of images made by the embedding processor
+QUERY_CHUNK = 16                    # Queries compared against database rows at once
+# Calibration keeps activations of every layer for every calibration mask, about 100 MB per mask
+CALIBRATION_SAMPLES = 32
+CALIBRATION_BATCH_SIZE = 8
+
+class PoolerOutput(torch.nn.Module):
+    """
+    ResNetModel returns a ModelOutput, only its pooler_output is exported
+    """
+    def __init__(self, model : ResNetModel) -> None:
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values : torch.Tensor) -> torch.Tensor:
+        return self.model(pixel_values=pixel_values).pooler_output
+
+
+class MasksCalibrationReader(CalibrationDataReader):
+    """
+    Feeds preprocessed building masks to int8 calibration, batch by batch
+    """
+    def __init__(self, masks : list[np.ndarray], batch_size : int = CALIBRATION_BATCH_SIZE) -> None:
+        self.masks = masks
+        self.batch_size = batch_size
+        self.start = 0
+
+    def get_next(self):
+        if self.start >= len(self.masks):
+            return None
+        batch = [preprocess_crop(mask) for mask in self.masks[self.start:self.start + self.batch_size]]
+        self.start += self.batch_size
+        return {'pixel_values': get_embedding_processor()(batch, return_tensors="np")['pixel_values']}
+
+
+def export_embedding_net(masks : list[np.ndarray], output_dir : str = EXPORTED_MODELS_PATH) -> None:
+    """
+    Exports the embedding net to ONNX, float32 and int8. Activation ranges of the int8 model
+    are calibrated on building masks, the same kind of images it sees in flight
+    """
+    calibration_masks = masks[::max(1, len(masks) // CALIBRATION_SAMPLES)][:CALIBRATION_SAMPLES]
+    os.makedirs(output_dir, exist_ok=True)
+    float_path = os.path.join(output_dir, EXPORTED_EMBEDDING_NETS['onnx'])
+    int8_path = os.path.join(output_dir, EXPORTED_EMBEDDING_NETS['onnx-int8'])
+
+    model = PoolerOutput(ResNetModel.from_pretrained(EMBEDDING_NET_PATH).eval())
+    example = torch.zeros(1, 3, EMBEDDING_INPUT_SIZE, EMBEDDING_INPUT_SIZE)
+    torch.onnx.export(model, (example,), float_path, input_names=['pixel_values'], output_names=['pooler_output'],
+                      dynamic_axes={'pixel_values': {0: 'batch'}, 'pooler_output': {0: 'batch'}},
+                      opset_version=ONNX_OPSET, dynamo=False)
+    print(f"Embedding net was exported to {float_path}")
+
+    # Batch normalizations are folded into convolutions before their ranges are calibrated
+    prepared_path = os.path.join(output_dir, 'embedding_net.prepared.onnx')
+    quant_pre_process(float_path, prepared_path)
+    quantize_static(prepared_path, int8_path, MasksCalibrationReader(calibration_masks), quant_format=QuantFormat.QDQ,
+                    per_channel=True, activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+    os.remove(prepared_path)
+    print(f"Embedding net was quantized to {int8_path}")
+
+def export_segmentation_net(output_dir : str = EXPORTED_MODELS_PATH) -> None:
+    """
+    Exports YOLO segmentation net to ONNX with ultralytics exporter
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    exported_path = YOLO(SEGMENTATION_NET_PATH).export(format='onnx', simplify=True)
+    shutil.move(exported_path, os.path.join(output_dir, EXPORTED_SEGMENTATION_NET))
+    print(f"Segmentation net was exported to {os.path.join(output_dir, EXPORTED_SEGMENTATION_NET)}")
+
+def load_database_embeddings(db_path : str, table_name : str = 'geomap_embeddings') -> np.ndarray:
+    """
+    Reads float32 embeddings of all rows of the geomap database, None if there is no database
+    """
+    if not os.path.exists(db_path):
+        return None
+    with sqlite3.connect(f"file:{db_path}?mode=ro", uri=True) as connection:
+        blobs = connection.execute(f"SELECT embedding FROM {table_name} ORDER BY rowid").fetchall()
+    return np.array([np.frombuffer(blob, np.float32) for blob, in blobs])
+
+def nearest_rows(queries : np.ndarray, rows : np.ndarray) -> np.ndarray:
+    """
+    Indexes of rows closest to queries in L1, the metric used by GeomapDB
+    """
+    result = []
+    for start in range(0, len(queries), QUERY_CHUNK):
+        distances = np.abs(queries[start:start + QUERY_CHUNK, None, :] - rows[None, :, :]).sum(axis=2)
+        result.append(distances.argmin(axis=1))
+    return np.concatenate(result)
+
+def check_accuracy(masks : list[np.ndarray], backend : str = 'onnx-int8', db_path : str = 'geomap.db') -> float:
+    """
+    Embeds masks with the original and the exported embedding net and returns the share of masks
+    whose closest database row is the same for both. Without a database, reference embeddings of the masks are used as rows
+    """
+    session = onnxruntime.InferenceSession(os.path.join(EXPORTED_MODELS_PATH, EXPORTED_EMBEDDING_NETS[backend]),
+                                           providers=['CPUExecutionProvider'])
+    exported_net = lambda pixel_values: session.run(['pooler_output'], {'pixel_values': pixel_values.numpy()})[0]
+    model = ResNetModel.from_pretrained(EMBEDDING_NET_PATH).eval()
+    def reference_net(pixel_values):
+        with torch.no_grad():
+            return model(pixel_values=pixel_values).pooler_output.numpy()
+
+    start = time.perf_counter()
+    reference = get_embeddings(masks, embedding_net=reference_net)
+    reference_time = time.perf_counter() - start
+    start = time.perf_counter()
+    exported = get_embeddings(masks, embedding_net=exported_net)
+    exported_time = time.perf_counter() - start
+
+    rows = load_database_embeddings(db_path)
+    if rows is None or not len(rows):
+        print(f"{db_path} was not found, reference embeddings of the masks are used as database rows")
+        rows = reference
+    reference_rows = nearest_rows(reference, rows)
+    exported_rows = nearest_rows(exported, rows)
+    agreement = float(np.mean(reference_rows == exported_rows))
+
+    embedding_error = np.abs(exported - reference).sum(axis=1).mean()
+    row_distance = np.abs(reference - rows[reference_rows]).sum(axis=1)
+    print(f"{len(masks)} masks, {len(rows)} database rows, backend {backend}")
+    print(f"  same closest row: {agreement:.2%}")
+    print(f"  mean L1 between reference and exported embeddings: {embedding_error:.4f}, "
+          f"mean L1 to the closest row: {row_distance.mean():.4f}")
+    print(f"  torch {reference_time / len(masks) * 1000:.2f} ms per mask, {backend} {exported_time / len(masks) * 1000:.2f} ms per mask")
+    return agreement
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export models for CPU-only inference and check their accuracy')
+    parser.add_argument('--masks', default=MASK_ARCHIVE_PATH,
+                        help='mask archive made by pre_flight.py, or a directory with PNG masks of older builds')
+    parser.add_argument('--samples', type=int, default=256, help='masks used for calibration and for the accuracy check')
+    parser.add_argument('--backend', default='onnx-int8', choices=list(EXPORTED_EMBEDDING_NETS), help='exported embedding net to check')
+    parser.add_argument('--db', default='geomap.db')
+    parser.add_argument('--min-agreement', type=float, default=0.95, help='the check fails if fewer masks keep their closest row')
+    parser.add_argument('--check-only', action='store_true', help='do not export, check already exported models')
+    parser.add_argument('--skip-segmentation', action='store_true')
+    args = parser.parse_args()
+
+    if os.path.isdir(args.masks):
+        masks = sorted(glob.glob(os.path.join(args.masks, '*.png')))
+        read_mask = cv2.imread
+    elif os.path.exists(args.masks):
+        archive = MaskArchive(args.masks)
+        masks = sorted(archive.latest('building').values())
+        read_mask = archive.mask
+    else:
+        masks = []
+    if not masks:
+        sys.exit(f"No masks were found in {args.masks}, run pre_flight.py first")
+    # Evenly spread sample, neighbouring masks are neighbouring buildings
+    masks = [read_mask(mask) for mask in masks[::max(1, len(masks) // args.samples)][:args.samples]]
+
+    if not args.check_only:
+        export_embedding_net(masks)
+        if not args.skip_segmentation:
+            export_segmentation_net()
+    if check_accuracy(masks, args.backend, args.db) < args.min_agreement:
+        sys.exit(f"Exported embeddings keep their closest row less often than {args.min_agreement:.0%}")
@@ -0,0 +1,189 @@
+"""
+This module provides you with concurrent, rate limited and cached access to OSM API
+"""
+
+import hashlib
+import os
+import pickle
+import random
+import re
+import threading
+import time
+import osmapi
+
+from concurrent.futures import ThreadPoolExecutor
+
+OSM_API_URL = 'https://www.openstreetmap.org'
+
+RETRY_STATUSES = {429, 500, 502, 503, 504, 509}     # Bandwidth limit, rate limit and server side errors
+MISSING_STATUSES = {404, 410}                       # Elements which do not exist or were deleted
+
+class TokenBucket:
+    """
+    Thread safe token bucket, which does not allow to make more than
+    rate requests per second on average and more than capacity requests at once
+    """
+    def __init__(self, rate : float, capacity : int) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.__tokens = capacity
+        self.__updated = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """
+        Blocks until a token is available and takes it
+        """
+        while True:
+            with self.__lock:
+                now = time.monotonic()
+                self.__tokens = min(self.capacity, self.__tokens + (now - self.__updated) * self.rate)
+                self.__updated = now
+                if self.__tokens >= 1:
+                    self.__tokens -= 1
+                    return
+                time_to_wait = (1 - self.__tokens) / self.rate
+            time.sleep(time_to_wait)
+
+
+class ResponseCache:
+    """
+    On-disk cache of API responses, stored as <cache_dir>/<kind>/<key>.pickle
+    """
+    def __init__(self, cache_dir : str) -> None:
+        self.cache_dir = cache_dir
+
+    def __path(self, kind : str, key : str) -> str:
+        return os.path.join(self.cache_dir, kind, f"{key}.pickle")
+
+    def get(self, kind : str, key : str):
+        """
+        Returns (True, response) if response is cached, (False, None) otherwise
+        """
+        path = self.__path(kind, key)
+        if not os.path.exists(path):
+            return False, None
+        with open(path, 'rb') as file:
+            return True, pickle.load(file)
+
+    def put(self, kind : str, key : str, response) -> None:
+        """
+        Stores response, the file is replaced atomically, so concurrent readers never see it half written
+        """
+        path = self.__path(kind, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as file:
+            pickle.dump(response, file)
+        os.replace(temp_path, path)
+
+
+def ids_key(ids : list[int]) -> str:
+    """
+    Makes cache key out of the list of element ids
+    """
+    return hashlib.sha1(','.join(map(str, sorted(ids))).encode()).hexdigest()
+
+def retry_delay(error : osmapi.ApiError, attempt : int, backoff : float) -> float:
+    """
+    Returns how long to sleep before the next attempt.
+    OSM tells how long to wait when bandwidth limit is exceeded, otherwise exponential backoff with jitter is used
+    """
+    payload = error.payload.decode(errors='replace') if isinstance(error.payload, bytes) else str(error.payload)
+    seconds = re.search(r'(\d+)\s+seconds', payload)
+    if error.status in (429, 509) and seconds:
+        return int(seconds.group(1)) + 1
+    return backoff * 2 ** attempt * (1 + random.random())
+
+
+class OsmDownloader:
+    """
+    Downloads data from OSM API in several threads, with token bucket rate limiting,
+    retries with backoff and on-disk response cache, so repeated builds make no network calls
+    """
+    def __init__(self, api_url : str = OSM_API_URL, max_workers : int = 4, requests_per_second : float = 2.0,
+                 retries : int = 5, backoff : float = 1.0, cache_dir : str = 'cache/osm_api') -> None:
+        self.api_url = api_url
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.cache = ResponseCache(cache_dir) if cache_dir else None
+        self.__bucket = TokenBucket(requests_per_second, max_workers)
+        self.__local = threading.local()
+
+    def __api(self) -> osmapi.OsmApi:
+        """
+        Every thread gets its own OsmApi, since they do not share HTTP sessions safely
+        """
+        if not hasattr(self.__local, 'api'):
+            self.__local.api = osmapi.OsmApi(api=self.api_url)
+            # osmapi retries server errors by itself with a fixed 5 seconds sleep and no rate limit,
+            # retries are made here instead, so they honour the bucket and the wait the server asks for
+            self.__local.api._session.MAX_RETRY_LIMIT = 1
+        return self.__local.api
+
+    def __request(self, kind : str, key : str, call, missing=None):
+        """
+        Returns cached response or makes the request, retrying it on transient errors.
+        An element which does not exist gives missing, which is cached too, so the next build does not ask for it again
+        """
+        if self.cache:
+            is_cached, response = self.cache.get(kind, key)
+            if is_cached:
+                return response
+        for attempt in range(self.retries + 1):
+            self.__bucket.acquire()
+            try:
+                response = call(self.__api())
+                break
+            except osmapi.ApiError as error:
+                if error.status in MISSING_STATUSES:
+                    print(f"APIError {error.status} {error.reason}, {kind} {key} is skipped")
+                    response = missing
+                    break
+                retryable = isinstance(error, (osmapi.ConnectionApiError, osmapi.TimeoutApiError)) or \
+                    error.status in RETRY_STATUSES
+                if not retryable or attempt == self.retries:
+                    raise
+                time_to_sleep = retry_delay(error, attempt, self.backoff)
+                print(f"APIError {error.status} {error.reason}, retrying in {time_to_sleep:.1f} seconds")
+                time.sleep(time_to_sleep)
+        if self.cache:
+            self.cache.put(kind, key, response)
+        return response
+
+    def map_sector(self, sector : list[float]) -> list[dict]:
+        """
+        Downloads everything inside the sector (min_lon, min_lat, max_lon, max_lat)
+        """
+        return self.__request('map', '_'.join(map(repr, sector)), lambda api: api.map(*sector), [])
+
+    def relation(self, relation_id : int) -> dict:
+        """
+        Downloads relation, None if it does not exist
+        """
+        return self.__request('relation', str(relation_id), lambda api: api.relation_get(relation_id))
+
+    def ways(self, ways_ids : list[int]) -> dict:
+        """
+        Downloads ways
+        """
+        return self.__request('ways', ids_key(ways_ids), lambda api: api.ways_get(ways_ids), {})
+
+    def nodes(self, nodes_ids : list[int]) -> dict:
+        """
+        Downloads nodes
+        """
+        return self.__request('nodes', ids_key(nodes_ids), lambda api: api.nodes_get(nodes_ids), {})
+
+    def map(self, function, items : list, report_every : int = 0) -> list:
+        """
+        Applies function to items in max_workers threads, keeps the order of results
+        """
+        results = []
+        with ThreadPoolExecutor(self.max_workers) as executor:
+            for i, result in enumerate(executor.map(function, items), start=1):
+                results.append(result)
+                if report_every and i % report_every == 0:
+                    print(f'{i}/{len(items)} requests were done')
+        return results
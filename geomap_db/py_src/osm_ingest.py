@@ -0,0 +1,333 @@
+"""
+This module provides you with multi-process ingestion of .osm.pbf extracts.
+PBF blobs are decoded in a process pool with NumPy, everything outside of the
+bounding box is rejected before any Python objects are built, and workers return
+compact arrays instead of osmium objects
+"""
+
+import os
+import struct
+import zlib
+import numpy as np
+
+from multiprocessing import Pool
+
+WIRE_VARINT, WIRE_64BIT, WIRE_LENGTH, WIRE_32BIT = 0, 1, 2, 5
+
+MEMBER_WAY = 1
+
+def iter_fields(buffer : bytes):
+    """
+    Iterates over (field number, value) pairs of a protobuf message.
+    Varints are returned as ints, length-delimited fields as memoryviews
+    """
+    buffer = memoryview(buffer)
+    position, end = 0, len(buffer)
+    while position < end:
+        key, position = read_varint(buffer, position)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == WIRE_VARINT:
+            value, position = read_varint(buffer, position)
+        elif wire_type == WIRE_LENGTH:
+            length, position = read_varint(buffer, position)
+            value = buffer[position:position + length]
+            position += length
+        elif wire_type == WIRE_64BIT:
+            value = buffer[position:position + 8]
+            position += 8
+        elif wire_type == WIRE_32BIT:
+            value = buffer[position:position + 4]
+            position += 4
+        else:
+            raise ValueError(f"Unsupported protobuf wire type {wire_type}")
+        yield field, value
+
+def field_value(buffer : bytes, field_number : int, default=None):
+    """
+    Value of the first field with the number, other fields are skipped without being collected
+    """
+    for field, value in iter_fields(buffer):
+        if field == field_number:
+            return value
+    return default
+
+def read_varint(buffer, position : int) -> tuple[int, int]:
+    """
+    Reads single varint, returns its value and the position after it
+    """
+    result = shift = 0
+    while True:
+        byte = buffer[position]
+        position += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, position
+        shift += 7
+
+def decode_packed(buffer, signed : bool = False) -> np.ndarray:
+    """
+    Decodes packed varints with NumPy, signed ones are zigzag decoded
+    """
+    data = np.frombuffer(buffer, np.uint8)
+    if not data.size:
+        return np.empty(0, np.int64)
+    ends = data < 0x80
+    starts = np.flatnonzero(np.concatenate(([True], ends[:-1])))
+    position = np.arange(data.size) - np.repeat(starts, np.diff(np.append(starts, data.size)))
+    chunks = (data & 0x7f).astype(np.uint64) << (7 * position).astype(np.uint64)
+    values = np.add.reduceat(chunks, starts)
+    if signed:
+        return (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+    return values.astype(np.int64)
+
+def decode_packed_segments(buffers : list, signed : bool = False) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Decodes several packed varint fields at once.
+    Returns concatenated values and the offsets of every segment in them
+    """
+    lengths = np.array([len(buffer) for buffer in buffers], np.int64)
+    joined = b''.join(buffers)
+    values = decode_packed(joined, signed)
+    data = np.frombuffer(joined, np.uint8)
+    value_ends = np.concatenate(([0], np.cumsum(data < 0x80)))
+    offsets = value_ends[np.concatenate(([0], np.cumsum(lengths)))]
+    return values, offsets
+
+def delta_decode_segments(values : np.ndarray, offsets : np.ndarray) -> np.ndarray:
+    """
+    Undoes delta coding separately inside every segment
+    """
+    if not values.size:
+        return values
+    totals = np.cumsum(values)
+    segment_starts = np.concatenate(([0], totals))[offsets[:-1]]
+    return totals - np.repeat(segment_starts, np.diff(offsets))
+
+def pbf_blobs(file_name : str) -> list[tuple[str, int, int]]:
+    """
+    Returns (type, offset, size) of every blob in the file without decompressing them
+    """
+    blobs = []
+    with open(file_name, 'rb') as file:
+        while True:
+            header_size = file.read(4)
+            if len(header_size) < 4:
+                break
+            header = file.read(struct.unpack('>I', header_size)[0])
+            blob_type, data_size = None, 0
+            for field, value in iter_fields(header):
+                if field == 1:
+                    blob_type = bytes(value).decode()
+                elif field == 3:
+                    data_size = value
+            blobs.append((blob_type, file.tell(), data_size))
+            file.seek(data_size, os.SEEK_CUR)
+    return blobs
+
+def read_blob(file_name : str, offset : int, size : int) -> bytes:
+    """
+    Reads and decompresses blob
+    """
+    with open(file_name, 'rb') as file:
+        file.seek(offset)
+        blob = file.read(size)
+    for field, value in iter_fields(blob):
+        if field == 1:
+            return bytes(value)
+        if field == 3:
+            return zlib.decompress(value)
+    raise ValueError("Only raw and zlib compressed PBF blobs are supported")
+
+def primitive_groups(block : bytes):
+    """
+    Splits PrimitiveBlock into string table, coordinates transformation and groups
+    """
+    strings, groups = [], []
+    granularity, lat_offset, lon_offset = 100, 0, 0
+    for field, value in iter_fields(block):
+        if field == 1:
+            strings = [bytes(string).decode() for string_field, string in iter_fields(value) if string_field == 1]
+        elif field == 2:
+            groups.append(value)
+        elif field == 17:
+            granularity = value
+        elif field == 19:
+            lat_offset = value
+        elif field == 20:
+            lon_offset = value
+    return strings, (granularity, lat_offset, lon_offset), groups
+
+def decode_tags(strings : list[str], keys, vals) -> dict:
+    """
+    Builds tags dictionary from packed string table indices
+    """
+    return dict(zip((strings[key] for key in decode_packed(keys)), (strings[val] for val in decode_packed(vals))))
+
+def parse_nodes_blob(file_name : str, offset : int, size : int, bbox : tuple[float, float, float, float]):
+    """
+    Worker of the first pass, returns ids, latitudes and longitudes of nodes inside the bounding box
+    and whether the blob has anything except nodes
+    """
+    min_lon, min_lat, max_lon, max_lat = bbox
+    _, (granularity, lat_offset, lon_offset), groups = primitive_groups(read_blob(file_name, offset, size))
+    ids, lats, lons = [], [], []
+    has_other = False
+    for group in groups:
+        for field, value in iter_fields(group):
+            if field == 2:
+                dense = dict(iter_fields(value))
+                ids.append(np.cumsum(decode_packed(dense.get(1, b''), True)))
+                lats.append(np.cumsum(decode_packed(dense.get(8, b''), True)))
+                lons.append(np.cumsum(decode_packed(dense.get(9, b''), True)))
+            elif field == 1:
+                node = {}
+                for node_field, node_value in iter_fields(value):
+                    node[node_field] = node_value
+                ids.append(np.array([zigzag(node.get(1, 0))], np.int64))
+                lats.append(np.array([zigzag(node.get(8, 0))], np.int64))
+                lons.append(np.array([zigzag(node.get(9, 0))], np.int64))
+            else:
+                has_other = True
+    if not ids:
+        return np.empty(0, np.int64), np.empty(0), np.empty(0), has_other
+
+    ids = np.concatenate(ids)
+    # Osmium keeps coordinates as integers of 1e-7 degree, so do we
+    lats = np.round((lat_offset + granularity * np.concatenate(lats)) / 100) / 1e7
+    lons = np.round((lon_offset + granularity * np.concatenate(lons)) / 100) / 1e7
+    acceptable = (min_lat <= lats) & (lats <= max_lat) & (min_lon <= lons) & (lons <= max_lon)
+    return ids[acceptable], lats[acceptable], lons[acceptable], has_other
+
+def zigzag(value : int) -> int:
+    """
+    Decodes zigzag encoded integer
+    """
+    return (value >> 1) ^ -(value & 1)
+
+_NODE_IDS = _NODE_CORDS = None
+
+def init_ways_worker(node_ids : np.ndarray, node_cords : np.ndarray) -> None:
+    """
+    Shares nodes inside the bounding box with the workers of the second pass
+    """
+    global _NODE_IDS, _NODE_CORDS
+    _NODE_IDS, _NODE_CORDS = node_ids, node_cords
+
+def parse_ways_blob(file_name : str, offset : int, size : int):
+    """
+    Worker of the second pass.
+    Returns ways, which have nodes inside the bounding box, as (id, tags, refs, [lat, lon] of the nodes inside)
+    and multipolygon relations as (id, tags, member way ids, member roles)
+    """
+    strings, _, groups = primitive_groups(read_blob(file_name, offset, size))
+    raw_ways, raw_relations = [], []
+    for group in groups:
+        for field, value in iter_fields(group):
+            if field == 3:
+                raw_ways.append(value)
+            elif field == 4:
+                raw_relations.append(dict(iter_fields(value)))
+
+    ways = []
+    if raw_ways:
+        # Only refs are read to find ways with nodes inside the bounding box, the rest is decoded for them alone
+        refs, offsets = decode_packed_segments([field_value(way, 8, b'') for way in raw_ways], True)
+        refs = delta_decode_segments(refs, offsets)
+        positions = np.minimum(np.searchsorted(_NODE_IDS, refs), max(_NODE_IDS.size - 1, 0))
+        inside = _NODE_IDS[positions] == refs if _NODE_IDS.size else np.zeros(refs.size, bool)
+        inside_amount = np.concatenate(([0], np.cumsum(inside)))[offsets]
+        for i in np.flatnonzero(np.diff(inside_amount)):
+            way = dict(iter_fields(raw_ways[i]))
+            way_refs = refs[offsets[i]:offsets[i + 1]]
+            way_inside = inside[offsets[i]:offsets[i + 1]]
+            way_cords = _NODE_CORDS[positions[offsets[i]:offsets[i + 1]][way_inside]]
+            ways.append((way.get(1, 0), decode_tags(strings, way.get(2, b''), way.get(3, b'')), way_refs, way_cords))
+
+    relations = []
+    for relation in raw_relations:
+        tags = decode_tags(strings, relation.get(2, b''), relation.get(3, b''))
+        if tags.get('type') != 'multipolygon':
+            continue
+        member_ids = np.cumsum(decode_packed(relation.get(9, b''), True))
+        member_types = decode_packed(relation.get(10, b''))
+        roles = [strings[role] for role in decode_packed(relation.get(8, b''))]
+        is_way = member_types == MEMBER_WAY
+        relations.append((relation.get(1, 0), tags, member_ids[is_way], [role for role, way in zip(roles, is_way) if way]))
+    return ways, relations
+
+def assemble_rings(member_ways : list[tuple[np.ndarray, np.ndarray]]) -> list[np.ndarray]:
+    """
+    Joins way segments by their end nodes into rings.
+    Takes (refs, [lat, lon] of the nodes inside the bounding box) of every way,
+    returns [lat, lon] of every assembled ring
+    """
+    chains = [(refs, cords) for refs, cords in member_ways if refs.size]
+    rings = []
+    while chains:
+        refs, cords = chains.pop(0)
+        chain_refs, chain_cords = [refs], [cords]
+        joined = True
+        while joined and chain_refs[0][0] != chain_refs[-1][-1]:
+            joined = False
+            for i, (other_refs, other_cords) in enumerate(chains):
+                if other_refs[0] == chain_refs[-1][-1]:
+                    chain_refs.append(other_refs)
+                    chain_cords.append(other_cords)
+                elif other_refs[-1] == chain_refs[-1][-1]:
+                    chain_refs.append(other_refs[::-1])
+                    chain_cords.append(other_cords[::-1])
+                else:
+                    continue
+                chains.pop(i)
+                joined = True
+                break
+        rings.append(np.concatenate(chain_cords))
+    return rings
+
+def load_pbf(file_name : str, min_lon : float, min_lat : float, max_lon : float, max_lat : float,
+             processes : int = None) -> tuple[list[dict], list[dict]]:
+    """
+    Reads areas and ways touching the bounding box out of .osm.pbf file in a process pool.
+    Areas and ways are returned in the same form GeomapFromFile keeps them,
+    with nodes outside of the bounding box dropped
+    """
+    bbox = (min_lon, min_lat, max_lon, max_lat)
+    data_blobs = [(file_name, offset, size) for blob_type, offset, size in pbf_blobs(file_name) if blob_type == 'OSMData']
+
+    with Pool(processes) as pool:
+        node_results = pool.starmap(parse_nodes_blob, [blob + (bbox,) for blob in data_blobs])
+    node_ids = np.concatenate([result[0] for result in node_results])
+    node_cords = np.stack((np.concatenate([result[1] for result in node_results]),
+                           np.concatenate([result[2] for result in node_results])), axis=-1).reshape((-1, 2))
+    order = np.argsort(node_ids, kind='stable')
+    node_ids, node_cords = node_ids[order], node_cords[order]
+    way_blobs = [blob for blob, result in zip(data_blobs, node_results) if result[3]]
+
+    with Pool(processes, initializer=init_ways_worker, initargs=(node_ids, node_cords)) as pool:
+        way_results = pool.starmap(parse_ways_blob, way_blobs)
+
+    areas, ways, way_geometry = [], [], {}
+    for blob_ways, _ in way_results:
+        for way_id, tags, refs, cords in blob_ways:
+            way_geometry[way_id] = (refs, cords)
+            if not tags:
+                continue
+            if refs.size >= 4 and refs[0] == refs[-1]:
+                areas.append({'area_id' : 2 * way_id, 'tags' : tags, 'outer_rings' : [cords], 'inner_rings' : []})
+            elif refs.size:
+                ways.append({'way_id' : way_id, 'tags' : tags, 'nodes' : cords})
+
+    for _, blob_relations in way_results:
+        for relation_id, tags, member_ids, roles in blob_relations:
+            outer_ways = [way_geometry[way_id] for way_id, role in zip(member_ids, roles)
+                          if role != 'inner' and way_id in way_geometry]
+            inner_ways = [way_geometry[way_id] for way_id, role in zip(member_ids, roles)
+                          if role == 'inner' and way_id in way_geometry]
+            if outer_ways or inner_ways:
+                areas.append({
+                    'area_id' : 2 * relation_id + 1,
+                    'tags' : tags,
+                    'outer_rings' : assemble_rings(outer_ways),
+                    'inner_rings' : assemble_rings(inner_ways)
+                })
+    return areas, ways
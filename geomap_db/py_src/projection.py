@@ -0,0 +1,98 @@
+"""
+This module provides you with a fast lat/lon to pixel projection for map rendering
+"""
+
+import numpy as np
+
+from geopy.distance import geodesic
+
+WGS84_A = 6378137.0                     # Semi-major axis, meters
+WGS84_E2 = 6.69437999014e-3             # First eccentricity squared
+
+
+class LocalProjection:
+    """
+    Local metric projection anchored at the top left corner of the map.
+    x grows to the east and y grows to the south, one pixel is one meter by default.
+    The result matches geodesic() distances from (origin_lat, origin_lon)
+    the way GeomapFromFile used to compute them node by node.
+    """
+    def __init__(self, origin_lat : float, origin_lon : float, max_lat_span : float = 1.0,
+                 pixels_per_meter : float = 1.0) -> None:
+        self.origin_lat = origin_lat
+        self.origin_lon = origin_lon
+        self.pixels_per_meter = pixels_per_meter
+        sin_lat = np.sin(np.radians(origin_lat))
+        # Parallel radius at the anchor latitude, x offsets are measured along it
+        prime_vertical = WGS84_A / np.sqrt(1 - WGS84_E2 * sin_lat ** 2)
+        self.__meters_per_lon = np.radians(1) * prime_vertical * np.cos(np.radians(origin_lat))
+        # Meridian radius at the middle of the covered latitudes, y offsets are measured along it
+        sin_mid = np.sin(np.radians(origin_lat - max_lat_span / 2))
+        meridian = WGS84_A * (1 - WGS84_E2) / (1 - WGS84_E2 * sin_mid ** 2) ** 1.5
+        self.__meters_per_lat = np.radians(1) * meridian
+
+    @classmethod
+    def for_bbox(cls, min_lon : float, min_lat : float, max_lon : float, max_lat : float,
+                 pixels_per_meter : float = 1.0) -> 'LocalProjection':
+        """
+        Creates projection anchored at (max_lat, min_lon) of the given bounding box
+        """
+        return cls(max_lat, min_lon, max_lat - min_lat, pixels_per_meter)
+
+    def to_meters(self, lat, lon) -> np.ndarray:
+        """
+        Converts arrays of latitudes and longitudes into (N, 2) array of [x, y] offsets in meters
+        """
+        lat = np.asarray(lat, np.float64)
+        lon = np.asarray(lon, np.float64)
+        x = (lon - self.origin_lon) * self.__meters_per_lon
+        y = (self.origin_lat - lat) * self.__meters_per_lat
+        return np.stack((x, y), axis=-1)
+
+    def to_pixels(self, lat, lon) -> np.ndarray:
+        """
+        Converts arrays of latitudes and longitudes into (N, 2) int32 array of [x, y] pixels
+        """
+        return np.floor(self.to_meters(lat, lon) * self.pixels_per_meter).astype(np.int32)
+
+    def to_contour(self, cords : np.ndarray) -> np.ndarray:
+        """
+        Converts (N, 2) array of [lat, lon] into contour which can be passed straight to cv2 drawing functions
+        """
+        return self.to_pixels(cords[:, 0], cords[:, 1]).reshape((-1, 1, 2))
+
+
+def nodes_to_array(nodes) -> np.ndarray:
+    """
+    Packs osmium nodes into (N, 2) float64 array of [lat, lon]
+    """
+    return np.array([(node.location.lat, node.location.lon) for node in nodes], np.float64).reshape((-1, 2))
+
+
+def max_projection_error(min_lon : float, min_lat : float, max_lon : float, max_lat : float,
+                         samples : int = 20) -> float:
+    """
+    Compares LocalProjection with geodesic() on a grid over the bounding box
+    and returns the largest deviation in meters
+    """
+    projection = LocalProjection.for_bbox(min_lon, min_lat, max_lon, max_lat)
+    lats, lons = np.meshgrid(np.linspace(min_lat, max_lat, samples), np.linspace(min_lon, max_lon, samples))
+    projected = projection.to_meters(lats.ravel(), lons.ravel())
+    max_error = 0.0
+    for (lat, lon), (x, y) in zip(zip(lats.ravel(), lons.ravel()), projected):
+        expected_y = geodesic((max_lat, min_lon), (lat, min_lon)).kilometers * 1000
+        expected_x = geodesic((max_lat, min_lon), (max_lat, lon)).kilometers * 1000
+        max_error = max(max_error, abs(x - expected_x), abs(y - expected_y))
+    return max_error
+
+
+if __name__ == '__main__':
+    BOUNDING_BOXES = {
+        'Saint Petersburg, Vasilyevsky island' : (30.2775, 59.9091, 30.2974, 59.9164),
+        'Saint Petersburg, 20x20 km' : (30.15, 59.85, 30.51, 60.03),
+        'Peterhof, 20x20 km' : (29.75, 59.78, 30.11, 59.96),
+    }
+    for name, bbox in BOUNDING_BOXES.items():
+        error = max_projection_error(*bbox)
+        print(f"{name}: max error {error:.3f} m")
+        assert error < 1, f"Projection error exceeds one pixel for {name}"
@@ -0,0 +1,83 @@
+"""
+This module measures startup of the image processing: import of py_src.image_processing,
+loading of every model and the first inference after it.
+Every run is a fresh interpreter, so nothing is shared between runs except the OS file cache.
+Run it from geomap_db: python -m py_src.startup_benchmark
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# Runs in the child interpreter, prints stage timings in ms as one JSON line
+CHILD_CODE = """
+import json, sys, time
+import numpy as np
+stages = sys.argv[1].split(',')
+timings = {}
+start = time.perf_counter()
+import py_src.image_processing as image_processing
+timings['import'] = (time.perf_counter() - start) * 1000
+crop = np.zeros((image_processing.WARM_UP_FRAME_SIZE // 8, image_processing.WARM_UP_FRAME_SIZE // 8, 3), np.uint8)
+frame = np.zeros((image_processing.WARM_UP_FRAME_SIZE, image_processing.WARM_UP_FRAME_SIZE, 3), np.uint8)
+actions = {
+    'load_processor': image_processing.get_embedding_processor,
+    'load_pca': image_processing.get_pca_model,
+    'load_embedding': image_processing.get_embedding_model,
+    'load_segmentation': image_processing.get_segmentation_model,
+    'first_embedding': lambda: image_processing.get_embeddings([crop]),
+    'second_embedding': lambda: image_processing.get_embeddings([crop]),
+    'first_segmentation': lambda: image_processing.segment_frame(frame),
+    'second_segmentation': lambda: image_processing.segment_frame(frame),
+}
+for stage in stages:
+    start = time.perf_counter()
+    actions[stage]()
+    timings[stage] = (time.perf_counter() - start) * 1000
+print(json.dumps(timings))
+"""
+
+EMBEDDING_STAGES = ['load_processor', 'load_pca', 'load_embedding', 'first_embedding', 'second_embedding']
+SEGMENTATION_STAGES = ['load_segmentation', 'first_segmentation', 'second_segmentation']
+
+def run_once(stages : list[str]) -> dict:
+    """
+    Measures stages in a fresh interpreter, import is always measured first
+    """
+    result = subprocess.run([sys.executable, '-c', CHILD_CODE, ','.join(stages)], capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Benchmark run failed:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def benchmark(stages : list[str], repeats : int) -> dict:
+    """
+    Returns median and max of every stage over the runs
+    """
+    runs = [run_once(stages) for _ in range(repeats)]
+    return {stage: {'median_ms': statistics.median(run[stage] for run in runs), 'max_ms': max(run[stage] for run in runs)}
+            for stage in ['import'] + stages}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure import, model loading and first inference time of image processing')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--import-only', action='store_true', help='measure only the import of py_src.image_processing')
+    parser.add_argument('--skip-segmentation', action='store_true', help='do not load the segmentation net')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    stages = []
+    if not args.import_only:
+        stages += EMBEDDING_STAGES
+        if not args.skip_segmentation:
+            stages += SEGMENTATION_STAGES
+    results = benchmark(stages, args.repeats)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'stage':<22}{'median, ms':>12}{'max, ms':>12}   ({args.repeats} runs)")
+        for stage, timing in results.items():
+            print(f"{stage:<22}{timing['median_ms']:>12.1f}{timing['max_ms']:>12.1f}")
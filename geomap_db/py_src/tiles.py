@@ -0,0 +1,205 @@
+"""
+This module provides you with tiled rendering of OSM maps, which does not need
+the whole map to fit in memory.
+Tiles follow slippy map z/x/y numbering and are stored as images/tiles/<z>/<x>/<y>.png
+"""
+
+import hashlib
+import json
+import math
+import os
+import cv2
+import numpy as np
+import osmium
+
+from tqdm import tqdm
+
+from py_src.geomap import COLORSCHEME, WAY_THICKNESS, get_description, draw_area, draw_way
+from py_src.projection import LocalProjection, nodes_to_array
+
+DEFAULT_TILE_ZOOM = 14              # About 1.2x1.2 km per tile around Saint Petersburg, rendered at 1 px/m
+
+RENDER_VERSION = 1                  # Bump it whenever drawing changes, so cached tiles get re-rendered
+
+TILE_INDEX_FILE = 'index.json'
+
+def lon_to_tile_x(lon : float, zoom : int) -> int:
+    """
+    Returns x number of the tile containing given longitude
+    """
+    return int((lon + 180) / 360 * 2 ** zoom)
+
+def lat_to_tile_y(lat : float, zoom : int) -> int:
+    """
+    Returns y number of the tile containing given latitude
+    """
+    return int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * 2 ** zoom)
+
+def tile_bounds(x : int, y : int, zoom : int) -> tuple[float, float, float, float]:
+    """
+    Returns (min_lon, min_lat, max_lon, max_lat) of the tile
+    """
+    def tile_y_to_lat(tile_y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * tile_y / 2 ** zoom))))
+    return x / 2 ** zoom * 360 - 180, tile_y_to_lat(y + 1), (x + 1) / 2 ** zoom * 360 - 180, tile_y_to_lat(y)
+
+def tiles_in_bbox(min_lon : float, min_lat : float, max_lon : float, max_lat : float, zoom : int):
+    """
+    Returns range of x and range of y of tiles touching the bounding box
+    """
+    return (range(lon_to_tile_x(min_lon, zoom), lon_to_tile_x(max_lon, zoom) + 1),
+            range(lat_to_tile_y(max_lat, zoom), lat_to_tile_y(min_lat, zoom) + 1))
+
+
+class TiledGeomapFromFile(osmium.SimpleHandler):
+    """
+    Tool for rendering OSM data from given file into fixed grid of tiles.
+    OSM objects are streamed into buckets of the tiles they touch as compact arrays,
+    then tiles are rendered and saved one by one.
+    A tile is rendered again only if the objects touching it have changed
+    """
+    def __init__(self, min_lon : float, min_lat : float, max_lon : float, max_lat : float,
+                 zoom : int = DEFAULT_TILE_ZOOM, tiles_dir : str = 'images/tiles') -> None:
+        osmium.SimpleHandler.__init__(self)
+        self.zoom = zoom
+        self.tiles_dir = tiles_dir
+        self.__tiles_x, self.__tiles_y = tiles_in_bbox(min_lon, min_lat, max_lon, max_lat, zoom)
+        self.__tiles = {}
+        self.__hashes = {}
+        # Ways can be drawn a bit over the tiles they touch because of their thickness
+        self.__way_margin = WAY_THICKNESS / 111000
+
+    def __add_object(self, kind : str, object_id : int, main_tag : tuple[str, str], rings : list[np.ndarray],
+                     outer_rings_amount : int = 0, margin : float = 0) -> None:
+        """
+        Puts object into the buckets of the tiles its bounding box touches
+        """
+        all_cords = np.concatenate(rings)
+        min_lat, min_lon = all_cords.min(axis=0) - margin
+        max_lat, max_lon = all_cords.max(axis=0) + margin
+        tiles_x, tiles_y = tiles_in_bbox(min_lon, min_lat, max_lon, max_lat, self.zoom)
+        tiles_x = range(max(tiles_x.start, self.__tiles_x.start), min(tiles_x.stop, self.__tiles_x.stop))
+        tiles_y = range(max(tiles_y.start, self.__tiles_y.start), min(tiles_y.stop, self.__tiles_y.stop))
+        if not tiles_x or not tiles_y:
+            return
+
+        tile_object = (kind, main_tag, rings, outer_rings_amount)
+        fingerprint = f"{kind}:{object_id}:{main_tag}:{outer_rings_amount}".encode()
+        for tile_x in tiles_x:
+            for tile_y in tiles_y:
+                tile = (tile_x, tile_y)
+                if tile not in self.__tiles:
+                    self.__tiles[tile] = []
+                    self.__hashes[tile] = hashlib.sha1(f"{RENDER_VERSION}".encode())
+                self.__tiles[tile].append(tile_object)
+                self.__hashes[tile].update(fingerprint)
+                for ring in rings:
+                    self.__hashes[tile].update(ring.tobytes())
+
+    def area(self, area):
+        """
+        Osmium library uses this method to process areas from .osm file
+        """
+        if not area.visible:
+            return
+        main_tag = get_description({tag.k : tag.v for tag in area.tags})
+        if not main_tag:
+            return
+        outer_rings, inner_rings = [], []
+        for outer_ring in area.outer_rings():
+            outer_rings.append(nodes_to_array(outer_ring))
+            for inner_ring in area.inner_rings(outer_ring):
+                inner_rings.append(nodes_to_array(inner_ring))
+        rings = [ring for ring in outer_rings + inner_rings if ring.size]
+        if rings:
+            outer_rings_amount = sum(1 for ring in outer_rings if ring.size)
+            self.__add_object('area', area.id, main_tag, rings, outer_rings_amount)
+
+    def way(self, way):
+        """
+        Osmium library uses this method to process ways from .osm file
+        """
+        if not way.visible or way.is_closed():
+            return
+        main_tag = get_description({tag.k : tag.v for tag in way.tags})
+        if main_tag and len(way.nodes):
+            self.__add_object('way', way.id, main_tag, [nodes_to_array(way.nodes)], margin=self.__way_margin)
+
+    def tile_path(self, tile_x : int, tile_y : int) -> str:
+        """
+        Returns path of the tile's image
+        """
+        return os.path.join(self.tiles_dir, str(self.zoom), str(tile_x), f"{tile_y}.png")
+
+    def __load_index(self) -> dict:
+        """
+        Loads hashes of the tiles rendered before
+        """
+        index_path = os.path.join(self.tiles_dir, TILE_INDEX_FILE)
+        if not os.path.exists(index_path):
+            return {}
+        with open(index_path, 'r', encoding='utf-8') as file:
+            return json.load(file)
+
+    def __save_index(self, index : dict) -> None:
+        """
+        Saves hashes of the rendered tiles
+        """
+        with open(os.path.join(self.tiles_dir, TILE_INDEX_FILE), 'w', encoding='utf-8') as file:
+            json.dump(index, file, indent=1, sort_keys=True)
+
+    def render_tile(self, tile_x : int, tile_y : int) -> np.ndarray:
+        """
+        Renders single tile at 1 px/m
+        """
+        min_lon, min_lat, max_lon, max_lat = tile_bounds(tile_x, tile_y, self.zoom)
+        projection = LocalProjection.for_bbox(min_lon, min_lat, max_lon, max_lat)
+        width, height = projection.to_pixels(min_lat, max_lon)
+        image = np.zeros((height, width, 3), np.uint8)
+
+        tile_objects = self.__tiles.get((tile_x, tile_y), [])
+        for kind, main_tag, rings, outer_rings_amount in tile_objects:
+            if kind == 'area':
+                contours = [projection.to_contour(ring) for ring in rings]
+                draw_area(image, contours, outer_rings_amount, COLORSCHEME[main_tag[1]])
+        for kind, main_tag, rings, _ in tile_objects:
+            if kind == 'way':
+                draw_way(image, projection.to_contour(rings[0]), COLORSCHEME[main_tag[1]])
+        return image
+
+    def visualize_map(self) -> list[str]:
+        """
+        Renders tiles which are missing or whose objects have changed since the previous run.
+        Returns paths of the rendered tiles
+        """
+        os.makedirs(self.tiles_dir, exist_ok=True)
+        index = self.__load_index()
+        empty_hash = hashlib.sha1(f"{RENDER_VERSION}".encode()).hexdigest()
+        rendered = []
+        tiles = [(tile_x, tile_y) for tile_x in self.__tiles_x for tile_y in self.__tiles_y]
+        for tile_x, tile_y in tqdm(tiles):
+            tile_path = self.tile_path(tile_x, tile_y)
+            tile_key = f"{self.zoom}/{tile_x}/{tile_y}"
+            tile_hash = self.__hashes[(tile_x, tile_y)].hexdigest() if (tile_x, tile_y) in self.__hashes else empty_hash
+            if index.get(tile_key) != tile_hash or not os.path.exists(tile_path):
+                os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+                cv2.imwrite(tile_path, self.render_tile(tile_x, tile_y))
+                index[tile_key] = tile_hash
+                rendered.append(tile_path)
+            self.__tiles.pop((tile_x, tile_y), None)
+        self.__save_index(index)
+        return rendered
+
+
+def build_tiled_geomap(min_lon : float, min_lat : float, max_lon : float, max_lat : float,
+                       geomap_file = "data/northwestern-fed-district-latest.osm.pbf",
+                       zoom : int = DEFAULT_TILE_ZOOM, tiles_dir : str = 'images/tiles') -> list[str]:
+    geomap = TiledGeomapFromFile(min_lon, min_lat, max_lon, max_lat, zoom, tiles_dir)
+    geomap.apply_file(geomap_file, locations=True)
+    rendered = geomap.visualize_map()
+    print(f"{len(rendered)} tiles were rendered")
+    return rendered
+
+
+if __name__ == '__main__':
+    build_tiled_geomap(30.2775, 59.9091, 30.2974, 59.9164)
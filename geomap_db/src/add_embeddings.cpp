@@ -1,18 +1,61 @@
+#include <cstdio>
+#include <string>
 #include <vector>
 #include <stdexcept>
 #include <geomap_db.hpp>
 
+// Records are read as little-endian doubles in form of (lon, lat, embedding...)
+std::vector<std::vector<double>> read_records(std::FILE *input, const unsigned embedding_dimensions)
+{
+    std::vector<std::vector<double>> rows;
+    std::vector<double> record(embedding_dimensions + 2);
+    const size_t record_size = record.size() * sizeof(double);
+    size_t read_size;
+    // Bytes are counted, so a record cut inside a double is not lost silently either
+    while ((read_size = std::fread(record.data(), 1, record_size, input)) == record_size)
+    {
+        rows.push_back(record);
+    }
+    if (!std::feof(input))
+        throw std::runtime_error("Something is wrong with the input!");
+    if (read_size)
+        throw std::runtime_error("Input ends with a truncated record of " + std::to_string(read_size) + " bytes out of " +
+                                 std::to_string(record_size));
+    return rows;
+}
 
 int main(int argc, char *argv[])
 {
     const unsigned EMBEDDING_DIMENSIONS = std::stoi(argv[1]);
+
+    GeomapDB geomap(EMBEDDING_DIMENSIONS, "geomap.db", "geomap_embeddings");
+
+    // Bulk mode: ./add_embeddings <dim> --stdin or ./add_embeddings <dim> --file <records.bin>
+    if (argc >= 3 && (std::string(argv[2]) == "--stdin" || std::string(argv[2]) == "--file"))
+    {
+        std::FILE *input = stdin;
+        if (std::string(argv[2]) == "--file")
+        {
+            if (argc != 4)
+                throw std::runtime_error("Input must be in form of (dim --file records.bin)");
+            input = std::fopen(argv[3], "rb");
+            if (!input)
+                throw std::runtime_error("Can not open " + std::string(argv[3]));
+        }
+        std::vector<std::vector<double>> rows = read_records(input, EMBEDDING_DIMENSIONS);
+        if (input != stdin)
+            std::fclose(input);
+        geomap.insert_many(rows);
+        std::cout << rows.size() << " embeddings were added" << std::endl;
+        return 0;
+    }
+
     if ((argc - 2) % (EMBEDDING_DIMENSIONS + 2) != 0)
         throw std::runtime_error("Something is wrong with the input!");
 
     unsigned embeddings_count = (argc - 2) / (EMBEDDING_DIMENSIONS + 2);
 
-    GeomapDB geomap(EMBEDDING_DIMENSIONS, "geomap.db", "geomap_embeddings");
-
+    geomap.begin_transaction();
     for (int i = 0; i < embeddings_count; ++i)
     {
         double emb_lon = std::stod(argv[2 + (EMBEDDING_DIMENSIONS + 2) * i]);
@@ -25,6 +68,7 @@ int main(int argc, char *argv[])
         }
         geomap.insert(emb_lon, emb_lat, embedding);
     }
+    geomap.commit_transaction();
 
     return 0;
 }
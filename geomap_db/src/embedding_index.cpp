@@ -0,0 +1,231 @@
+#include <embedding_index.hpp>
+#include <cmath>
+#include <queue>
+#include <cstdio>
+#include <fstream>
+#include <algorithm>
+#include <mapped_file.hpp>
+
+static const char INDEX_MAGIC[4] = {'G', 'I', 'V', 'F'};
+static const unsigned INDEX_VERSION = 2;
+static const unsigned TRAIN_ITERATIONS = 10;
+static const unsigned TRAIN_ROWS_PER_LIST = 64;
+
+EmbeddingIndex::EmbeddingIndex(const unsigned dim_embedding)
+{
+    embedding_dim = dim_embedding;
+    rows = 0;
+}
+
+float EmbeddingIndex::distance(const float *a, const float *b, const unsigned dim, const EmbeddingMetric metric)
+{
+    float result = 0;
+    if (metric == EmbeddingMetric::L1)
+    {
+        for (unsigned i = 0; i < dim; ++i)
+            result += std::fabs(a[i] - b[i]);
+    }
+    else
+    {
+        for (unsigned i = 0; i < dim; ++i)
+            result += (a[i] - b[i]) * (a[i] - b[i]);
+    }
+    return result;
+}
+
+unsigned EmbeddingIndex::size() const
+{
+    return rows;
+}
+
+bool EmbeddingIndex::is_flat() const
+{
+    return centroids.empty();
+}
+
+unsigned EmbeddingIndex::lists_amount() const
+{
+    return centroids.size() / embedding_dim;
+}
+
+unsigned EmbeddingIndex::nearest_centroid(const float *embedding) const
+{
+    unsigned nearest = 0;
+    float nearest_distance = distance(embedding, centroids.data(), embedding_dim, EmbeddingMetric::L2);
+    for (unsigned i = 1; i < lists_amount(); ++i)
+    {
+        float centroid_distance = distance(embedding, centroids.data() + i * embedding_dim, embedding_dim, EmbeddingMetric::L2);
+        if (centroid_distance < nearest_distance)
+        {
+            nearest = i;
+            nearest_distance = centroid_distance;
+        }
+    }
+    return nearest;
+}
+
+void EmbeddingIndex::build(const float *embeddings, const unsigned rows_amount)
+{
+    rows = rows_amount;
+    centroids.clear();
+    lists.clear();
+    if (rows < MIN_ROWS)
+        return;
+
+    unsigned n_lists = static_cast<unsigned>(std::sqrt(static_cast<double>(rows)));
+    unsigned train_rows = std::min(rows, n_lists * TRAIN_ROWS_PER_LIST);
+    std::vector<unsigned> train_positions(train_rows);
+    for (unsigned i = 0; i < train_rows; ++i)
+        train_positions[i] = static_cast<unsigned>(static_cast<unsigned long long>(i) * rows / train_rows);
+
+    centroids.resize(n_lists * embedding_dim);
+    for (unsigned i = 0; i < n_lists; ++i)
+    {
+        const float *row = embeddings + static_cast<size_t>(train_positions[i * train_rows / n_lists]) * embedding_dim;
+        std::copy(row, row + embedding_dim, centroids.begin() + i * embedding_dim);
+    }
+
+    std::vector<double> sums(n_lists * embedding_dim);
+    std::vector<unsigned> counts(n_lists);
+    for (unsigned iteration = 0; iteration < TRAIN_ITERATIONS; ++iteration)
+    {
+        std::fill(sums.begin(), sums.end(), 0);
+        std::fill(counts.begin(), counts.end(), 0);
+        for (const auto position : train_positions)
+        {
+            const float *row = embeddings + static_cast<size_t>(position) * embedding_dim;
+            unsigned nearest = nearest_centroid(row);
+            counts[nearest] += 1;
+            for (unsigned j = 0; j < embedding_dim; ++j)
+                sums[nearest * embedding_dim + j] += row[j];
+        }
+        for (unsigned i = 0; i < n_lists; ++i)
+        {
+            if (!counts[i])
+                continue;
+            for (unsigned j = 0; j < embedding_dim; ++j)
+                centroids[i * embedding_dim + j] = sums[i * embedding_dim + j] / counts[i];
+        }
+    }
+
+    lists.assign(n_lists, {});
+    for (unsigned position = 0; position < rows; ++position)
+        lists[nearest_centroid(embeddings + static_cast<size_t>(position) * embedding_dim)].push_back(position);
+}
+
+void EmbeddingIndex::add(const float *embedding, const unsigned position)
+{
+    if (position != rows)
+        throw std::runtime_error("Embeddings must be added to the index in order of their positions");
+    rows += 1;
+    if (!is_flat())
+        lists[nearest_centroid(embedding)].push_back(position);
+}
+
+std::vector<std::pair<float, unsigned>> EmbeddingIndex::search(const float *embeddings, const float *query, const unsigned k, const EmbeddingMetric metric, const unsigned nprobe) const
+{
+    std::priority_queue<std::pair<float, unsigned>> best;
+    auto consider = [&](const unsigned position)
+    {
+        float row_distance = distance(query, embeddings + static_cast<size_t>(position) * embedding_dim, embedding_dim, metric);
+        if (best.size() < k)
+            best.push({row_distance, position});
+        else if (row_distance < best.top().first)
+        {
+            best.pop();
+            best.push({row_distance, position});
+        }
+    };
+
+    if (is_flat())
+    {
+        for (unsigned position = 0; position < rows; ++position)
+            consider(position);
+    }
+    else
+    {
+        std::vector<std::pair<float, unsigned>> centroid_distances(lists_amount());
+        for (unsigned i = 0; i < lists_amount(); ++i)
+            centroid_distances[i] = {distance(query, centroids.data() + i * embedding_dim, embedding_dim, EmbeddingMetric::L2), i};
+        unsigned probes = std::min(std::max(nprobe, 1u), lists_amount());
+        std::partial_sort(centroid_distances.begin(), centroid_distances.begin() + probes, centroid_distances.end());
+        for (unsigned i = 0; i < probes; ++i)
+        {
+            for (const auto position : lists[centroid_distances[i].second])
+                consider(position);
+        }
+    }
+
+    std::vector<std::pair<float, unsigned>> result(best.size());
+    for (size_t i = result.size(); i > 0; --i)
+    {
+        result[i - 1] = best.top();
+        best.pop();
+    }
+    return result;
+}
+
+void EmbeddingIndex::save(const std::string &path, const std::uint64_t table_identity) const
+{
+    // Written next to the old file and renamed over it, so a loading index is never read half written
+    std::string temp_path = temporary_path(path);
+    std::ofstream file(temp_path, std::ios::binary | std::ios::trunc);
+    unsigned n_lists = lists_amount();
+    file.write(INDEX_MAGIC, sizeof(INDEX_MAGIC));
+    file.write(reinterpret_cast<const char *>(&INDEX_VERSION), sizeof(unsigned));
+    file.write(reinterpret_cast<const char *>(&embedding_dim), sizeof(unsigned));
+    file.write(reinterpret_cast<const char *>(&rows), sizeof(unsigned));
+    file.write(reinterpret_cast<const char *>(&n_lists), sizeof(unsigned));
+    file.write(reinterpret_cast<const char *>(&table_identity), sizeof(std::uint64_t));
+    file.write(reinterpret_cast<const char *>(centroids.data()), centroids.size() * sizeof(float));
+    for (const auto &list : lists)
+    {
+        unsigned list_size = list.size();
+        file.write(reinterpret_cast<const char *>(&list_size), sizeof(unsigned));
+        file.write(reinterpret_cast<const char *>(list.data()), list.size() * sizeof(unsigned));
+    }
+    file.close();
+    if (!file || std::rename(temp_path.c_str(), path.c_str()) != 0)
+    {
+        std::remove(temp_path.c_str());
+        throw std::runtime_error("Can not write embedding index to " + path);
+    }
+}
+
+bool EmbeddingIndex::load(const std::string &path, const unsigned max_rows, const std::uint64_t table_identity)
+{
+    std::ifstream file(path, std::ios::binary);
+    if (!file)
+        return false;
+    char magic[4];
+    unsigned version, dim, rows_amount, n_lists;
+    std::uint64_t saved_identity;
+    file.read(magic, sizeof(magic));
+    file.read(reinterpret_cast<char *>(&version), sizeof(unsigned));
+    file.read(reinterpret_cast<char *>(&dim), sizeof(unsigned));
+    file.read(reinterpret_cast<char *>(&rows_amount), sizeof(unsigned));
+    file.read(reinterpret_cast<char *>(&n_lists), sizeof(unsigned));
+    file.read(reinterpret_cast<char *>(&saved_identity), sizeof(std::uint64_t));
+    if (!file || !std::equal(magic, magic + 4, INDEX_MAGIC) || version != INDEX_VERSION || dim != embedding_dim ||
+        saved_identity != table_identity || rows_amount > max_rows)
+        return false;
+
+    std::vector<float> loaded_centroids(n_lists * embedding_dim);
+    std::vector<std::vector<unsigned>> loaded_lists(n_lists);
+    file.read(reinterpret_cast<char *>(loaded_centroids.data()), loaded_centroids.size() * sizeof(float));
+    for (auto &list : loaded_lists)
+    {
+        unsigned list_size = 0;
+        file.read(reinterpret_cast<char *>(&list_size), sizeof(unsigned));
+        if (!file || list_size > rows_amount)
+            return false;
+        list.resize(list_size);
+        file.read(reinterpret_cast<char *>(list.data()), list_size * sizeof(unsigned));
+    }
+    if (!file)
+        return false;
+    rows = rows_amount;
+    centroids.swap(loaded_centroids);
+    lists.swap(loaded_lists);
+    return true;
+}
@@ -0,0 +1,155 @@
+#include <embedding_matrix.hpp>
+#include <cstdio>
+#include <fstream>
+#include <algorithm>
+
+static const char MATRIX_MAGIC[4] = {'G', 'E', 'M', 'B'};
+static const std::uint32_t MATRIX_VERSION = 2;
+
+// Arrays go right after the header and stay 8 bytes aligned
+struct MatrixHeader
+{
+    char magic[4];
+    std::uint32_t version;
+    std::uint32_t embedding_dim;
+    std::uint32_t reserved;
+    std::uint64_t table_identity;
+    std::uint64_t rows;
+};
+
+EmbeddingMatrix::EmbeddingMatrix(const unsigned dim_embedding)
+{
+    embedding_dim = dim_embedding;
+    rows = 0;
+    identity = 0;
+    point_to_own();
+}
+
+void EmbeddingMatrix::point_to_own()
+{
+    row_ids_data = own_row_ids.data();
+    locations_data = own_locations.data();
+    embeddings_data = own_embeddings.data();
+}
+
+void EmbeddingMatrix::detach()
+{
+    if (!file.is_open())
+        return;
+    own_row_ids.assign(row_ids_data, row_ids_data + rows);
+    own_locations.assign(locations_data, locations_data + 2 * static_cast<size_t>(rows));
+    own_embeddings.assign(embeddings_data, embeddings_data + static_cast<size_t>(rows) * embedding_dim);
+    file.close();
+    point_to_own();
+}
+
+void EmbeddingMatrix::clear()
+{
+    file.close();
+    rows = 0;
+    identity = 0;
+    own_row_ids.clear();
+    own_locations.clear();
+    own_embeddings.clear();
+    point_to_own();
+}
+
+unsigned EmbeddingMatrix::size() const
+{
+    return rows;
+}
+
+std::int64_t EmbeddingMatrix::last_row_id() const
+{
+    return rows ? row_ids_data[rows - 1] : 0;
+}
+
+std::uint64_t EmbeddingMatrix::table_identity() const
+{
+    return identity;
+}
+
+void EmbeddingMatrix::set_table_identity(const std::uint64_t new_identity)
+{
+    identity = new_identity;
+}
+
+const std::int64_t *EmbeddingMatrix::row_ids() const
+{
+    return row_ids_data;
+}
+
+const double *EmbeddingMatrix::locations() const
+{
+    return locations_data;
+}
+
+const float *EmbeddingMatrix::embeddings() const
+{
+    return embeddings_data;
+}
+
+void EmbeddingMatrix::append(const std::int64_t row_id, const double lon, const double lat, const std::vector<double> &embedding)
+{
+    std::vector<float> embedding_float(embedding.begin(), embedding.end());
+    append(row_id, lon, lat, embedding_float.data());
+}
+
+void EmbeddingMatrix::append(const std::int64_t row_id, const double lon, const double lat, const float *embedding)
+{
+    detach();
+    own_row_ids.push_back(row_id);
+    own_locations.push_back(lon);
+    own_locations.push_back(lat);
+    own_embeddings.insert(own_embeddings.end(), embedding, embedding + embedding_dim);
+    rows += 1;
+    point_to_own();
+}
+
+bool EmbeddingMatrix::load(const std::string &path)
+{
+    clear();
+    if (!file.open(path) || file.size() < sizeof(MatrixHeader))
+    {
+        file.close();
+        return false;
+    }
+    const MatrixHeader *header = reinterpret_cast<const MatrixHeader *>(file.data());
+    size_t row_size = sizeof(std::int64_t) + 2 * sizeof(double) + embedding_dim * sizeof(float);
+    if (!std::equal(header->magic, header->magic + 4, MATRIX_MAGIC) || header->version != MATRIX_VERSION ||
+        header->embedding_dim != embedding_dim || file.size() != sizeof(MatrixHeader) + header->rows * row_size)
+    {
+        file.close();
+        return false;
+    }
+
+    rows = header->rows;
+    identity = header->table_identity;
+    const char *data = file.data() + sizeof(MatrixHeader);
+    row_ids_data = reinterpret_cast<const std::int64_t *>(data);
+    locations_data = reinterpret_cast<const double *>(data + rows * sizeof(std::int64_t));
+    embeddings_data = reinterpret_cast<const float *>(data + rows * (sizeof(std::int64_t) + 2 * sizeof(double)));
+    return true;
+}
+
+void EmbeddingMatrix::save(const std::string &path) const
+{
+    // Written next to the old file and renamed over it, so a mapped matrix is never seen half written
+    std::string temp_path = temporary_path(path);
+    bool output_written;
+    {
+        std::ofstream output(temp_path, std::ios::binary | std::ios::trunc);
+        MatrixHeader header = {{MATRIX_MAGIC[0], MATRIX_MAGIC[1], MATRIX_MAGIC[2], MATRIX_MAGIC[3]}, MATRIX_VERSION, embedding_dim, 0, identity, rows};
+        output.write(reinterpret_cast<const char *>(&header), sizeof(header));
+        output.write(reinterpret_cast<const char *>(row_ids_data), rows * sizeof(std::int64_t));
+        output.write(reinterpret_cast<const char *>(locations_data), 2 * static_cast<size_t>(rows) * sizeof(double));
+        output.write(reinterpret_cast<const char *>(embeddings_data), static_cast<size_t>(rows) * embedding_dim * sizeof(float));
+        output.close();
+        output_written = static_cast<bool>(output);
+    }
+    if (!output_written || std::rename(temp_path.c_str(), path.c_str()) != 0)
+    {
+        std::remove(temp_path.c_str());
+        throw std::runtime_error("Can not write embedding matrix to " + path);
+    }
+}
@@ -0,0 +1,157 @@
+#include <geomap_db.hpp>
+#include <location_seeker.hpp>
+#include <string>
+#include <vector>
+#include <fstream>
+#include <sstream>
+#include <chrono>
+#include <iostream>
+#include <stdexcept>
+
+// Times GeomapDB and LocationSeeker on a prepared database, made by py_src/benchmark.py.
+// Queries file has a line "lon lat embedding..." per query in the order of the table columns,
+// frames file has a line "lon lat image_path" per frame. Like the table, lon holds the latitude.
+// Prints one JSON line of samples in ms for every stage.
+// Usage: ./geomap_benchmark db_name queries_file eps [frames_file]
+
+const unsigned FRAME_OBJECTS = 16;
+
+struct Query
+{
+    double lon, lat;
+    std::vector<double> embedding;
+};
+
+struct Frame
+{
+    double lon, lat;
+    std::string path;
+};
+
+std::vector<Query> read_queries(const std::string &file_name)
+{
+    std::ifstream file(file_name);
+    if (!file)
+        throw std::runtime_error("Can not open queries file " + file_name);
+    std::vector<Query> queries;
+    std::string line;
+    while (std::getline(file, line))
+    {
+        std::istringstream fields(line);
+        Query query;
+        if (!(fields >> query.lon >> query.lat))
+            continue;
+        double cord;
+        while (fields >> cord)
+            query.embedding.push_back(cord);
+        queries.push_back(query);
+    }
+    if (queries.empty())
+        throw std::runtime_error("Queries file " + file_name + " is empty");
+    return queries;
+}
+
+std::vector<Frame> read_frames(const std::string &file_name)
+{
+    std::ifstream file(file_name);
+    if (!file)
+        throw std::runtime_error("Can not open frames file " + file_name);
+    std::vector<Frame> frames;
+    std::string line;
+    while (std::getline(file, line))
+    {
+        std::istringstream fields(line);
+        Frame frame;
+        if (!(fields >> frame.lon >> frame.lat >> std::ws) || !std::getline(fields, frame.path))
+            continue;
+        frames.push_back(frame);
+    }
+    return frames;
+}
+
+double elapsed_ms(const std::chrono::steady_clock::time_point &start)
+{
+    return std::chrono::duration<double, std::milli>(std::chrono::steady_clock::now() - start).count();
+}
+
+void print_samples(std::ostream &os, const std::string &stage, const std::vector<double> &samples, const bool last = false)
+{
+    os << "\"" << stage << "\": [";
+    for (size_t i = 0; i < samples.size(); ++i)
+        os << (i ? ", " : "") << samples[i];
+    os << "]" << (last ? "" : ", ");
+}
+
+int main(int argc, char *argv[])
+{
+    if (argc != 4 && argc != 5)
+        throw std::runtime_error("Input must be in form of (db_name queries_file eps [frames_file])");
+    std::string db_name = argv[1];
+    std::vector<Query> queries = read_queries(argv[2]);
+    double eps = std::stod(argv[3]);
+    std::vector<Frame> frames = argc == 5 ? read_frames(argv[4]) : std::vector<Frame>();
+    const unsigned embedding_dim = queries[0].embedding.size();
+
+    // The first open builds the cached matrix, grid and index, the second one maps them
+    std::vector<double> open_cold, open_warm, closest, closest_frame, update_embeddings, update_frame;
+    auto start = std::chrono::steady_clock::now();
+    {
+        GeomapDB geomap(embedding_dim, db_name, "geomap_embeddings", true);
+        open_cold.push_back(elapsed_ms(start));
+    }
+    start = std::chrono::steady_clock::now();
+    {
+        GeomapDB geomap(embedding_dim, db_name, "geomap_embeddings", true);
+        open_warm.push_back(elapsed_ms(start));
+
+        for (const auto &query : queries)
+        {
+            start = std::chrono::steady_clock::now();
+            geomap.get_closest_most_similar_object(query.lon, query.lat, eps, query.embedding);
+            closest.push_back(elapsed_ms(start));
+        }
+        // A frame asks for all its buildings around one location at once
+        for (size_t first = 0; first + FRAME_OBJECTS <= queries.size(); first += FRAME_OBJECTS)
+        {
+            std::vector<std::vector<double>> embeddings;
+            for (size_t i = first; i < first + FRAME_OBJECTS; ++i)
+                embeddings.push_back(queries[i].embedding);
+            start = std::chrono::steady_clock::now();
+            geomap.get_closest_most_similar_objects(queries[first].lon, queries[first].lat, eps, embeddings);
+            closest_frame.push_back(elapsed_ms(start));
+        }
+    }
+
+    LocationSeeker seeker(embedding_dim, db_name, queries[0].lon, queries[0].lat);
+    for (size_t first = 0; first + FRAME_OBJECTS <= queries.size(); first += FRAME_OBJECTS)
+    {
+        std::vector<std::vector<double>> embeddings;
+        for (size_t i = first; i < first + FRAME_OBJECTS; ++i)
+            embeddings.push_back(queries[i].embedding);
+        seeker.set_current_location(queries[first].lon, queries[first].lat);
+        start = std::chrono::steady_clock::now();
+        seeker.update_current_location(embeddings, eps);
+        update_embeddings.push_back(elapsed_ms(start));
+    }
+    if (!frames.empty())
+    {
+        seeker.warm_up();
+        for (const auto &frame : frames)
+        {
+            seeker.set_current_location(frame.lon, frame.lat);
+            start = std::chrono::steady_clock::now();
+            seeker.update_current_location(frame.path, eps);
+            update_frame.push_back(elapsed_ms(start));
+        }
+    }
+
+    std::cout << "{";
+    print_samples(std::cout, "open_cold", open_cold);
+    print_samples(std::cout, "open_warm", open_warm);
+    print_samples(std::cout, "get_closest_most_similar_object", closest);
+    print_samples(std::cout, "get_closest_most_similar_objects", closest_frame);
+    print_samples(std::cout, "update_current_location_embeddings", update_embeddings);
+    print_samples(std::cout, "update_current_location_frame", update_frame, true);
+    std::cout << "}" << std::endl;
+    return 0;
+}
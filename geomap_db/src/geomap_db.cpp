@@ -1,16 +1,53 @@
 #include <geomap_db.hpp>
 
-GeomapDB::GeomapDB(const unsigned dim_embedding, const std::string &database_name, const std::string &tbl_name = "geomap_embeddings")
+constexpr const char *GeomapDB::IDENTITY_TABLE_NAME;
+
+GeomapDB::GeomapDB(const unsigned dim_embedding, const std::string &database_name, const std::string &tbl_name = "geomap_embeddings", const bool is_read_only) : index(dim_embedding), matrix(dim_embedding)
 {
+    ScopedTimer timer("db_open");
     db_name = database_name;
     table_name = tbl_name;
     embedding_dim = dim_embedding;
+    read_only = is_read_only;
+    transaction_depth = 0;
+    index_path = db_name + "." + table_name + ".ivf";
+    matrix_path = db_name + "." + table_name + ".emb";
+    grid_path = db_name + "." + table_name + ".grid";
+    index_changed = false;
+    matrix_changed = false;
+    grid_changed = false;
+    rows_reloaded = false;
+    table_identity = 0;
     connection();
     create_table();
+    load_rows();
+    load_index();
 }
 
 GeomapDB::~GeomapDB()
 {
+    if (transaction_depth)
+    {
+        transaction_depth = 1;
+        commit_transaction();
+    }
+    try
+    {
+        if (matrix_changed)
+            matrix.save(matrix_path);
+        if (grid_changed)
+            grid.save(grid_path, table_identity);
+        if (index_changed)
+            index.save(index_path, table_identity);
+    }
+    catch (const std::exception &error)
+    {
+        std::cerr << "Saving index error: " << error.what() << std::endl;
+    }
+    for (const auto &statement : statements)
+    {
+        sqlite3_finalize(statement.second);
+    }
     int rc = sqlite3_close(db);
     if (rc != SQLITE_OK)
     {
@@ -20,139 +57,481 @@ GeomapDB::~GeomapDB()
 
 std::ostream &GeomapDB::print_db(std::ostream &os)
 {
-    std::string query = "SELECT * FROM " + table_name;
+    std::string query = "SELECT lon, lat, embedding FROM " + table_name + ";";
     std::vector<std::vector<double>> rows = select(query);
+    std::streamsize precision = os.precision(PRINT_PRECISION);
     os << table_name << std::endl;
-    for (const auto row : rows)
+    for (const auto &row : rows)
     {
         for (const auto element : row)
         {
-            os << std::to_string(element) << "; ";
+            os << element << "; ";
         }
         os << std::endl;
     }
+    os.precision(precision);
     return os;
 }
 
-std::string GeomapDB::get_closest_condition(const double lon, const double lat, const double eps)
+std::vector<float> GeomapDB::to_query(const std::vector<double> &embedding)
 {
-    std::string lon_condition = std::to_string(lon - eps) + " <= lon AND lon <= " + std::to_string(lon + eps);
-    std::string lat_condition = std::to_string(lat - eps) + " <= lat AND lat <= " + std::to_string(lat + eps);
-    std::string condition = lon_condition + " AND " + lat_condition;
-    return condition;
+    if (embedding.size() != embedding_dim)
+        throw std::runtime_error("Embedding must have " + std::to_string(embedding_dim) + " cords, " + std::to_string(embedding.size()) + " were given!");
+    return std::vector<float>(embedding.begin(), embedding.end());
 }
 
-std::string GeomapDB::get_embedding_distances_table(const std::vector<double> &embedding)
+void GeomapDB::connection()
 {
-    if (embedding.size() != embedding_dim)
-        throw std::runtime_error("Embedding must have " + std::to_string(embedding_dim) + " cords, " + std::to_string(embedding.size()) + " were given!");
-    std::string condition = "SELECT *, (";
-    for (int i = 0; i < embedding_dim; ++i)
+    // Writers switch the database to WAL, so readers do not block them and each other
+    int flags = read_only ? SQLITE_OPEN_READONLY : SQLITE_OPEN_READWRITE | SQLITE_OPEN_CREATE;
+    int rc = sqlite3_open_v2(db_name.c_str(), &db, flags, NULL);
+    if (rc != SQLITE_OK)
     {
-        condition += "ABS(embedding" + std::to_string(i) + " - " + std::to_string(embedding[i]) + ")";
-        if (i < embedding_dim - 1)
-            condition += " + ";
-        else
-            condition += ") AS embedding_distance FROM " + table_name;
+        std::cerr << "Connection error: " << sqlite3_errmsg(db) << std::endl;
+        return;
+    }
+    sqlite3_busy_timeout(db, BUSY_TIMEOUT_MS);
+    if (!read_only)
+    {
+        execute("PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;", "Connection");
     }
-    return condition;
 }
 
-void GeomapDB::connection()
+bool GeomapDB::execute(const std::string &query, const std::string &action)
 {
-    int rc = sqlite3_open(db_name.c_str(), &db);
+    char *err = NULL;
+    int rc = sqlite3_exec(db, query.c_str(), NULL, NULL, &err);
     if (rc != SQLITE_OK)
     {
-        std::cerr << "Connection error: " << sqlite3_errmsg(db) << std::endl;
+        std::cerr << action << " error: " << (err ? err : sqlite3_errmsg(db)) << std::endl;
+        sqlite3_free(err);
+        return false;
     }
+    return true;
 }
 
-void GeomapDB::create_table()
+sqlite3_stmt *GeomapDB::prepare(const std::string &query)
 {
-    std::string embedding_init = "";
-    for (int i = 0; i < embedding_dim; ++i)
+    // Statements are prepared once per connection and reset before every use
+    auto cached = statements.find(query);
+    if (cached != statements.end())
     {
-        embedding_init += ", embedding" + std::to_string(i) + " DOUBLE";
+        sqlite3_reset(cached->second);
+        sqlite3_clear_bindings(cached->second);
+        return cached->second;
     }
-    std::string query = "CREATE TABLE IF NOT EXISTS " + table_name + "(lon DOUBLE, lat DOUBLE" + embedding_init + ");";
-    int rc = sqlite3_exec(db, query.c_str(), NULL, NULL, &err);
+    sqlite3_stmt *stmt = NULL;
+    int rc = sqlite3_prepare_v2(db, query.c_str(), -1, &stmt, 0);
     if (rc != SQLITE_OK)
     {
-        std::cerr << "Creating table error: " << err << std::endl;
+        return NULL;
     }
+    statements[query] = stmt;
+    return stmt;
 }
 
-void GeomapDB::insert(const double lon, const double lat, const std::vector<double> &embedding)
+void GeomapDB::begin_transaction()
 {
-    std::string values = std::to_string(lon) + ", " + std::to_string(lat);
-    for (const auto cord : embedding)
+    // Transactions can be nested, only the outermost one is real
+    if (transaction_depth++ == 0)
     {
-        values += ", " + std::to_string(cord);
+        execute("BEGIN TRANSACTION;", "Transaction");
     }
-    std::string query = "INSERT INTO " + table_name + " VALUES(" + values + ");";
+}
 
-    int rc = sqlite3_exec(db, query.c_str(), NULL, NULL, &err);
+void GeomapDB::commit_transaction()
+{
+    if (transaction_depth && --transaction_depth == 0)
+    {
+        execute("COMMIT;", "Transaction");
+    }
+}
 
-    if (rc != SQLITE_OK)
+void GeomapDB::create_table()
+{
+    // Tables of older versions kept every embedding cord in its own DOUBLE column
+    if (has_column("embedding0"))
+    {
+        if (read_only)
+            throw std::runtime_error("Table " + table_name + " of " + db_name + " has to be migrated, run ./print_table --migrate next to it once");
+        // Cords beyond embedding_dim would be dropped by the migration and missing ones read as zeros
+        if (!has_column("embedding" + std::to_string(embedding_dim - 1)) || has_column("embedding" + std::to_string(embedding_dim)))
+            throw std::runtime_error("Table " + table_name + " has embeddings of another dimension than " + std::to_string(embedding_dim));
+        migrate_table();
+    }
+    if (read_only)
+        return;
+    execute("CREATE TABLE IF NOT EXISTS " + table_name + "(lon DOUBLE, lat DOUBLE, embedding BLOB);", "Creating table");
+    create_identity();
+}
+
+// A table made anew gets a new token, so caches of a deleted database with the same rowids are not taken for its own.
+// Appended rows keep the identity, updated and deleted rows are counted by triggers, so writers which do not bump
+// user_version are noticed too. py_src/geomap_sync.py creates the same table and triggers
+void GeomapDB::create_identity()
+{
+    std::string identity_table = IDENTITY_TABLE_NAME;
+    std::string changed = " BEGIN UPDATE " + identity_table + " SET changes = changes + 1 WHERE table_name = '" + table_name + "'; END;";
+    execute("CREATE TABLE IF NOT EXISTS " + identity_table + "(table_name TEXT PRIMARY KEY, token INTEGER, changes INTEGER);"
+            "INSERT OR IGNORE INTO " + identity_table + " VALUES('" + table_name + "', random(), 0);"
+            "CREATE TRIGGER IF NOT EXISTS " + table_name + "_updated AFTER UPDATE ON " + table_name + changed +
+            "CREATE TRIGGER IF NOT EXISTS " + table_name + "_deleted AFTER DELETE ON " + table_name + changed,
+            "Creating table identity");
+}
+
+bool GeomapDB::has_column(const std::string &column_name)
+{
+    sqlite3_stmt *stmt = prepare("PRAGMA table_info(" + table_name + ");");
+    bool found = false;
+    if (!stmt)
+    {
+        return found;
+    }
+    while (sqlite3_step(stmt) == SQLITE_ROW)
+    {
+        found = found || column_name == reinterpret_cast<const char *>(sqlite3_column_text(stmt, 1));
+    }
+    sqlite3_reset(stmt);
+    return found;
+}
+
+void GeomapDB::migrate_table()
+{
+    std::cout << "Migrating " << table_name << " to float32 embeddings" << std::endl;
+    std::string legacy_name = table_name + "_legacy";
+    if (!execute("BEGIN TRANSACTION; ALTER TABLE " + table_name + " RENAME TO " + legacy_name + "; CREATE TABLE " + table_name + "(lon DOUBLE, lat DOUBLE, embedding BLOB);", "Migration"))
+    {
+        execute("ROLLBACK;", "Migration");
+        return;
+    }
+
+    // One-off statements, they are not cached
+    sqlite3_stmt *select_stmt, *insert_stmt;
+    std::string query = "INSERT INTO " + table_name + "(rowid, lon, lat, embedding) VALUES(?, ?, ?, ?);";
+    sqlite3_prepare_v2(db, query.c_str(), -1, &insert_stmt, 0);
+    query = "SELECT rowid, * FROM " + legacy_name + ";";
+    sqlite3_prepare_v2(db, query.c_str(), -1, &select_stmt, 0);
+    std::vector<float> embedding(embedding_dim);
+    bool failed = false;
+    while (!failed && sqlite3_step(select_stmt) == SQLITE_ROW)
+    {
+        for (int i = 0; i < embedding_dim; ++i)
+        {
+            embedding[i] = sqlite3_column_double(select_stmt, i + 3);
+        }
+        sqlite3_bind_int64(insert_stmt, 1, sqlite3_column_int64(select_stmt, 0));
+        sqlite3_bind_double(insert_stmt, 2, sqlite3_column_double(select_stmt, 1));
+        sqlite3_bind_double(insert_stmt, 3, sqlite3_column_double(select_stmt, 2));
+        sqlite3_bind_blob(insert_stmt, 4, embedding.data(), embedding_dim * sizeof(float), SQLITE_TRANSIENT);
+        failed = sqlite3_step(insert_stmt) != SQLITE_DONE;
+        sqlite3_reset(insert_stmt);
+    }
+    sqlite3_finalize(select_stmt);
+    sqlite3_finalize(insert_stmt);
+
+    if (failed)
+    {
+        std::cerr << "Migration error: " << sqlite3_errmsg(db) << std::endl;
+        execute("ROLLBACK;", "Migration");
+        return;
+    }
+    execute("DROP TABLE " + legacy_name + "; COMMIT; VACUUM;", "Migration");
+}
+
+sqlite3_int64 GeomapDB::get_last_row_id()
+{
+    sqlite3_stmt *stmt = prepare("SELECT max(rowid) FROM " + table_name + ";");
+    sqlite3_int64 last_row_id = 0;
+    if (stmt && sqlite3_step(stmt) == SQLITE_ROW)
+    {
+        last_row_id = sqlite3_column_int64(stmt, 0);
+    }
+    if (stmt)
+    {
+        sqlite3_reset(stmt);
+    }
+    return last_row_id;
+}
+
+// Writers that delete or rewrite rows bump user_version of the database, appended rows do not change it
+std::uint32_t GeomapDB::get_data_version()
+{
+    sqlite3_stmt *stmt = prepare("PRAGMA user_version;");
+    std::uint32_t data_version = 0;
+    if (stmt && sqlite3_step(stmt) == SQLITE_ROW)
+    {
+        data_version = sqlite3_column_int64(stmt, 0);
+    }
+    if (stmt)
+    {
+        sqlite3_reset(stmt);
+    }
+    return data_version;
+}
+
+// Token and changes of the table with user_version, 64 bits of FNV-1a. Tables of databases made before the identity
+// table existed, which are opened only for reading, are known by user_version alone
+std::uint64_t GeomapDB::get_table_identity()
+{
+    std::int64_t values[3] = {0, 0, get_data_version()};
+    sqlite3_stmt *stmt = prepare(std::string("SELECT token, changes FROM ") + IDENTITY_TABLE_NAME + " WHERE table_name = ?;");
+    if (stmt)
+    {
+        sqlite3_bind_text(stmt, 1, table_name.c_str(), -1, SQLITE_TRANSIENT);
+        if (sqlite3_step(stmt) == SQLITE_ROW)
+        {
+            values[0] = sqlite3_column_int64(stmt, 0);
+            values[1] = sqlite3_column_int64(stmt, 1);
+        }
+        sqlite3_reset(stmt);
+    }
+    std::uint64_t identity = 14695981039346656037ULL;
+    const unsigned char *bytes = reinterpret_cast<const unsigned char *>(values);
+    for (size_t i = 0; i < sizeof(values); ++i)
     {
-        std::cerr << "Insertion error: " << err << std::endl;
+        identity ^= bytes[i];
+        identity *= 1099511628211ULL;
     }
+    return identity;
+}
+
+void GeomapDB::load_rows()
+{
+    // The matrix and the grid are mapped as they are, if they were saved for this table in its current state,
+    // otherwise only the rows they lack are read from the table
+    sqlite3_int64 last_row_id = get_last_row_id();
+    table_identity = get_table_identity();
+    bool is_matrix_valid = matrix.load(matrix_path) && matrix.table_identity() == table_identity && matrix.last_row_id() <= last_row_id;
+    if (!is_matrix_valid)
+    {
+        matrix.clear();
+        matrix.set_table_identity(table_identity);
+        matrix_changed = true;
+        rows_reloaded = true;
+    }
+    if (matrix.last_row_id() < last_row_id)
+    {
+        sqlite3_stmt *stmt = prepare("SELECT rowid, lon, lat, embedding FROM " + table_name + " WHERE rowid > ? ORDER BY rowid;");
+        if (!stmt)
+        {
+            std::cerr << "Loading rows error: " << sqlite3_errmsg(db) << std::endl;
+            return;
+        }
+        sqlite3_bind_int64(stmt, 1, matrix.last_row_id());
+        while (sqlite3_step(stmt) == SQLITE_ROW)
+        {
+            if (sqlite3_column_bytes(stmt, 3) != embedding_dim * sizeof(float))
+            {
+                std::cerr << "Loading rows error: row " << sqlite3_column_int64(stmt, 0) << " has embedding of wrong size" << std::endl;
+                continue;
+            }
+            const float *embedding = static_cast<const float *>(sqlite3_column_blob(stmt, 3));
+            matrix.append(sqlite3_column_int64(stmt, 0), sqlite3_column_double(stmt, 1), sqlite3_column_double(stmt, 2), embedding);
+        }
+        sqlite3_reset(stmt);
+        matrix_changed = true;
+    }
+    if (!is_matrix_valid || !grid.load(grid_path, matrix.size(), table_identity))
+    {
+        grid.clear();
+    }
+    for (unsigned position = grid.size(); position < matrix.size(); ++position)
+    {
+        grid.add(matrix.locations()[2 * position], matrix.locations()[2 * position + 1], position);
+        grid_changed = true;
+    }
+}
+
+void GeomapDB::load_index()
+{
+    // The index can be behind the table, if rows were added without it, then they are added now.
+    // Positions of reloaded rows can differ from the saved ones, so their index is built anew
+    if (rows_reloaded || !index.load(index_path, matrix.size(), table_identity))
+    {
+        index.build(matrix.embeddings(), matrix.size());
+        index_changed = true;
+    }
+    for (unsigned position = index.size(); position < matrix.size(); ++position)
+    {
+        index.add(matrix.embeddings() + static_cast<size_t>(position) * embedding_dim, position);
+        index_changed = true;
+    }
+    update_index();
+}
+
+void GeomapDB::update_index()
+{
+    // Tables filled from scratch start with a flat index, it is clustered once it is big enough
+    if (index.is_flat() && index.size() >= EmbeddingIndex::MIN_ROWS)
+    {
+        index.build(matrix.embeddings(), matrix.size());
+        index_changed = true;
+    }
+}
+
+void GeomapDB::append_row(const sqlite3_int64 row_id, const double lon, const double lat, const std::vector<double> &embedding)
+{
+    unsigned position = matrix.size();
+    matrix.append(row_id, lon, lat, embedding);
+    grid.add(lon, lat, position);
+    index.add(matrix.embeddings() + static_cast<size_t>(position) * embedding_dim, position);
+    matrix_changed = true;
+    grid_changed = true;
+    index_changed = true;
+}
+
+std::vector<double> GeomapDB::get_row(const unsigned position)
+{
+    std::vector<double> row = {matrix.locations()[2 * position], matrix.locations()[2 * position + 1]};
+    const float *embedding = matrix.embeddings() + static_cast<size_t>(position) * embedding_dim;
+    row.insert(row.end(), embedding, embedding + embedding_dim);
+    return row;
+}
+
+void GeomapDB::insert(const double lon, const double lat, const std::vector<double> &embedding)
+{
+    std::vector<double> row = {lon, lat};
+    row.insert(row.end(), embedding.begin(), embedding.end());
+    insert_many({row});
+}
+
+void GeomapDB::insert_many(const std::vector<std::vector<double>> &rows)
+{
+    sqlite3_stmt *stmt = prepare("INSERT INTO " + table_name + "(lon, lat, embedding) VALUES(?, ?, ?);");
+    if (!stmt)
+    {
+        std::cerr << "Insertion error: " << sqlite3_errmsg(db) << std::endl;
+        return;
+    }
+    begin_transaction();
+    std::vector<float> embedding(embedding_dim);
+    for (const auto &row : rows)
+    {
+        if (row.size() != embedding_dim + 2)
+        {
+            std::cerr << "Insertion error: row must have " << embedding_dim + 2 << " values, " << row.size() << " were given" << std::endl;
+            continue;
+        }
+        std::copy(row.begin() + 2, row.end(), embedding.begin());
+        sqlite3_bind_double(stmt, 1, row[0]);
+        sqlite3_bind_double(stmt, 2, row[1]);
+        sqlite3_bind_blob(stmt, 3, embedding.data(), embedding_dim * sizeof(float), SQLITE_TRANSIENT);
+        if (sqlite3_step(stmt) != SQLITE_DONE)
+        {
+            std::cerr << "Insertion error: " << sqlite3_errmsg(db) << std::endl;
+        }
+        else
+        {
+            append_row(sqlite3_last_insert_rowid(db), row[0], row[1], std::vector<double>(row.begin() + 2, row.end()));
+        }
+        sqlite3_reset(stmt);
+    }
+    commit_transaction();
+    update_index();
 }
 
 std::vector<std::vector<double>> GeomapDB::get_closest_objects(const double lon, const double lat, const double eps)
 {
-    std::string condition = get_closest_condition(lon, lat, eps);
-    std::string query = "SELECT * FROM " + table_name + " WHERE " + condition + ";";
-    return select(query);
+    std::vector<std::vector<double>> result;
+    for (const auto position : grid.find(matrix.locations(), lon, lat, eps))
+    {
+        result.push_back(get_row(position));
+    }
+    return result;
 }
 
 std::vector<double> GeomapDB::get_most_similar_object(const std::vector<double> &embedding)
 {
-    std::string embedding_distance_table = get_embedding_distances_table(embedding);
-    std::string query = "SELECT * FROM (" + embedding_distance_table + " ORDER BY embedding_distance) DESC LIMIT 1;";
-    std::vector<std::vector<double>> result = select(query);
-    std::cout << result.size() << std::endl;
+    std::vector<std::vector<double>> result = get_most_similar_objects(embedding, 1);
     if (result.empty())
         return {};
-    else
-        return result[0];
+    result[0].pop_back();
+    return result[0];
+}
+
+std::vector<std::vector<double>> GeomapDB::get_most_similar_objects(const std::vector<double> &embedding, const unsigned k, const EmbeddingMetric metric, const unsigned nprobe)
+{
+    std::vector<float> query = to_query(embedding);
+    std::vector<std::vector<double>> result;
+    for (const auto &match : index.search(matrix.embeddings(), query.data(), k, metric, nprobe))
+    {
+        std::vector<double> row = get_row(match.second);
+        row.push_back(match.first);
+        result.push_back(row);
+    }
+    return result;
 }
 
 std::vector<double> GeomapDB::get_closest_most_similar_object(const double lon, const double lat, const double eps_loc, const std::vector<double> &embedding)
 {
-    std::string condition = get_closest_condition(lon, lat, eps_loc);
-    std::string embedding_distance_table = get_embedding_distances_table(embedding);
-    std::string query = "SELECT * FROM (" + embedding_distance_table + " WHERE " + condition + " ORDER BY embedding_distance) DESC LIMIT 1;";
-    std::vector<std::vector<double>> result = select(query);
-    if (result.empty())
-        return {};
-    else
-        return result[0];
+    std::vector<double> result = get_closest_most_similar_objects(lon, lat, eps_loc, {embedding})[0];
+    if (!result.empty())
+        result.pop_back();
+    return result;
+}
+
+// For every embedding returns its best match inside the eps box with the distance appended, or an empty row
+std::vector<std::vector<double>> GeomapDB::get_closest_most_similar_objects(const double lon, const double lat, const double eps_loc, const std::vector<std::vector<double>> &embeddings)
+{
+    std::vector<float> queries;
+    for (const auto &embedding : embeddings)
+    {
+        std::vector<float> query = to_query(embedding);
+        queries.insert(queries.end(), query.begin(), query.end());
+    }
+
+    // Candidates are found once for the whole frame and every candidate row is read once
+    std::vector<bool> found(embeddings.size(), false);
+    std::vector<unsigned> best_positions(embeddings.size(), 0);
+    std::vector<float> best_distances(embeddings.size(), 0);
+    for (const auto position : grid.find(matrix.locations(), lon, lat, eps_loc))
+    {
+        const float *row_embedding = matrix.embeddings() + static_cast<size_t>(position) * embedding_dim;
+        for (unsigned i = 0; i < embeddings.size(); ++i)
+        {
+            float row_distance = EmbeddingIndex::distance(queries.data() + i * embedding_dim, row_embedding, embedding_dim, EmbeddingMetric::L1);
+            if (!found[i] || row_distance < best_distances[i])
+            {
+                found[i] = true;
+                best_positions[i] = position;
+                best_distances[i] = row_distance;
+            }
+        }
+    }
+
+    std::vector<std::vector<double>> result(embeddings.size());
+    for (unsigned i = 0; i < embeddings.size(); ++i)
+    {
+        if (!found[i])
+            continue;
+        result[i] = get_row(best_positions[i]);
+        result[i].push_back(best_distances[i]);
+    }
+    return result;
 }
 
 std::vector<std::vector<double>> GeomapDB::select(const std::string &query)
 {
-    int rc = sqlite3_prepare_v2(db, query.c_str(), -1, &stmt, 0);
+    sqlite3_stmt *stmt = prepare(query);
     std::vector<std::vector<double>> result;
-    if (rc != SQLITE_OK)
+    if (!stmt)
     {
         return result;
     }
-    while (sqlite3_step(stmt) != SQLITE_DONE)
+    while (sqlite3_step(stmt) == SQLITE_ROW)
     {
         std::vector<double> row;
         double lon = sqlite3_column_double(stmt, 0);
         double lat = sqlite3_column_double(stmt, 1);
         row.push_back(lon);
         row.push_back(lat);
-        for (int i = 2; i < embedding_dim + 2; ++i)
+        const float *embedding = static_cast<const float *>(sqlite3_column_blob(stmt, 2));
+        if (sqlite3_column_bytes(stmt, 2) == embedding_dim * sizeof(float))
         {
-            double embedding_cord = sqlite3_column_double(stmt, i);
-            row.push_back(embedding_cord);
+            row.insert(row.end(), embedding, embedding + embedding_dim);
         }
         result.push_back(row);
     }
     sqlite3_reset(stmt);
-    sqlite3_finalize(stmt);
     return result;
 }
@@ -0,0 +1,82 @@
+#include <embedding_index.hpp>
+#include <string>
+#include <vector>
+#include <random>
+#include <chrono>
+#include <iostream>
+
+// Measures recall and latency of EmbeddingIndex against exhaustive search.
+// Usage: ./index_benchmark [rows] [queries] [k]
+int main(int argc, char *argv[])
+{
+    const unsigned EMBEDDING_DIMENSIONS = 16;
+    const unsigned CLUSTERS = 256;
+    unsigned rows = argc > 1 ? std::stoi(argv[1]) : 100000;
+    unsigned queries = argc > 2 ? std::stoi(argv[2]) : 1000;
+    unsigned k = argc > 3 ? std::stoi(argv[3]) : 10;
+
+    // PCA embeddings of buildings form clusters, so the synthetic ones do too
+    std::mt19937 generator(42);
+    std::normal_distribution<float> centers(0, 100), spread(0, 20), noise(0, 5);
+    std::vector<float> cluster_centers(CLUSTERS * EMBEDDING_DIMENSIONS);
+    for (auto &cord : cluster_centers)
+        cord = centers(generator);
+    std::vector<float> embeddings(static_cast<size_t>(rows) * EMBEDDING_DIMENSIONS);
+    std::uniform_int_distribution<unsigned> cluster_choice(0, CLUSTERS - 1), row_choice(0, rows - 1);
+    for (unsigned i = 0; i < rows; ++i)
+    {
+        unsigned cluster = cluster_choice(generator);
+        for (unsigned j = 0; j < EMBEDDING_DIMENSIONS; ++j)
+            embeddings[i * EMBEDDING_DIMENSIONS + j] = cluster_centers[cluster * EMBEDDING_DIMENSIONS + j] + spread(generator);
+    }
+    // Queries are noisy copies of stored embeddings, like buildings seen from the UAV
+    std::vector<float> query_embeddings(static_cast<size_t>(queries) * EMBEDDING_DIMENSIONS);
+    for (unsigned i = 0; i < queries; ++i)
+    {
+        unsigned row = row_choice(generator);
+        for (unsigned j = 0; j < EMBEDDING_DIMENSIONS; ++j)
+            query_embeddings[i * EMBEDDING_DIMENSIONS + j] = embeddings[row * EMBEDDING_DIMENSIONS + j] + noise(generator);
+    }
+
+    auto start = std::chrono::steady_clock::now();
+    EmbeddingIndex index(EMBEDDING_DIMENSIONS), flat(EMBEDDING_DIMENSIONS);
+    index.build(embeddings.data(), rows);
+    flat.build(embeddings.data(), 0);
+    for (unsigned i = 0; i < rows; ++i)
+        flat.add(embeddings.data() + static_cast<size_t>(i) * EMBEDDING_DIMENSIONS, i);
+    double build_seconds = std::chrono::duration<double>(std::chrono::steady_clock::now() - start).count();
+    std::cout << "rows " << rows << ", queries " << queries << ", k " << k << ", build " << build_seconds << " s" << std::endl;
+
+    const EmbeddingMetric metrics[] = {EmbeddingMetric::L1, EmbeddingMetric::L2};
+    const unsigned nprobes[] = {1, 2, 4, 8, 16, 32, 64};
+    for (const auto metric : metrics)
+    {
+        std::vector<std::vector<std::pair<float, unsigned>>> truth(queries);
+        start = std::chrono::steady_clock::now();
+        for (unsigned i = 0; i < queries; ++i)
+            truth[i] = flat.search(embeddings.data(), query_embeddings.data() + i * EMBEDDING_DIMENSIONS, k, metric);
+        double flat_us = std::chrono::duration<double, std::micro>(std::chrono::steady_clock::now() - start).count() / queries;
+        std::cout << (metric == EmbeddingMetric::L1 ? "L1" : "L2") << " flat: " << flat_us << " us/query" << std::endl;
+
+        for (const auto nprobe : nprobes)
+        {
+            unsigned hits_at_1 = 0, hits_at_k = 0;
+            start = std::chrono::steady_clock::now();
+            std::vector<std::vector<std::pair<float, unsigned>>> found(queries);
+            for (unsigned i = 0; i < queries; ++i)
+                found[i] = index.search(embeddings.data(), query_embeddings.data() + i * EMBEDDING_DIMENSIONS, k, metric, nprobe);
+            double index_us = std::chrono::duration<double, std::micro>(std::chrono::steady_clock::now() - start).count() / queries;
+            for (unsigned i = 0; i < queries; ++i)
+            {
+                if (!found[i].empty() && found[i][0].second == truth[i][0].second)
+                    hits_at_1 += 1;
+                for (const auto &match : found[i])
+                    for (const auto &expected : truth[i])
+                        hits_at_k += match.second == expected.second;
+            }
+            std::cout << "  nprobe " << nprobe << ": " << index_us << " us/query, recall@1 " << static_cast<double>(hits_at_1) / queries
+                      << ", recall@" << k << " " << static_cast<double>(hits_at_k) / (queries * k) << std::endl;
+        }
+    }
+    return 0;
+}
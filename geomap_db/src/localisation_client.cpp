@@ -0,0 +1,33 @@
+#include <localisation_socket.hpp>
+#include <string>
+#include <iostream>
+#include <stdexcept>
+#include <unistd.h>
+
+// Sends one frame to localisation_server and prints coordinates it returns.
+// Usage: ./localisation_client uav_input [lon lat] [--socket socket_path]
+int main(int argc, char *argv[])
+{
+    std::string socket_path = DEFAULT_LOCALISATION_SOCKET;
+    if (argc >= 3 && std::string(argv[argc - 2]) == "--socket")
+    {
+        socket_path = argv[argc - 1];
+        argc -= 2;
+    }
+    if (argc != 2 && argc != 4)
+        throw std::runtime_error("Input must be in form of (uav_input [lon lat] [--socket socket_path])");
+    std::string request = argv[1];
+    if (argc == 4)
+        request += " " + std::string(argv[2]) + " " + std::string(argv[3]);
+
+    int connection = connect_socket(socket_path);
+    std::string response;
+    if (!write_line(connection, request) || !read_line(connection, response))
+    {
+        close(connection);
+        throw std::runtime_error("Connection to " + socket_path + " was lost");
+    }
+    close(connection);
+    std::cout << response << std::endl;
+    return response.compare(0, 6, "error:") == 0;
+}
@@ -0,0 +1,193 @@
+#include <localisation_pipeline.hpp>
+#include <thread>
+
+static const char *STAGE_NAMES[] = {"decoding", "segmentation", "embedding", "matching", "latency"};
+// Names of the stages in the metrics log, where Python stages of segmentation and embedding are logged too
+static const char *METRIC_NAMES[] = {"pipeline_decoding", "pipeline_segmentation", "pipeline_embedding", "pipeline_matching", "pipeline_latency"};
+
+PythonValue &PythonValue::operator=(PythonValue &&other)
+{
+    reset();
+    value = std::move(other.value);
+    return *this;
+}
+
+PythonValue::~PythonValue()
+{
+    reset();
+}
+
+void PythonValue::reset()
+{
+    if (value)
+    {
+        py::gil_scoped_acquire gil;
+        value = py::object();
+    }
+}
+
+LocalisationPipeline::LocalisationPipeline(LocationSeeker &location_seeker, const PipelineOptions &pipeline_options)
+    : seeker(location_seeker), options(pipeline_options), image_processing(py::module_::import("py_src.image_processing")),
+      python_metrics(py::module_::import("py_src.metrics")), tracker(image_processing.attr("BuildingTracker")()),
+      decoded(pipeline_options.queue_size), segmented(pipeline_options.queue_size), embedded(pipeline_options.queue_size)
+{
+    dropped_amount = 0;
+    located_amount = 0;
+}
+
+void LocalisationPipeline::run(const std::string &source)
+{
+    started = std::chrono::steady_clock::now();
+    {
+        // Stages take the GIL only for their Python calls
+        py::gil_scoped_release release;
+        std::thread decoding(&LocalisationPipeline::decode, this, source);
+        std::thread segmentation(&LocalisationPipeline::segment, this);
+        std::thread embedding(&LocalisationPipeline::embed, this);
+        std::thread matching(&LocalisationPipeline::match, this);
+        decoding.join();
+        segmentation.join();
+        embedding.join();
+        matching.join();
+    }
+    report();
+}
+
+void LocalisationPipeline::add_stat(const Stage stage, const std::chrono::steady_clock::time_point &start, const long frame)
+{
+    double ms = std::chrono::duration<double, std::milli>(std::chrono::steady_clock::now() - start).count();
+    Metrics::instance().record(METRIC_NAMES[stage], ms, frame);
+    std::lock_guard<std::mutex> lock(stats_mutex);
+    stats[stage].count += 1;
+    stats[stage].total_ms += ms;
+    stats[stage].max_ms = std::max(stats[stage].max_ms, ms);
+}
+
+void LocalisationPipeline::report()
+{
+    std::lock_guard<std::mutex> lock(stats_mutex);
+    double seconds = std::chrono::duration<double>(std::chrono::steady_clock::now() - started).count();
+    std::cout << "Located " << located_amount << " frames (" << located_amount / seconds << " per second), dropped " << dropped_amount << std::endl;
+    for (unsigned stage = 0; stage < STAGES_AMOUNT; ++stage)
+    {
+        if (stats[stage].count)
+            std::cout << "  " << STAGE_NAMES[stage] << ": mean " << stats[stage].total_ms / stats[stage].count << " ms, max " << stats[stage].max_ms << " ms" << std::endl;
+    }
+}
+
+void LocalisationPipeline::decode(const std::string &source)
+{
+    try
+    {
+        PythonValue capture;
+        double fps;
+        {
+            py::gil_scoped_acquire gil;
+            py::tuple opened = image_processing.attr("open_video_source")(source);
+            capture = PythonValue(py::object(opened[0]));
+            fps = opened[1].cast<double>();
+        }
+        // Video files are read at their own pace, like a camera would give them
+        bool is_paced = options.drop_frames && fps > 0;
+        for (unsigned index = 0;; ++index)
+        {
+            if (is_paced)
+                std::this_thread::sleep_until(started + std::chrono::duration_cast<std::chrono::steady_clock::duration>(std::chrono::duration<double>(index / fps)));
+            Frame frame;
+            frame.index = index;
+            frame.captured = std::chrono::steady_clock::now();
+            {
+                py::gil_scoped_acquire gil;
+                frame.image = PythonValue(image_processing.attr("read_frame")(capture.value));
+                if (frame.image.value.is_none())
+                    break;
+            }
+            add_stat(DECODING, frame.captured, index);
+            if (!options.drop_frames)
+                decoded.push(std::move(frame));
+            else if (decoded.push_dropping(std::move(frame)))
+            {
+                Metrics::instance().count("frames_dropped", 1);
+                std::lock_guard<std::mutex> lock(stats_mutex);
+                dropped_amount += 1;
+            }
+        }
+    }
+    catch (const std::exception &error)
+    {
+        std::cerr << "Decoding error: " << error.what() << std::endl;
+    }
+    decoded.close();
+}
+
+void LocalisationPipeline::segment()
+{
+    Frame frame;
+    while (decoded.pop(frame))
+    {
+        auto start = std::chrono::steady_clock::now();
+        try
+        {
+            py::gil_scoped_acquire gil;
+            if (Metrics::instance().enabled())
+                python_metrics.attr("set_frame")(frame.index);
+            frame.crops = PythonValue(image_processing.attr("track_frame")(tracker.value, frame.image.value));
+            frame.image.value = py::object();
+        }
+        catch (const std::exception &error)
+        {
+            std::cerr << "Segmentation error on frame " << frame.index << ": " << error.what() << std::endl;
+            continue;
+        }
+        add_stat(SEGMENTATION, start, frame.index);
+        segmented.push(std::move(frame));
+    }
+    segmented.close();
+}
+
+void LocalisationPipeline::embed()
+{
+    Frame frame;
+    while (segmented.pop(frame))
+    {
+        auto start = std::chrono::steady_clock::now();
+        try
+        {
+            py::gil_scoped_acquire gil;
+            if (Metrics::instance().enabled())
+                python_metrics.attr("set_frame")(frame.index);
+            frame.objects = to_tracked_objects(tracker.value.attr("embed")(frame.crops.value));
+            frame.crops.value = py::object();
+        }
+        catch (const std::exception &error)
+        {
+            std::cerr << "Embedding error on frame " << frame.index << ": " << error.what() << std::endl;
+            continue;
+        }
+        add_stat(EMBEDDING, start, frame.index);
+        embedded.push(std::move(frame));
+    }
+    embedded.close();
+}
+
+void LocalisationPipeline::match()
+{
+    Frame frame;
+    while (embedded.pop(frame))
+    {
+        auto start = std::chrono::steady_clock::now();
+        std::vector<double> new_cords = seeker.update_current_location(frame.objects, options.location_eps, frame.index);
+        add_stat(MATCHING, start, frame.index);
+        add_stat(LATENCY, frame.captured, frame.index);
+        std::cout << "Frame " << frame.index << ": " << new_cords[0] << " " << new_cords[1] << std::endl;
+
+        bool is_report_time;
+        {
+            std::lock_guard<std::mutex> lock(stats_mutex);
+            located_amount += 1;
+            is_report_time = options.report_every && located_amount % options.report_every == 0;
+        }
+        if (is_report_time)
+            report();
+    }
+}
@@ -0,0 +1,76 @@
+#include <location_seeker.hpp>
+#include <localisation_socket.hpp>
+#include <string>
+#include <vector>
+#include <chrono>
+#include <cerrno>
+#include <cstring>
+#include <sstream>
+#include <iostream>
+#include <stdexcept>
+#include <unistd.h>
+#include <sys/socket.h>
+
+const unsigned EMBEDDING_DIMENSION = 16;
+const double LOCATION_EPS = 0.001;
+
+// Keeps the models and geomap.db loaded and answers localisation requests over a UNIX socket.
+// Usage: ./localisation_server lon lat [socket_path]
+int main(int argc, char *argv[])
+{
+    if (argc != 3 && argc != 4)
+        throw std::runtime_error("Input must be in form of (lon lat [socket_path])");
+    double start_lon = std::stod(argv[1]), start_lat = std::stod(argv[2]);
+    std::string socket_path = argc == 4 ? argv[3] : DEFAULT_LOCALISATION_SOCKET;
+
+    auto start = std::chrono::steady_clock::now();
+    LocationSeeker lock_seeker(EMBEDDING_DIMENSION, "geomap.db", start_lon, start_lat);
+    lock_seeker.warm_up();
+    std::cout << "Models and geomap were loaded in " << std::chrono::duration<double>(std::chrono::steady_clock::now() - start).count() << " s" << std::endl;
+
+    int server = listen_socket(socket_path);
+    std::cout << "Listening on " << socket_path << std::endl;
+    while (true)
+    {
+        int connection = accept(server, nullptr, nullptr);
+        if (connection < 0)
+        {
+            std::cerr << "Accepting error: " << std::strerror(errno) << std::endl;
+            continue;
+        }
+        std::string request;
+        while (read_line(connection, request))
+        {
+            // Request is "<uav_input> [lon lat]", given location replaces the tracked one
+            std::istringstream request_stream(request);
+            std::string uav_input;
+            double lon, lat;
+            request_stream >> uav_input;
+            if (request_stream >> lon >> lat)
+                lock_seeker.set_current_location(lon, lat);
+
+            std::string response;
+            start = std::chrono::steady_clock::now();
+            try
+            {
+                std::vector<double> new_cords = lock_seeker.update_current_location(uav_input, LOCATION_EPS);
+                std::ostringstream response_stream;
+                response_stream.precision(10);
+                response_stream << new_cords[0] << " " << new_cords[1];
+                response = response_stream.str();
+            }
+            catch (const std::exception &error)
+            {
+                // Python errors come with a traceback, only the message itself fits in a response line
+                std::string message = error.what();
+                response = "error: " + message.substr(0, message.find('\n'));
+                std::cerr << "Localisation error: " << message << std::endl;
+            }
+            std::cout << uav_input << " -> " << response << " in " << std::chrono::duration<double, std::milli>(std::chrono::steady_clock::now() - start).count() << " ms" << std::endl;
+            if (!write_line(connection, response))
+                break;
+        }
+        close(connection);
+    }
+    return 0;
+}
@@ -0,0 +1,77 @@
+#include <localisation_socket.hpp>
+#include <cerrno>
+#include <cstring>
+#include <unistd.h>
+#include <sys/socket.h>
+#include <sys/un.h>
+
+static sockaddr_un socket_address(const std::string &path)
+{
+    sockaddr_un address;
+    std::memset(&address, 0, sizeof(address));
+    address.sun_family = AF_UNIX;
+    if (path.size() >= sizeof(address.sun_path))
+        throw std::runtime_error("Socket path is too long: " + path);
+    std::strcpy(address.sun_path, path.c_str());
+    return address;
+}
+
+int listen_socket(const std::string &path)
+{
+    sockaddr_un address = socket_address(path);
+    int server = socket(AF_UNIX, SOCK_STREAM, 0);
+    if (server < 0)
+        throw std::runtime_error("Can not create socket: " + std::string(std::strerror(errno)));
+    // Socket file of the previous run is left behind if it was killed
+    unlink(path.c_str());
+    if (bind(server, reinterpret_cast<sockaddr *>(&address), sizeof(address)) != 0 || listen(server, 1) != 0)
+    {
+        close(server);
+        throw std::runtime_error("Can not listen on " + path + ": " + std::string(std::strerror(errno)));
+    }
+    return server;
+}
+
+int connect_socket(const std::string &path)
+{
+    sockaddr_un address = socket_address(path);
+    int client = socket(AF_UNIX, SOCK_STREAM, 0);
+    if (client < 0)
+        throw std::runtime_error("Can not create socket: " + std::string(std::strerror(errno)));
+    if (connect(client, reinterpret_cast<sockaddr *>(&address), sizeof(address)) != 0)
+    {
+        close(client);
+        throw std::runtime_error("Can not connect to " + path + ": " + std::string(std::strerror(errno)));
+    }
+    return client;
+}
+
+// Lines are short, so they are read byte by byte and nothing is left buffered between calls
+bool read_line(const int connection, std::string &line)
+{
+    line.clear();
+    char symbol;
+    while (true)
+    {
+        ssize_t received = recv(connection, &symbol, 1, 0);
+        if (received <= 0)
+            return false;
+        if (symbol == '\n')
+            return true;
+        line += symbol;
+    }
+}
+
+bool write_line(const int connection, const std::string &line)
+{
+    std::string message = line + "\n";
+    size_t sent = 0;
+    while (sent < message.size())
+    {
+        ssize_t result = send(connection, message.data() + sent, message.size() - sent, MSG_NOSIGNAL);
+        if (result <= 0)
+            return false;
+        sent += result;
+    }
+    return true;
+}
@@ -0,0 +1,176 @@
+#include <location_grid.hpp>
+#include <cmath>
+#include <cstdio>
+#include <map>
+#include <fstream>
+#include <algorithm>
+
+constexpr double LocationGrid::DEFAULT_CELL_SIZE;
+
+static const char GRID_MAGIC[4] = {'G', 'G', 'R', 'D'};
+static const std::uint32_t GRID_VERSION = 2;
+
+// Keys, offsets and positions go right after the header
+struct GridHeader
+{
+    char magic[4];
+    std::uint32_t version;
+    double cell_size;
+    std::uint64_t table_identity;
+    std::uint64_t rows;
+    std::uint64_t cells_amount;
+};
+
+LocationGrid::LocationGrid(const double size_of_cell)
+{
+    cell_size = size_of_cell;
+    clear();
+}
+
+std::int64_t LocationGrid::cell_index(const double cord) const
+{
+    return static_cast<std::int64_t>(std::floor(cord / cell_size));
+}
+
+std::uint64_t LocationGrid::cell_key(const std::int64_t lon_index, const std::int64_t lat_index)
+{
+    return (static_cast<std::uint64_t>(lon_index) << 32) | static_cast<std::uint32_t>(lat_index);
+}
+
+void LocationGrid::add(const double lon, const double lat, const unsigned position)
+{
+    cells[cell_key(cell_index(lon), cell_index(lat))].push_back(position);
+    rows += 1;
+}
+
+unsigned LocationGrid::size() const
+{
+    return rows;
+}
+
+void LocationGrid::clear()
+{
+    rows = 0;
+    cells.clear();
+    file.close();
+    loaded_cells_amount = 0;
+    loaded_keys = nullptr;
+    loaded_offsets = nullptr;
+    loaded_positions = nullptr;
+}
+
+// Returns positions of rows with |row_lon - lon| <= eps and |row_lat - lat| <= eps in increasing order
+std::vector<unsigned> LocationGrid::find(const double *locations, const double lon, const double lat, const double eps) const
+{
+    std::vector<unsigned> result;
+    auto check_positions = [&](const unsigned *begin, const unsigned *end)
+    {
+        for (const unsigned *position = begin; position != end; ++position)
+        {
+            double row_lon = locations[2 * *position], row_lat = locations[2 * *position + 1];
+            if (lon - eps <= row_lon && row_lon <= lon + eps && lat - eps <= row_lat && row_lat <= lat + eps)
+                result.push_back(*position);
+        }
+    };
+    auto check_cell = [&](const std::uint64_t key)
+    {
+        const std::uint64_t *loaded_key = std::lower_bound(loaded_keys, loaded_keys + loaded_cells_amount, key);
+        if (loaded_key != loaded_keys + loaded_cells_amount && *loaded_key == key)
+        {
+            size_t i = loaded_key - loaded_keys;
+            check_positions(loaded_positions + loaded_offsets[i], loaded_positions + loaded_offsets[i + 1]);
+        }
+        auto cell = cells.find(key);
+        if (cell != cells.end())
+            check_positions(cell->second.data(), cell->second.data() + cell->second.size());
+    };
+
+    std::int64_t min_lon = cell_index(lon - eps), max_lon = cell_index(lon + eps);
+    std::int64_t min_lat = cell_index(lat - eps), max_lat = cell_index(lat + eps);
+    // A box bigger than the whole map is answered by visiting the filled cells only
+    if (static_cast<double>(max_lon - min_lon + 1) * (max_lat - min_lat + 1) > loaded_cells_amount + cells.size())
+    {
+        if (loaded_cells_amount)
+            check_positions(loaded_positions, loaded_positions + loaded_offsets[loaded_cells_amount]);
+        for (const auto &cell : cells)
+            check_positions(cell.second.data(), cell.second.data() + cell.second.size());
+    }
+    else
+    {
+        for (std::int64_t i = min_lon; i <= max_lon; ++i)
+        {
+            for (std::int64_t j = min_lat; j <= max_lat; ++j)
+                check_cell(cell_key(i, j));
+        }
+    }
+    std::sort(result.begin(), result.end());
+    return result;
+}
+
+bool LocationGrid::load(const std::string &path, const unsigned max_rows, const std::uint64_t table_identity)
+{
+    clear();
+    if (!file.open(path) || file.size() < sizeof(GridHeader))
+    {
+        file.close();
+        return false;
+    }
+    const GridHeader *header = reinterpret_cast<const GridHeader *>(file.data());
+    size_t expected_size = sizeof(GridHeader) + header->cells_amount * (sizeof(std::uint64_t) + sizeof(std::uint32_t)) +
+                           sizeof(std::uint32_t) + header->rows * sizeof(std::uint32_t);
+    if (!std::equal(header->magic, header->magic + 4, GRID_MAGIC) || header->version != GRID_VERSION ||
+        header->cell_size != cell_size || header->table_identity != table_identity || header->rows > max_rows || file.size() != expected_size)
+    {
+        file.close();
+        return false;
+    }
+
+    rows = header->rows;
+    loaded_cells_amount = header->cells_amount;
+    const char *data = file.data() + sizeof(GridHeader);
+    loaded_keys = reinterpret_cast<const std::uint64_t *>(data);
+    loaded_offsets = reinterpret_cast<const std::uint32_t *>(data + loaded_cells_amount * sizeof(std::uint64_t));
+    loaded_positions = loaded_offsets + loaded_cells_amount + 1;
+    return true;
+}
+
+void LocationGrid::save(const std::string &path, const std::uint64_t table_identity) const
+{
+    std::map<std::uint64_t, std::vector<unsigned>> sorted_cells;
+    for (unsigned i = 0; i < loaded_cells_amount; ++i)
+        sorted_cells[loaded_keys[i]].assign(loaded_positions + loaded_offsets[i], loaded_positions + loaded_offsets[i + 1]);
+    for (const auto &cell : cells)
+    {
+        std::vector<unsigned> &positions = sorted_cells[cell.first];
+        positions.insert(positions.end(), cell.second.begin(), cell.second.end());
+    }
+
+    std::vector<std::uint64_t> keys;
+    std::vector<std::uint32_t> offsets = {0};
+    std::vector<std::uint32_t> positions;
+    for (const auto &cell : sorted_cells)
+    {
+        keys.push_back(cell.first);
+        positions.insert(positions.end(), cell.second.begin(), cell.second.end());
+        offsets.push_back(positions.size());
+    }
+
+    // Written next to the old file and renamed over it, so a mapped grid is never seen half written
+    std::string temp_path = temporary_path(path);
+    bool output_written;
+    {
+        std::ofstream output(temp_path, std::ios::binary | std::ios::trunc);
+        GridHeader header = {{GRID_MAGIC[0], GRID_MAGIC[1], GRID_MAGIC[2], GRID_MAGIC[3]}, GRID_VERSION, cell_size, table_identity, positions.size(), keys.size()};
+        output.write(reinterpret_cast<const char *>(&header), sizeof(header));
+        output.write(reinterpret_cast<const char *>(keys.data()), keys.size() * sizeof(std::uint64_t));
+        output.write(reinterpret_cast<const char *>(offsets.data()), offsets.size() * sizeof(std::uint32_t));
+        output.write(reinterpret_cast<const char *>(positions.data()), positions.size() * sizeof(std::uint32_t));
+        output.close();
+        output_written = static_cast<bool>(output);
+    }
+    if (!output_written || std::rename(temp_path.c_str(), path.c_str()) != 0)
+    {
+        std::remove(temp_path.c_str());
+        throw std::runtime_error("Can not write location grid to " + path);
+    }
+}
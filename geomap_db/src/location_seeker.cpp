@@ -1,22 +1,119 @@
 #include <location_seeker.hpp>
 
-std::vector<std::vector<double>> LocationSeeker::get_image_embeddings(const std::string &image_path)
+std::vector<std::vector<double>> to_embeddings(const py::array_t<float, py::array::c_style | py::array::forcecast> &array)
 {
-    py::module_ image_processing = py::module_::import("py_src.image_processing");
-    py::object image_embeddings = image_processing.attr("get_geomap_embeddings")(image_path);
-    std::vector<std::vector<double>> result(image_embeddings.cast<std::vector<std::vector<double>>>());
-    std::cout << "Detected " << result.size() << " objects" << std::endl;
+    auto embeddings = array.unchecked<2>();
+    std::vector<std::vector<double>> result(embeddings.shape(0));
+    for (py::ssize_t i = 0; i < embeddings.shape(0); ++i)
+    {
+        result[i].assign(embeddings.data(i, 0), embeddings.data(i, 0) + embeddings.shape(1));
+    }
+    return result;
+}
+
+TrackedObjects to_tracked_objects(const py::tuple &objects)
+{
+    TrackedObjects result;
+    result.track_ids = objects[0].cast<std::vector<long>>();
+    result.embeddings = to_embeddings(objects[1].cast<py::array_t<float, py::array::c_style | py::array::forcecast>>());
+    result.embedded = objects[2].cast<std::vector<bool>>();
+    return result;
+}
+
+TrackedObjects LocationSeeker::get_image_objects(const std::string &image_path)
+{
+    TrackedObjects result = to_tracked_objects(image_processing.attr("get_tracked_embeddings")(tracker, image_path));
+    std::cout << "Detected " << result.track_ids.size() << " objects" << std::endl;
     return result;
 }
 
+void LocationSeeker::set_current_location(const double lon, const double lat)
+{
+    previous_lon = lon;
+    previous_lat = lat;
+    geomap_db.move_to(previous_lon, previous_lat);
+    // Tracks and their matches belong to the previous location, they are not carried over a jump
+    track_matches.clear();
+    tracker = image_processing.attr("BuildingTracker")();
+}
+
+void LocationSeeker::warm_up()
+{
+    image_processing.attr("warm_up")();
+}
+
 std::vector<double> LocationSeeker::update_current_location(const std::string &image_path, const double eps)
 {
-    std::vector<std::vector<double>> image_embeddings = get_image_embeddings(image_path);
+    const long frame = frames_amount;
+    ScopedTimer timer("frame", frame);
+    // Python stages of the frame are logged with its index
+    bool is_measured = Metrics::instance().enabled();
+    if (is_measured)
+        python_metrics.attr("set_frame")(frame);
+    TrackedObjects objects = get_image_objects(image_path);
+    if (is_measured)
+        python_metrics.attr("set_frame")(py::none());
+    return update_current_location(objects, eps, frame);
+}
+
+long LocationSeeker::next_frame(const long frame_index)
+{
+    const long frame = frame_index >= 0 ? frame_index : static_cast<long>(frames_amount);
+    frames_amount += 1;
+    return frame;
+}
+
+std::vector<double> LocationSeeker::update_current_location(const std::vector<std::vector<double>> &image_embeddings, const double eps, const long frame_index)
+{
+    const long frame = next_frame(frame_index);
+    ScopedTimer timer("position_update", frame);
+    std::vector<std::vector<double>> matches;
+    {
+        ScopedTimer query_timer("db_query", frame);
+        matches = geomap_db.get_closest_most_similar_objects(previous_lon, previous_lat, eps, image_embeddings);
+    }
+    return locate(matches, frame);
+}
+
+std::vector<double> LocationSeeker::update_current_location(const TrackedObjects &objects, const double eps, const long frame_index)
+{
+    const long frame = next_frame(frame_index);
+    ScopedTimer timer("position_update", frame);
+    std::vector<std::vector<double>> matches(objects.track_ids.size()), lookups;
+    std::vector<size_t> lookup_positions;
+    for (size_t i = 0; i < objects.track_ids.size(); ++i)
+    {
+        auto cached = track_matches.find(objects.track_ids[i]);
+        // A track without a match is looked up again, the location it was looked up around may have been wrong
+        if (!objects.embedded[i] && cached != track_matches.end() && !cached->second.empty())
+            matches[i] = cached->second;
+        else
+        {
+            lookups.push_back(objects.embeddings[i]);
+            lookup_positions.push_back(i);
+        }
+    }
+    if (!lookups.empty())
+    {
+        ScopedTimer query_timer("db_query", frame);
+        std::vector<std::vector<double>> found = geomap_db.get_closest_most_similar_objects(previous_lon, previous_lat, eps, lookups);
+        for (size_t i = 0; i < found.size(); ++i)
+            matches[lookup_positions[i]] = std::move(found[i]);
+    }
+    Metrics::instance().count("matches_reused", objects.track_ids.size() - lookups.size(), frame);
+    // Tracks missing from the frame are forgotten, their ids are not given again
+    track_matches.clear();
+    for (size_t i = 0; i < objects.track_ids.size(); ++i)
+        track_matches[objects.track_ids[i]] = matches[i];
+    return locate(matches, frame);
+}
+
+std::vector<double> LocationSeeker::locate(const std::vector<std::vector<double>> &matches, const long frame)
+{
     double temp_lat = 0, temp_lon = 0;
     unsigned recognition_amount = 0;
-    for (const auto img_embed : image_embeddings)
+    for (const auto &db_embedding : matches)
     {
-        std::vector<double> db_embedding(geomap_db.get_closest_most_similar_object(previous_lon, previous_lat, eps, img_embed));
         if (!db_embedding.empty())
         {
             recognition_amount += 1;
@@ -25,10 +122,12 @@ std::vector<double> LocationSeeker::update_current_location(const std::string &i
         }
     }
     std::cout << "Recognized " << recognition_amount << " objects" << std::endl;
+    Metrics::instance().count("objects_recognized", recognition_amount, frame);
     if (recognition_amount)
     {
         previous_lat = temp_lat / recognition_amount;
         previous_lon = temp_lon / recognition_amount;
+        geomap_db.move_to(previous_lon, previous_lat);
     }
     return {previous_lat, previous_lon};
 }
@@ -0,0 +1,67 @@
+#include <mapped_file.hpp>
+#include <thread>
+#include <functional>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+
+MappedFile::MappedFile()
+{
+    mapping = nullptr;
+    mapping_size = 0;
+}
+
+MappedFile::~MappedFile()
+{
+    close();
+}
+
+bool MappedFile::open(const std::string &path)
+{
+    close();
+    int file = ::open(path.c_str(), O_RDONLY);
+    if (file < 0)
+        return false;
+    struct stat file_stat;
+    if (fstat(file, &file_stat) != 0 || file_stat.st_size == 0)
+    {
+        ::close(file);
+        return false;
+    }
+    void *file_mapping = mmap(nullptr, file_stat.st_size, PROT_READ, MAP_SHARED, file, 0);
+    ::close(file);
+    if (file_mapping == MAP_FAILED)
+        return false;
+    mapping = file_mapping;
+    mapping_size = file_stat.st_size;
+    return true;
+}
+
+void MappedFile::close()
+{
+    if (mapping)
+        munmap(mapping, mapping_size);
+    mapping = nullptr;
+    mapping_size = 0;
+}
+
+bool MappedFile::is_open() const
+{
+    return mapping != nullptr;
+}
+
+const char *MappedFile::data() const
+{
+    return static_cast<const char *>(mapping);
+}
+
+size_t MappedFile::size() const
+{
+    return mapping_size;
+}
+
+std::string temporary_path(const std::string &path)
+{
+    return path + "." + std::to_string(getpid()) + "." + std::to_string(std::hash<std::thread::id>()(std::this_thread::get_id())) + ".tmp";
+}
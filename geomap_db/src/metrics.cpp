@@ -0,0 +1,62 @@
+#include <metrics.hpp>
+#include <cstdlib>
+#include <sstream>
+#include <iostream>
+#include <unistd.h>
+
+Metrics::Metrics() : sink(NULL)
+{
+    const char *path = std::getenv("GEOMAP_METRICS");
+    if (path == NULL || !*path)
+        return;
+    sink = std::string(path) == "-" ? stderr : std::fopen(path, "a");
+    if (sink == NULL)
+        std::cerr << "Metrics error: can not open " << path << std::endl;
+}
+
+Metrics::~Metrics()
+{
+    if (sink != NULL && sink != stderr)
+        std::fclose(sink);
+}
+
+Metrics &Metrics::instance()
+{
+    static Metrics metrics;
+    return metrics;
+}
+
+void Metrics::record(const std::string &stage, const double ms, const long frame)
+{
+    if (!enabled())
+        return;
+    std::ostringstream event;
+    event << "{\"stage\": \"" << stage << "\", \"ms\": " << ms;
+    write(event.str(), frame);
+}
+
+void Metrics::count(const std::string &counter, const double value, const long frame)
+{
+    if (!enabled())
+        return;
+    std::ostringstream event;
+    event << "{\"counter\": \"" << counter << "\", \"value\": " << value;
+    write(event.str(), frame);
+}
+
+// Appends time, pid and frame to the event and writes it as one line
+void Metrics::write(const std::string &event, const long frame)
+{
+    std::ostringstream line;
+    line.setf(std::ios::fixed);
+    line.precision(6);
+    line << event << ", \"time\": " << std::chrono::duration<double>(std::chrono::system_clock::now().time_since_epoch()).count()
+         << ", \"pid\": " << getpid();
+    if (frame >= 0)
+        line << ", \"frame\": " << frame;
+    line << "}\n";
+    std::string text = line.str();
+    std::lock_guard<std::mutex> lock(sink_mutex);
+    std::fwrite(text.data(), 1, text.size(), sink);
+    std::fflush(sink);
+}
@@ -1,8 +1,27 @@
 #include <geomap_db.hpp>
 #include <iostream>
+#include <stdexcept>
+#include <string>
 
-int main()
+// Prints geomap.db, which is opened read-only.
+// Usage: ./print_table [--migrate], --migrate opens it for writing, so a table of an older version is migrated first
+int main(int argc, char *argv[])
 {
-    GeomapDB geomap(16, "geomap.db", "geomap_embeddings");
-    geomap.print_db(std::cout);
+    bool migrate = argc == 2 && std::string(argv[1]) == "--migrate";
+    if (argc > 2 || (argc == 2 && !migrate))
+    {
+        std::cerr << "Usage: ./print_table [--migrate]" << std::endl;
+        return 1;
+    }
+    try
+    {
+        GeomapDB geomap(16, "geomap.db", "geomap_embeddings", !migrate);
+        geomap.print_db(std::cout);
+    }
+    catch (const std::runtime_error &error)
+    {
+        std::cerr << "print_table error: " << error.what() << std::endl;
+        return 1;
+    }
+    return 0;
 }
@@ -0,0 +1,219 @@
+#include <sharded_geomap_db.hpp>
+#include <cmath>
+#include <cstdlib>
+#include <fstream>
+#include <sstream>
+#include <metrics.hpp>
+
+constexpr const char *ShardedGeomapDB::SHARDS_SUFFIX;
+constexpr const char *ShardedGeomapDB::MANIFEST_NAME;
+
+ShardedGeomapDB::ShardedGeomapDB(const unsigned dim_embedding, const std::string &db_name, const int shards_radius)
+{
+    embedding_dim = dim_embedding;
+    shards_path = db_name + SHARDS_SUFFIX;
+    shard_size = 0;
+    radius = shards_radius;
+    stopping = false;
+    if (!read_manifest())
+    {
+        whole.reset(new GeomapDB(embedding_dim, db_name, "geomap_embeddings", true));
+        return;
+    }
+    std::cout << "Geomap is split into " << available.size() << " shards of " << shard_size << " degrees" << std::endl;
+    loader = std::thread(&ShardedGeomapDB::load_shards, this);
+}
+
+ShardedGeomapDB::~ShardedGeomapDB()
+{
+    if (!loader.joinable())
+        return;
+    {
+        std::lock_guard<std::mutex> lock(mutex);
+        stopping = true;
+    }
+    changed.notify_all();
+    loader.join();
+}
+
+// Manifest is "shard_size <degrees>" and a line "<lon cell> <lat cell> <rows> <digest>" per shard
+bool ShardedGeomapDB::read_manifest()
+{
+    std::ifstream file(shards_path + "/" + MANIFEST_NAME);
+    std::string key;
+    if (!file || !(file >> key >> shard_size) || key != "shard_size" || shard_size <= 0)
+        return false;
+    std::string line;
+    while (std::getline(file, line))
+    {
+        std::istringstream fields(line);
+        Cell cell;
+        if (fields >> cell.first >> cell.second)
+            available.insert(cell);
+    }
+    return !available.empty();
+}
+
+bool ShardedGeomapDB::is_sharded() const
+{
+    return !whole;
+}
+
+ShardedGeomapDB::Cell ShardedGeomapDB::cell_of(const double lon, const double lat) const
+{
+    return Cell(static_cast<std::int64_t>(std::floor(lon / shard_size)), static_cast<std::int64_t>(std::floor(lat / shard_size)));
+}
+
+std::string ShardedGeomapDB::shard_name(const Cell &cell) const
+{
+    return shards_path + "/shard_" + std::to_string(cell.first) + "_" + std::to_string(cell.second) + ".db";
+}
+
+bool ShardedGeomapDB::is_near(const Cell &cell, const Cell &center, const int cells) const
+{
+    return std::llabs(cell.first - center.first) <= cells && std::llabs(cell.second - center.second) <= cells;
+}
+
+void ShardedGeomapDB::move_to(const double lon, const double lat)
+{
+    if (!is_sharded())
+        return;
+    Cell center = cell_of(lon, lat);
+    {
+        std::lock_guard<std::mutex> lock(mutex);
+        // Shards are kept one cell longer than they are prefetched, so flying along a border does not reload them
+        for (auto shard = loaded.begin(); shard != loaded.end();)
+        {
+            if (is_near(shard->first, center, radius + 1))
+            {
+                ++shard;
+                continue;
+            }
+            released.push_back(std::move(shard->second));
+            shard = loaded.erase(shard);
+        }
+        for (auto cell = queued.begin(); cell != queued.end();)
+        {
+            if (is_near(*cell, center, radius + 1))
+            {
+                ++cell;
+                continue;
+            }
+            pending.erase(*cell);
+            cell = queued.erase(cell);
+        }
+        // Closer shards are queued first
+        for (int distance = 0; distance <= radius; ++distance)
+        {
+            for (std::int64_t lon_cell = center.first - distance; lon_cell <= center.first + distance; ++lon_cell)
+            {
+                for (std::int64_t lat_cell = center.second - distance; lat_cell <= center.second + distance; ++lat_cell)
+                {
+                    Cell cell(lon_cell, lat_cell);
+                    if (is_near(cell, center, distance - 1) || !available.count(cell) || loaded.count(cell) || pending.count(cell))
+                        continue;
+                    queued.push_back(cell);
+                    pending.insert(cell);
+                }
+            }
+        }
+    }
+    changed.notify_all();
+}
+
+std::shared_ptr<GeomapDB> ShardedGeomapDB::require(const Cell &cell)
+{
+    std::unique_lock<std::mutex> lock(mutex);
+    if (!available.count(cell))
+        return nullptr;
+    auto shard = loaded.find(cell);
+    if (shard != loaded.end())
+        return shard->second;
+    if (!pending.count(cell))
+    {
+        pending.insert(cell);
+        queued.push_front(cell);
+        changed.notify_all();
+    }
+    Metrics::instance().count("shard_misses", 1);
+    changed.wait(lock, [this, &cell] { return loaded.count(cell) || !pending.count(cell) || stopping; });
+    shard = loaded.find(cell);
+    return shard != loaded.end() ? shard->second : nullptr;
+}
+
+std::vector<std::vector<double>> ShardedGeomapDB::get_closest_most_similar_objects(const double lon, const double lat, const double eps_loc, const std::vector<std::vector<double>> &embeddings)
+{
+    if (!is_sharded())
+        return whole->get_closest_most_similar_objects(lon, lat, eps_loc, embeddings);
+
+    // Every embedding keeps its best match over all shards the box overlaps, distance is the last cord of a match
+    std::vector<std::vector<double>> result(embeddings.size());
+    Cell first = cell_of(lon - eps_loc, lat - eps_loc), last = cell_of(lon + eps_loc, lat + eps_loc);
+    for (std::int64_t lon_cell = first.first; lon_cell <= last.first; ++lon_cell)
+    {
+        for (std::int64_t lat_cell = first.second; lat_cell <= last.second; ++lat_cell)
+        {
+            std::shared_ptr<GeomapDB> shard = require(Cell(lon_cell, lat_cell));
+            if (!shard)
+                continue;
+            std::vector<std::vector<double>> matches = shard->get_closest_most_similar_objects(lon, lat, eps_loc, embeddings);
+            for (size_t i = 0; i < matches.size(); ++i)
+            {
+                if (!matches[i].empty() && (result[i].empty() || matches[i].back() < result[i].back()))
+                    result[i] = std::move(matches[i]);
+            }
+        }
+    }
+    return result;
+}
+
+unsigned ShardedGeomapDB::loaded_shards_amount()
+{
+    if (!is_sharded())
+        return 1;
+    std::lock_guard<std::mutex> lock(mutex);
+    return loaded.size();
+}
+
+// Opens queued shards and closes released ones outside the lock, closing saves caches a shard has built
+void ShardedGeomapDB::load_shards()
+{
+    std::unique_lock<std::mutex> lock(mutex);
+    while (true)
+    {
+        changed.wait(lock, [this] { return stopping || !queued.empty() || !released.empty(); });
+        if (stopping)
+            break;
+        if (!released.empty())
+        {
+            std::vector<std::shared_ptr<GeomapDB>> closing;
+            closing.swap(released);
+            lock.unlock();
+            Metrics::instance().count("shards_released", closing.size());
+            closing.clear();
+            lock.lock();
+            continue;
+        }
+        Cell cell = queued.front();
+        queued.pop_front();
+        lock.unlock();
+        std::shared_ptr<GeomapDB> shard;
+        try
+        {
+            ScopedTimer timer("shard_load");
+            shard = std::make_shared<GeomapDB>(embedding_dim, shard_name(cell), "geomap_embeddings", true);
+        }
+        catch (const std::exception &error)
+        {
+            std::cerr << "Loading shard error: " << shard_name(cell) << ": " << error.what() << std::endl;
+        }
+        lock.lock();
+        // A shard which can not be opened is not asked for again
+        if (shard)
+            loaded[cell] = shard;
+        else
+            available.erase(cell);
+        pending.erase(cell);
+        changed.notify_all();
+    }
+}
@@ -0,0 +1,26 @@
+#include <localisation_pipeline.hpp>
+#include <string>
+#include <iostream>
+#include <stdexcept>
+
+const unsigned EMBEDDING_DIMENSION = 16;
+const double LOCATION_EPS = 0.001;
+
+// Usage: ./video_localisation video_source lon lat [--no-drop]
+// video_source is a camera index or a video file, with --no-drop every frame of it is located
+int main(int argc, char *argv[])
+{
+    if (argc != 4 && !(argc == 5 && std::string(argv[4]) == "--no-drop"))
+        throw std::runtime_error("Input must be in form of (video_source lon lat [--no-drop])");
+    std::string video_source = argv[1];
+    double start_lon = std::stod(argv[2]), start_lat = std::stod(argv[3]);
+
+    LocationSeeker lock_seeker(EMBEDDING_DIMENSION, "geomap.db", start_lon, start_lat);
+    lock_seeker.warm_up();
+    PipelineOptions options;
+    options.drop_frames = argc != 5;
+    options.location_eps = LOCATION_EPS;
+    LocalisationPipeline pipeline(lock_seeker, options);
+    pipeline.run(video_source);
+    return 0;
+}
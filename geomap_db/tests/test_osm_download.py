@@ -0,0 +1,129 @@
+"""
+Tests of OsmDownloader against a local HTTP server standing in for the OSM API
+"""
+
+import sys
+import os
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import osmapi
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from py_src.osm_download import OsmDownloader
+
+RELATION_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+ <relation id="{id}" visible="true" version="1" changeset="1" timestamp="2020-01-01T00:00:00Z" user="user" uid="1">
+  <member type="way" ref="2" role="outer"/>
+  <tag k="building" v="yes"/>
+ </relation>
+</osm>'''
+
+class OsmApiStub(ThreadingHTTPServer):
+    """
+    Answers every request with the next scripted (status, body), the last one is repeated.
+    Paths and times of the requests are recorded
+    """
+    def __init__(self, responses : list):
+        super().__init__(('127.0.0.1', 0), OsmApiHandler)
+        self.responses = list(responses)
+        self.requests = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def next_response(self, path : str) -> tuple:
+        with self.lock:
+            self.requests.append((path, time.monotonic()))
+            return self.responses.pop(0) if len(self.responses) > 1 else self.responses[0]
+
+class OsmApiHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        status, body = self.server.next_response(self.path)
+        if status == 200:
+            body = body.format(id=self.path.rstrip('/').split('/')[-1])
+        data = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml' if status == 200 else 'text/plain')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def osm_api():
+    servers = []
+
+    def start(*responses):
+        server = OsmApiStub(responses)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+def downloader(server, cache_dir=None, **kwargs) -> OsmDownloader:
+    options = dict(requests_per_second=1000.0, retries=3, backoff=0.01)
+    options.update(kwargs)
+    return OsmDownloader(api_url=server.url, cache_dir=cache_dir, **options)
+
+@pytest.mark.parametrize('status', [509, 429])
+def test_retry_waits_as_server_asks(osm_api, status):
+    server = osm_api((status, 'You have downloaded too much data. Please try again in 1 seconds.'),
+                     (200, RELATION_XML))
+    relation = downloader(server).relation(1)
+    assert relation['id'] == 1
+    assert relation['member'][0]['ref'] == 2
+    assert len(server.requests) == 2
+    # The server asked for 1 second, backoff alone would wait about 10 ms
+    assert server.requests[1][1] - server.requests[0][1] >= 1.0
+
+def test_gives_up_after_retries(osm_api):
+    server = osm_api((503, 'Service unavailable'))
+    with pytest.raises(osmapi.ApiError) as error:
+        downloader(server, retries=2).relation(1)
+    assert error.value.status == 503
+    assert len(server.requests) == 3
+
+def test_error_which_is_not_transient_is_not_retried(osm_api):
+    server = osm_api((400, 'Bad request'), (200, RELATION_XML))
+    with pytest.raises(osmapi.ApiError):
+        downloader(server).relation(1)
+    assert len(server.requests) == 1
+
+@pytest.mark.parametrize('status', [404, 410])
+def test_missing_element_is_skipped_and_cached(osm_api, tmp_path, status):
+    server = osm_api((status, 'Gone'))
+    assert downloader(server, str(tmp_path)).relation(1) is None
+    assert downloader(server, str(tmp_path)).relation(1) is None
+    assert downloader(server, str(tmp_path)).ways([1, 2]) == {}
+    assert len(server.requests) == 2
+
+def test_cache_hit_makes_no_request(osm_api, tmp_path):
+    server = osm_api((200, RELATION_XML))
+    first = downloader(server, str(tmp_path)).relation(7)
+    assert len(server.requests) == 1
+    second = downloader(server, str(tmp_path)).relation(7)
+    assert second == first
+    assert len(server.requests) == 1
+    downloader(server, str(tmp_path)).relation(8)
+    assert len(server.requests) == 2
+
+def test_token_bucket_limits_request_rate(osm_api):
+    server = osm_api((200, RELATION_XML))
+    osm = downloader(server, requests_per_second=10.0, max_workers=2)
+    osm.map(osm.relation, list(range(1, 13)))
+    times = sorted(request_time for _, request_time in server.requests)
+    assert len(times) == 12
+    # The bucket holds a token per worker, the other 10 requests wait for refills at 10 per second
+    assert times[-1] - times[0] >= 0.95
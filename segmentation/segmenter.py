@@ -1,10 +1,42 @@
+import threading
 import cv2
 import numpy as np
 from typing import List
-from ultralytics import YOLO
 
 
-_model = YOLO('dronuniver_yolov8nseg.pt')
+MODEL_PATH = 'dronuniver_yolov8nseg.pt'
+
+# Built on first use, importing ultralytics alone takes seconds
+_model = None
+_model_lock = threading.Lock()
+
+
+def get_model():
+    '''
+    Returns:
+        model: YOLO - segmentation model, loaded once per process \
+            even if several threads ask for it at the same time
+    '''
+    global _model
+    model = _model
+    if model is None:
+        with _model_lock:
+            if _model is None:
+                from ultralytics import YOLO
+                _model = YOLO(MODEL_PATH)
+            model = _model
+    return model
+
+
+def warm_up(size: int = 640) -> None:
+    '''
+    Loads the model and runs it once on a blank image, \
+        so the first real image does not pay for initialisation
+
+    Params:
+        size: int - side of the blank image
+    '''
+    get_model()(np.zeros((size, size, 3), np.uint8), verbose=False)
 
 
 def segment_buildings(img_name: str) -> List[np.ndarray]:
@@ -17,20 +49,26 @@ def segment_buildings(img_name: str) -> List[np.ndarray]:
             (numpy array)
     '''
     clear_img = cv2.imread(img_name)
-    segmented = _model(img_name)[0]
-    masks = segmented.masks.data.numpy()
-
-    result = [None] * len(masks)
-
-    for i in range(len(masks)):
-        img = clear_img.copy()
-        mask0 = cv2.resize(masks[i], dsize=(img.shape[-2::-1])).astype(np.uint8)
-        masked_img = cv2.bitwise_and(img, img, mask=mask0)
-        non_zero_coords = np.argwhere(mask0 > 0)
-        y_min, x_min = non_zero_coords.min(axis=0)
-        y_max, x_max = non_zero_coords.max(axis=0)
-        cropped_image = masked_img[y_min:y_max+1, x_min:x_max+1]
-        result[i] = cropped_image[:, :, ::-1]
+    segmented = get_model()(clear_img)[0]
+    if segmented.masks is None:
+        return []
+    height, width = clear_img.shape[:2]
+
+    # Polygons are in image coordinates, each one is filled only inside its own bounds
+    # and the crop is a view into the image until it is masked
+    result = []
+    for polygon in segmented.masks.xy:
+        if not len(polygon):
+            continue
+        polygon = polygon.astype(np.int32)
+        x_min, y_min = np.maximum(polygon.min(axis=0), 0)
+        x_max, y_max = np.minimum(polygon.max(axis=0), (width - 1, height - 1))
+        if x_max < x_min or y_max < y_min:
+            continue
+        mask = np.zeros((y_max - y_min + 1, x_max - x_min + 1), np.uint8)
+        cv2.fillPoly(mask, [polygon], 1, offset=(-int(x_min), -int(y_min)))
+        crop = clear_img[y_min:y_max+1, x_min:x_max+1]
+        result.append(cv2.bitwise_and(crop, crop, mask=mask)[:, :, ::-1])
 
     return result
 